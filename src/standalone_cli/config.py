@@ -33,14 +33,94 @@ class ProcessingConfiguration:
     COMPRESSION_ALGORITHM = "7z" # Options: "Uncompressed", "7z", "tar" (Not used for AIP anymore)
     COMPRESSION_LEVEL = 0 # 0 = Uncompressed DIP, 1-9 = 7z Compressed DIP
 
+    # Distributed worker mode (--worker)
+    QUEUE_LEASE_SECONDS = 300 # A transfer is reclaimed if its worker misses heartbeats for this long
+    QUEUE_HEARTBEAT_SECONDS = 60
+    QUEUE_MAX_ATTEMPTS = 3 # Transfers whose lease expired this many times are marked failed
+
+    UPDATE_AIP_INDEX = True # Record every stored AIP's files in the AIP index
+
+    # Space reserved on a scratch volume per transfer, as a multiple of the transfer size
+    # (working copy + derivatives + bag files)
+    SCRATCH_HEADROOM = 2.0
+
+    # Server mode (serve)
+    SERVER_HOST = "127.0.0.1" # Loopback only: the job API has no authentication
+    SERVER_PORT = 8765
+    SERVER_WORKERS = 2 # Transfers processed concurrently
+    SERVER_JOB_TTL_SECONDS = 24 * 3600 # Finished jobs are forgotten this long after they end...
+    SERVER_MAX_FINISHED_JOBS = 1000 # ...or once more than this many have finished, oldest first
+
+    # Per-file messages (e.g. "Normalized X to TIFF") are rolled up into a console summary this often
+    PROGRESS_SUMMARY_SECONDS = 10
+
+    # Holey bags: files of at least this many bytes are left where they are and listed in fetch.txt
+    # instead of being copied into the AIP. 0 disables the size check. See also Paths.FETCH_PATH_PREFIXES
+    FETCH_SIZE_THRESHOLD = 0
+
+    # Virus scan results are cached per (sha256, ClamAV signature version); only unseen content is scanned
+    SCAN_CACHE = True
+    SCAN_CACHE_MAX_ENTRIES = 1000000 # Least recently used entries beyond this are evicted
+
+    # Store the AIP of originals first and queue normalization (and the DIP) for the 'deferred' command
+    DEFER_NORMALIZATION = False
+    DEFERRED_NICENESS = 10 # Added to the 'deferred' command's niceness (Unix only)
+
+    # Sharding: per-file work on transfers of at least SHARD_MIN_FILES files (virus scan, identification,
+    # normalization, checksums) is split into contiguous shards run by SHARD_WORKERS threads and merged in
+    # order, so the bag is the same as after a serial run
+    SHARD_MIN_FILES = 10000
+    SHARD_FILES = 5000 # A shard is closed at the next directory after this many files...
+    SHARD_BYTES = 20 * 1024**3 # ...or this many bytes
+    SHARD_WORKERS = os.cpu_count() or 1
+    # Each clamscan process loads the full signature database, so the virus scan is only split this many ways
+    # unless AM_CLAMSCAN_CMD is clamdscan, which shares the signatures loaded by clamd and uses SHARD_WORKERS
+    SCAN_SHARD_WORKERS = 1
+
+class DeferredNormalizationConfiguration(ProcessingConfiguration):
+    # --profile deferred: originals are preserved in minutes, derivatives follow in the background
+    DEFER_NORMALIZATION = True
+
+# Processing profiles selectable with --profile
+PROFILES = {
+    "default": ProcessingConfiguration,
+    "deferred": DeferredNormalizationConfiguration,
+}
+
 class Paths:
     # Default paths - EDIT THESE or set via environment variables
     TRANSFER_SOURCE = os.getenv("AM_TRANSFER_SOURCE", r"C:\Users\madan\Documents\archivematica\transfers")
     AIP_STORAGE = os.getenv("AM_AIP_STORAGE", r"C:\Users\madan\Documents\archivematica\storage\aips")
     DIP_STORAGE = os.getenv("AM_DIP_STORAGE", r"C:\Users\madan\Documents\archivematica\storage\dips")
 
+    # Shared job table for --worker mode. Defaults to <transfer path>/.am-queue.sqlite
+    QUEUE_DB = os.getenv("AM_QUEUE_DB")
+
+    # Cross-AIP file index. Defaults to <AIP storage>/aip-index.sqlite
+    AIP_INDEX = os.getenv("AM_AIP_INDEX")
+
+    # Scratch volumes for processing directories, fastest first, separated by os.pathsep
+    # (':' on Linux, ';' on Windows). Defaults to ./processing
+    SCRATCH_VOLUMES = [p for p in os.getenv("AM_SCRATCH_VOLUMES", "").split(os.pathsep) if p] or ["processing"]
+
+    # Chrome trace-event file with a span per step and per tool invocation. Tracing is off when unset
+    TRACE_FILE = os.getenv("AM_TRACE_FILE")
+
+    # Directory for per-transfer JSON-lines logs (<transfer>-<run id>.jsonl)
+    LOG_DIR = os.getenv("AM_LOG_DIR", "logs")
+
+    # Files under these prefixes (e.g. an object store mounted locally) are never copied into the AIP,
+    # only listed in fetch.txt. Separated by os.pathsep
+    FETCH_PATH_PREFIXES = [p for p in os.getenv("AM_FETCH_PATH_PREFIXES", "").split(os.pathsep) if p]
+
+    # Virus scan result cache (see ProcessingConfiguration.SCAN_CACHE)
+    SCAN_CACHE = os.getenv("AM_SCAN_CACHE", "scan-cache.sqlite")
+
+    # Queue of stored AIPs awaiting deferred normalization. Defaults to <AIP storage>/.am-normalization-queue.sqlite
+    NORMALIZATION_QUEUE_DB = os.getenv("AM_NORMALIZATION_QUEUE_DB")
+
     # Tool Paths (Ensure these are in PATH or provide absolute paths)
-    CLAMSCAN_CMD = "clamscan"
+    CLAMSCAN_CMD = os.getenv("AM_CLAMSCAN_CMD", "clamscan") # 'clamdscan' reuses the signatures loaded by a running clamd
     TREE_CMD = "tree" # Windows: might need 'tree.com' or similar if using GnuWin32, or just 'tree' for cmd built-in (but cmd built-in is limited)
     FIDO_CMD = "fido"
     SEVEN_ZIP_CMD = "7z"
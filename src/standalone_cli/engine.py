@@ -1,5 +1,15 @@
 import logging
 import os
+import shutil
+import uuid
+from .config import Paths
+from .utils.fs import directory_size, ignore_paths
+from .utils.scratch import ScratchAllocator
+from .utils import tracing
+from .utils.logs import transfer_logging
+from .utils.fetch import plan_fetch_files
+from .utils.accrual import plan_accrual
+from .steps import WorkflowCancelled
 from .steps.ingest import (
     ScanVirusStep,
     AssignUUIDStep,
@@ -9,25 +19,31 @@ from .steps.ingest import (
 )
 from .steps.process import (
     NormalizeStep,
+    DeferNormalizationStep,
     CreateSIPStep,
-    ProcessContentStep
+    ProcessContentStep,
+    UpdateBagStep
 )
 from .steps.store import (
     StoreAIPStep,
+    QueueNormalizationStep,
     StoreDIPStep
 )
 
 logger = logging.getLogger(__name__)
 
 class WorkflowEngine:
-    def __init__(self, transfer_path, aip_path, dip_path, config):
+    def __init__(self, transfer_path, aip_path, dip_path, config, cancel_event=None, accrual=False):
         self.context = {
             'sip_path': transfer_path,
             'aip_path': aip_path,
             'dip_path': dip_path,
-            'config': config
+            'config': config,
+            'cancel_event': cancel_event
         }
         self.config = config
+        self.cancel_event = cancel_event
+        self.accrual = accrual
         self.steps = []
         
         # Initialize steps based on configuration
@@ -49,16 +65,26 @@ class WorkflowEngine:
         if self.config.CREATE_SIP:
             self.steps.append(CreateSIPStep(self.context))
             
-        if self.config.NORMALIZE:
+        # Deferred profile: normalization and the DIP run later, from the queue, against the stored AIP
+        deferred = self.config.NORMALIZE and self.config.DEFER_NORMALIZATION
+
+        if deferred:
+            self.steps.append(DeferNormalizationStep(self.context))
+        elif self.config.NORMALIZE:
             self.steps.append(NormalizeStep(self.context))
             
         if self.config.EXAMINE_CONTENTS:
             self.steps.append(ProcessContentStep(self.context))
+
+        if self.config.CREATE_SIP:
+            self.steps.append(UpdateBagStep(self.context))
             
         if self.config.STORE_AIP:
             self.steps.append(StoreAIPStep(self.context))
             
-        if self.config.STORE_DIP:
+        if deferred:
+            self.steps.append(QueueNormalizationStep(self.context))
+        elif self.config.STORE_DIP:
             self.steps.append(StoreDIPStep(self.context))
             
         # Note: Other flags like DELETE_PACKAGE_AFTER_EXTRACTION, THUMBNAIL_MODE, etc.
@@ -67,20 +93,54 @@ class WorkflowEngine:
         # and not implemented, so no steps are added for them.
 
     def run(self):
+        run_id = str(uuid.uuid4())
+        transfer_dirname = os.path.basename(self.context['sip_path'].rstrip(os.sep))
+        if not transfer_dirname:
+            transfer_dirname = "transfer"
+
+        with transfer_logging(transfer_dirname, run_id, Paths.LOG_DIR):
+            self._run(run_id, transfer_dirname)
+
+    def _run(self, run_id, transfer_dirname):
         logger.info("Starting Automated Workflow...")
+
+        # Accrual mode: files unchanged since the source's latest AIP are neither copied nor processed
+        skipped = set()
+        skipped_size = 0
+        if self.accrual:
+            accrual = plan_accrual(self.context['sip_path'], transfer_dirname, self.context['aip_path'], self.config.UPDATE_AIP_INDEX)
+            if accrual['parent'] and not (accrual['added'] or accrual['changed'] or accrual['removed']):
+                logger.info(f"No changes since AIP {accrual['parent']['name']}; nothing to ingest.")
+                return
+            self.context['accrual'] = accrual
+            for rel_path in accrual['unchanged']:
+                record = accrual['files'][rel_path]
+                skipped.add(os.path.abspath(record['transfer_path']))
+                skipped_size += record['size']
         
-        # Create a temporary processing directory
-        # We'll use a 'processing' folder in the project root for visibility, or tempdir
-        # Let's use a 'processing' folder in the current working directory as per plan
-        import shutil
-        import uuid
-        
-        processing_root = os.path.abspath("processing")
-        os.makedirs(processing_root, exist_ok=True)
-        
-        # Create a unique subfolder for this run
-        run_id = str(uuid.uuid4())
-        processing_path = os.path.join(processing_root, run_id)
+        # Large files (and files on configured prefixes) are not copied; the bag lists them in fetch.txt
+        fetch_files = [
+            entry for entry in plan_fetch_files(self.context['sip_path'], self.config.FETCH_SIZE_THRESHOLD, Paths.FETCH_PATH_PREFIXES)
+            if os.path.abspath(entry['transfer_path']) not in skipped
+        ]
+        self.context['fetch_files'] = fetch_files
+        if fetch_files:
+            logger.info(f"Leaving {len(fetch_files)} file(s) in place ({sum(e['size'] for e in fetch_files)} bytes); they will be listed in fetch.txt")
+        for entry in fetch_files:
+            if entry.get('outside_prefixes'):
+                # Recorded in the METS as well (see CreateSIPStep)
+                logger.warning(
+                    f"{entry['rel_path']} ({entry['size']} bytes) is left in place outside FETCH_PATH_PREFIXES; "
+                    f"fetch.txt will point into the transfer area at {entry['source']}. Keep it until the bag is completed."
+                )
+        skipped.update(os.path.abspath(entry['transfer_path']) for entry in fetch_files)
+        skipped_size += sum(entry['size'] for entry in fetch_files)
+
+        # Create a temporary processing directory on a scratch volume with room for this transfer
+        transfer_size = directory_size(self.context['sip_path']) - skipped_size
+        allocator = ScratchAllocator(Paths.SCRATCH_VOLUMES)
+        reservation = allocator.reserve(run_id, int(transfer_size * self.config.SCRATCH_HEADROOM))
+        processing_path = reservation.processing_path
         
         logger.info(f"Creating processing environment at {processing_path}...")
         
@@ -92,13 +152,10 @@ class WorkflowEngine:
             # Usually Archivematica preserves the top folder name if it's significant.
             # Let's copy the folder itself to be safe and preserve structure.
             
-            transfer_dirname = os.path.basename(self.context['sip_path'].rstrip(os.sep))
-            if not transfer_dirname:
-                transfer_dirname = "transfer"
-                
             working_sip_path = os.path.join(processing_path, transfer_dirname)
             
-            shutil.copytree(self.context['sip_path'], working_sip_path)
+            with tracing.span("CopyTransfer", transfer=transfer_dirname, path=self.context['sip_path'], size=transfer_size):
+                shutil.copytree(self.context['sip_path'], working_sip_path, ignore=ignore_paths(skipped))
             logger.info(f"Copied transfer to {working_sip_path}")
             
             # Update context to point to the working copy
@@ -107,8 +164,12 @@ class WorkflowEngine:
             
             # Execute steps
             for step in self.steps:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    logger.warning(f"Workflow cancelled before {step.__class__.__name__}")
+                    raise WorkflowCancelled(step.__class__.__name__)
                 try:
-                    step.execute()
+                    with tracing.span(step.__class__.__name__, transfer=transfer_dirname):
+                        step.execute()
                 except Exception as e:
                     logger.error(f"Step {step.__class__.__name__} failed: {e}")
                     raise
@@ -123,3 +184,4 @@ class WorkflowEngine:
                     shutil.rmtree(processing_path)
                 except Exception as e:
                     logger.warning(f"Failed to cleanup processing directory: {e}")
+            reservation.release()
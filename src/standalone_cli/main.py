@@ -2,63 +2,325 @@ import argparse
 import logging
 import sys
 import os
-from .engine import WorkflowEngine
-from .config import Paths, ProcessingConfiguration
+import time
+import json
+import sqlite3
+import urllib.error
+from .engine import WorkflowEngine, WorkflowCancelled
+from .config import Paths, ProcessingConfiguration, PROFILES
+from .utils.fs import tree_fingerprint
+from .utils.job_queue import TransferQueue, Heartbeat, default_worker_id, normalization_queue_path
+from .utils.aip_index import AIPIndex, index_path
+from .utils import tracing
+from .server import serve, JobClient
+from .reprocess import REPROCESS_STEPS, find_aip, reprocess_aip
+from .utils import logs
+from .utils.fetch import complete_bag
+from .utils.scan_cache import ScanCache
 
 def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(sys.stdout)
-        ]
+    # Records are queued and written by a background thread; see utils/logs.py
+    logs.setup_logging(
+        fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        summary_interval=ProcessingConfiguration.PROGRESS_SUMMARY_SECONDS,
+        stream=sys.stdout
     )
 
+def run_transfer(item_path, args, cancel_event=None):
+    engine = WorkflowEngine(
+        transfer_path=item_path,
+        aip_path=args.aip_storage,
+        dip_path=args.dip_storage,
+        config=PROFILES[args.profile],
+        cancel_event=cancel_event,
+        accrual=args.accrual
+    )
+    engine.run()
+
+def list_transfers(transfer_path):
+    return [
+        os.path.join(transfer_path, item)
+        for item in os.listdir(transfer_path)
+        if os.path.isdir(os.path.join(transfer_path, item))
+    ]
+
+def run_batch(args):
+    transfers_found = False
+
+    for item_path in list_transfers(args.transfer_path):
+        transfers_found = True
+        item = os.path.basename(item_path)
+        logging.info(f"Found transfer: {item}")
+
+        try:
+            run_transfer(item_path, args)
+        except Exception as e:
+            logging.exception(f"Workflow failed for transfer {item}")
+            # We continue to the next transfer instead of exiting
+            continue
+
+    if not transfers_found:
+        logging.warning(f"No transfer directories found in {args.transfer_path}")
+
+def run_worker(args):
+    """Claim transfers from the shared queue until none are left."""
+    config = ProcessingConfiguration
+    queue_db = args.queue_db or os.path.join(args.transfer_path, '.am-queue.sqlite')
+    # Transfers are recorded relative to --transfer-path, which may be mounted elsewhere on other hosts
+    queue = TransferQueue(queue_db, lease_seconds=config.QUEUE_LEASE_SECONDS, max_attempts=config.QUEUE_MAX_ATTEMPTS, root=args.transfer_path)
+    worker_id = args.worker_id or default_worker_id()
+    logging.info(f"Worker {worker_id} using queue {queue_db}")
+
+    # Every worker enqueues what it sees; transfers already in the queue are ignored unless they changed
+    for item_path in list_transfers(args.transfer_path):
+        size, fingerprint = tree_fingerprint(item_path)
+        if queue.enqueue(os.path.abspath(item_path), size, fingerprint, force=args.requeue):
+            logging.info(f"Queued transfer: {os.path.basename(item_path)}")
+
+    while True:
+        item_path = queue.claim(worker_id)
+        if item_path is None:
+            # Keep polling while other workers hold leases, so we can take over if one of them dies
+            if queue.counts().get('running', 0) > 0:
+                time.sleep(config.QUEUE_HEARTBEAT_SECONDS)
+                continue
+            break
+
+        item = os.path.basename(item_path)
+        logging.info(f"Worker {worker_id} claimed transfer: {item}")
+        heartbeat = Heartbeat(queue, item_path, worker_id, config.QUEUE_HEARTBEAT_SECONDS)
+        heartbeat.start()
+        try:
+            run_transfer(item_path, args, cancel_event=heartbeat.lost)
+        except WorkflowCancelled:
+            # Another worker holds the transfer now; leave its queue row alone
+            logging.warning(f"Worker {worker_id} abandoned transfer {item}: lease lost")
+        except Exception as e:
+            logging.exception(f"Workflow failed for transfer {item}")
+            queue.fail(item_path, worker_id, str(e))
+        else:
+            queue.complete(item_path, worker_id)
+        finally:
+            heartbeat.stop()
+
+    logging.info(f"Worker {worker_id} finished. Queue state: {queue.counts()}")
+
+def run_deferred(args):
+    """Normalize stored AIPs from the deferred normalization queue at reduced CPU priority."""
+    config = PROFILES[args.profile]
+    if hasattr(os, 'nice'):
+        os.nice(config.DEFERRED_NICENESS)
+    else:
+        logging.warning("Process priority cannot be lowered on this platform; running at normal priority.")
+
+    queue_db = normalization_queue_path(args.aip_storage)
+    queue = TransferQueue(queue_db, lease_seconds=config.QUEUE_LEASE_SECONDS, max_attempts=config.QUEUE_MAX_ATTEMPTS, root=args.aip_storage)
+    worker_id = args.worker_id or default_worker_id()
+    steps = ['normalize', 'dip'] if config.STORE_DIP else ['normalize']
+    logging.info(f"Deferred normalization worker {worker_id} using queue {queue_db}")
+
+    while True:
+        aip_dir = queue.claim(worker_id)
+        if aip_dir is None:
+            if args.poll:
+                time.sleep(args.poll)
+                continue
+            if queue.counts().get('running', 0) > 0:
+                time.sleep(config.QUEUE_HEARTBEAT_SECONDS)
+                continue
+            break
+
+        logging.info(f"Normalizing stored AIP: {os.path.basename(aip_dir)}")
+        heartbeat = Heartbeat(queue, aip_dir, worker_id, config.QUEUE_HEARTBEAT_SECONDS)
+        heartbeat.start()
+        try:
+            reprocess_aip(aip_dir, args.dip_storage, config, steps, cancel_event=heartbeat.lost)
+        except WorkflowCancelled:
+            logging.warning(f"Worker {worker_id} abandoned {os.path.basename(aip_dir)}: lease lost")
+        except Exception as e:
+            logging.exception(f"Deferred normalization failed for {os.path.basename(aip_dir)}")
+            queue.fail(aip_dir, worker_id, str(e))
+        else:
+            queue.complete(aip_dir, worker_id)
+        finally:
+            heartbeat.stop()
+
+    logging.info(f"Deferred normalization queue state: {queue.counts()}")
+
+def run_index(args):
+    if not os.path.isdir(args.aip_storage):
+        logging.error(f"AIP storage does not exist: {args.aip_storage}")
+        sys.exit(1)
+    db_path = index_path(args.aip_storage)
+    if args.index_command == 'query' and not os.path.isfile(db_path):
+        logging.error(f"No AIP index at {db_path}; build it with 'index backfill'")
+        sys.exit(1)
+    try:
+        index = AIPIndex(db_path)
+    except sqlite3.OperationalError as e:
+        # e.g. the directory of AM_AIP_INDEX does not exist or is not writable
+        logging.error(f"Cannot open the AIP index {db_path}: {e}")
+        sys.exit(1)
+    try:
+        if args.index_command == 'backfill':
+            start = time.monotonic()
+            aip_count, file_count = index.backfill(args.aip_storage, workers=args.workers)
+            logging.info(f"Indexed {file_count} files from {aip_count} AIPs into {db_path} in {time.monotonic() - start:.1f}s")
+        else:
+            start = time.monotonic()
+            results = index.query(
+                sha256=args.sha256,
+                path=args.path,
+                name=args.name,
+                file_format=args.format,
+                aip_uuid=args.aip,
+                limit=args.limit
+            )
+            for row in results:
+                print("\t".join(str(row[column]) for column in AIPIndex.QUERY_COLUMNS))
+            logging.info(f"{len(results)} result(s) in {(time.monotonic() - start) * 1000:.1f} ms")
+    finally:
+        index.close()
+
+def run_scan_cache_command(args):
+    cache = ScanCache(args.db, ProcessingConfiguration.SCAN_CACHE_MAX_ENTRIES)
+    try:
+        if args.scan_cache_command == 'clear':
+            cache.clear()
+            logging.info(f"Cleared scan cache {args.db}")
+        else:
+            print(json.dumps(cache.stats(), indent=2))
+    finally:
+        cache.close()
+
+def run_job_command(args):
+    client = JobClient(args.url)
+    try:
+        if args.job_command == 'submit':
+            job = client.submit(os.path.abspath(args.transfer))
+            if args.wait:
+                job = client.wait(job['id'])
+            result = job
+        elif args.job_command == 'status':
+            result = client.status(args.job_id) if args.job_id else client.list()
+        else:
+            result = client.cancel(args.job_id)
+    except (urllib.error.URLError, ConnectionError) as e:
+        logging.error(f"Cannot reach the job server at {args.url}: {getattr(e, 'reason', e)}")
+        sys.exit(1)
+    except RuntimeError as e:
+        # Error response from the server, e.g. an unknown job ID
+        logging.error(str(e))
+        sys.exit(1)
+    print(json.dumps(result, indent=2))
+
 def main():
     setup_logging()
     parser = argparse.ArgumentParser(description="Standalone Archivematica CLI")
     parser.add_argument('--transfer-path', help="Path to the transfer directory", default=Paths.TRANSFER_SOURCE)
     parser.add_argument('--aip-storage', help="Path to store AIPs", default=Paths.AIP_STORAGE)
     parser.add_argument('--dip-storage', help="Path to store DIPs", default=Paths.DIP_STORAGE)
+    parser.add_argument('--worker', action='store_true', help="Claim transfers from a queue shared with other worker processes")
+    parser.add_argument('--queue-db', help="Path to the shared queue database (default: <transfer-path>/.am-queue.sqlite)", default=Paths.QUEUE_DB)
+    parser.add_argument('--requeue', action='store_true', help="With --worker: queue finished transfers again even if they have not changed")
+    parser.add_argument('--worker-id', help="Name of this worker in the queue (default: <hostname>-<pid>)")
+    parser.add_argument('--profile', choices=PROFILES, default='default', help="Processing profile; 'deferred' stores the AIP of originals first and queues normalization")
+    parser.add_argument('--accrual', action='store_true', help="Only ingest files that are new or changed since the latest AIP of the same transfer directory")
+    parser.add_argument('--trace', help="Write a Chrome trace-event file of every step and tool invocation", default=Paths.TRACE_FILE)
+
+    subparsers = parser.add_subparsers(dest='command')
+    index_parser = subparsers.add_parser('index', help="Query or rebuild the cross-AIP file index")
+    index_subparsers = index_parser.add_subparsers(dest='index_command', required=True)
+    backfill_parser = index_subparsers.add_parser('backfill', help="Index every AIP in --aip-storage from its METS file")
+    backfill_parser.add_argument('--workers', type=int, help="Number of METS parser processes (default: CPU count)")
+    query_parser = index_subparsers.add_parser('query', help="Find files by checksum, path, name, format or AIP")
+    query_parser.add_argument('--sha256', help="SHA-256 checksum")
+    query_parser.add_argument('--path', help="Bag-relative path, e.g. data/content/objects/file1.txt")
+    query_parser.add_argument('--name', help="File name")
+    query_parser.add_argument('--format', help="MIME type")
+    query_parser.add_argument('--aip', help="AIP UUID")
+    query_parser.add_argument('--limit', type=int, default=100, help="Maximum number of results")
+
+    serve_parser = subparsers.add_parser('serve', help="Run a resident worker pool that accepts jobs over a local HTTP API")
+    serve_parser.add_argument('--host', default=ProcessingConfiguration.SERVER_HOST)
+    serve_parser.add_argument('--port', type=int, default=ProcessingConfiguration.SERVER_PORT)
+    serve_parser.add_argument('--workers', type=int, default=ProcessingConfiguration.SERVER_WORKERS, help="Number of transfers processed concurrently")
+
+    default_url = f"http://{ProcessingConfiguration.SERVER_HOST}:{ProcessingConfiguration.SERVER_PORT}"
+    job_parser = subparsers.add_parser('job', help="Submit, inspect or cancel jobs on a running server")
+    job_parser.add_argument('--url', default=default_url, help=f"Server URL (default: {default_url})")
+    job_subparsers = job_parser.add_subparsers(dest='job_command', required=True)
+    submit_parser = job_subparsers.add_parser('submit', help="Queue a transfer directory")
+    submit_parser.add_argument('transfer', help="Path to a single transfer directory")
+    submit_parser.add_argument('--wait', action='store_true', help="Wait for the job to finish")
+    status_parser = job_subparsers.add_parser('status', help="Show one job, or all jobs")
+    status_parser.add_argument('job_id', nargs='?')
+    cancel_parser = job_subparsers.add_parser('cancel', help="Cancel a queued or running job")
+    cancel_parser.add_argument('job_id')
+
+    reprocess_parser = subparsers.add_parser('reprocess', help="Rerun selected steps on a stored AIP and update it in place")
+    reprocess_parser.add_argument('aip', help="AIP directory, directory name in --aip-storage, or AIP UUID")
+    reprocess_parser.add_argument('--steps', default="normalize,dip", help=f"Comma-separated steps to run (choices: {', '.join(REPROCESS_STEPS)}; default: normalize,dip)")
+    reprocess_parser.add_argument('--force', action='store_true', help="Regenerate preservation copies that already exist")
+
+    deferred_parser = subparsers.add_parser('deferred', help="Normalize AIPs queued by the deferred profile, at low priority, and update them and their DIPs")
+    deferred_parser.add_argument('--poll', type=float, help="Keep waiting for new AIPs, checking the queue every POLL seconds")
+
+    complete_parser = subparsers.add_parser('complete', help="Copy the files listed in an AIP's fetch.txt into the bag")
+    complete_parser.add_argument('aip', help="AIP directory, directory name in --aip-storage, or AIP UUID")
+
+    scan_cache_parser = subparsers.add_parser('scan-cache', help="Show statistics for, or clear, the virus scan result cache")
+    scan_cache_parser.add_argument('--db', default=Paths.SCAN_CACHE, help=f"Cache database (default: {Paths.SCAN_CACHE})")
+    scan_cache_parser.add_argument('scan_cache_command', choices=['stats', 'clear'])
 
     args = parser.parse_args()
 
-    # Validate paths
+    if args.command == 'index':
+        run_index(args)
+        return
+    if args.command == 'job':
+        run_job_command(args)
+        return
+    if args.command == 'scan-cache':
+        run_scan_cache_command(args)
+        return
+    if args.command == 'complete':
+        complete_bag(find_aip(args.aip, args.aip_storage))
+        return
+
+    tracing.configure(args.trace)
+
+    if args.command == 'reprocess':
+        os.makedirs(args.dip_storage, exist_ok=True)
+        aip_dir = find_aip(args.aip, args.aip_storage)
+        steps = [name.strip() for name in args.steps.split(',') if name.strip()]
+        reprocess_aip(aip_dir, args.dip_storage, PROFILES[args.profile], steps, force=args.force)
+        return
+
+    if args.command == 'deferred':
+        os.makedirs(args.dip_storage, exist_ok=True)
+        run_deferred(args)
+        return
+
+    if args.command == 'serve':
+        os.makedirs(args.aip_storage, exist_ok=True)
+        os.makedirs(args.dip_storage, exist_ok=True)
+        serve(args.host, args.port, args.aip_storage, args.dip_storage, PROFILES[args.profile], args.workers)
+        return
+
     # Validate paths
     if not os.path.exists(args.transfer_path):
         logging.error(f"Transfer path does not exist: {args.transfer_path}")
         sys.exit(1)
-    
+
     # Create storage directories if they don't exist
     os.makedirs(args.aip_storage, exist_ok=True)
     os.makedirs(args.dip_storage, exist_ok=True)
 
-    # Iterate over subdirectories in transfer_path
-    transfer_items = os.listdir(args.transfer_path)
-    transfers_found = False
-
-    for item in transfer_items:
-        item_path = os.path.join(args.transfer_path, item)
-        
-        if os.path.isdir(item_path):
-            transfers_found = True
-            logging.info(f"Found transfer: {item}")
-            
-            engine = WorkflowEngine(
-                transfer_path=item_path,
-                aip_path=args.aip_storage,
-                dip_path=args.dip_storage,
-                config=ProcessingConfiguration
-            )
-            try:
-                engine.run()
-            except Exception as e:
-                logging.exception(f"Workflow failed for transfer {item}")
-                # We continue to the next transfer instead of exiting
-                continue
-
-    if not transfers_found:
-        logging.warning(f"No transfer directories found in {args.transfer_path}")
+    if args.worker:
+        run_worker(args)
+    else:
+        run_batch(args)
 
 if __name__ == "__main__":
     main()
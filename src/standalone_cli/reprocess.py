@@ -0,0 +1,118 @@
+import csv
+import glob
+import logging
+import os
+from .engine import WorkflowCancelled
+from .steps.process import NormalizeStep, ProcessContentStep
+from .steps.store import StoreDIPStep
+from .utils import tracing
+from .utils.aip_index import AIPIndex, index_path
+from .utils.bag import snapshot, read_bag_info, read_manifest, MANIFEST
+from .utils.mets import update_aip
+from .utils.fetch import fetch_files_from_bag
+
+logger = logging.getLogger(__name__)
+
+# Steps that can run against a stored AIP, in the order they are executed
+REPROCESS_STEPS = {
+    'normalize': NormalizeStep,
+    'examine': ProcessContentStep,
+    'dip': StoreDIPStep,
+}
+
+
+def find_aip(aip, aip_storage):
+    """Resolve an AIP given as a path, a directory name in aip_storage, or a UUID."""
+    if os.path.isdir(aip):
+        return os.path.abspath(aip)
+    candidate = os.path.join(aip_storage, aip)
+    if os.path.isdir(candidate):
+        return os.path.abspath(candidate)
+    matches = [path for path in glob.glob(os.path.join(aip_storage, f"*-{aip}")) if os.path.isdir(path)]
+    if len(matches) == 1:
+        return os.path.abspath(matches[0])
+    raise FileNotFoundError(f"AIP not found in {aip_storage}: {aip}")
+
+
+def load_formats(report_path):
+    """Recover identification results from a previous normalization report, so FIDO need not run again."""
+    formats = {}
+    if os.path.exists(report_path):
+        with open(report_path, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('puid') or row.get('mimetype'):
+                    formats[row['file']] = {'puid': row['puid'], 'mimetype': row['mimetype']}
+    return formats
+
+
+def reprocess_aip(aip_dir, dip_path, config, step_names, force=False, cancel_event=None):
+    """
+    Run selected steps against a stored AIP and update it in place.
+
+    Only files the steps create, change or delete are rehashed; the METS,
+    manifests and Payload-Oxum are updated incrementally from those.
+    If cancel_event is set, WorkflowCancelled is raised before the next step
+    or the next file a step writes, and before the METS and manifests are
+    touched. Payload files that are not in the manifest yet, e.g. derivatives
+    written by an earlier run that was cancelled, are picked up as new.
+    """
+    unknown = [name for name in step_names if name not in REPROCESS_STEPS]
+    if unknown:
+        raise ValueError(f"Unknown step(s): {', '.join(unknown)}. Choose from {', '.join(REPROCESS_STEPS)}")
+
+    aip_dir = os.path.abspath(aip_dir)
+    data_dir = os.path.join(aip_dir, 'data')
+    mets_files = glob.glob(os.path.join(data_dir, "METS.*.xml"))
+    if not mets_files:
+        raise FileNotFoundError(f"No METS file in {data_dir}; is {aip_dir} an AIP?")
+    mets_path = mets_files[0]
+
+    info = read_bag_info(aip_dir)
+    sip_uuid = info.get('External-Identifier') or os.path.basename(mets_path)[len("METS."):-len(".xml")]
+    aip_name = os.path.basename(aip_dir)
+    sip_name = aip_name[:-len(sip_uuid) - 1] if aip_name.endswith(f"-{sip_uuid}") else aip_name
+
+    context = {
+        'sip_path': aip_dir,
+        'aip_path': os.path.dirname(aip_dir),
+        'dip_path': dip_path,
+        'config': config,
+        'cancel_event': cancel_event,
+        'sip_uuid': sip_uuid,
+        'sip_name': sip_name,
+        'normalize_force': force,
+        'fetch_files': fetch_files_from_bag(aip_dir, "data/content/objects/"),
+        'formats': load_formats(os.path.join(data_dir, 'content', 'logs', 'normalization.csv')),
+    }
+
+    logger.info(f"Reprocessing AIP {aip_name} with steps: {', '.join(step_names)}")
+    manifest = read_manifest(os.path.join(aip_dir, MANIFEST))
+    before = {path: state for path, state in snapshot(aip_dir).items() if path in manifest}
+
+    def check_cancelled(before):
+        if cancel_event is not None and cancel_event.is_set():
+            logger.warning(f"Reprocessing of {aip_name} cancelled before {before}")
+            raise WorkflowCancelled(before)
+
+    for name, step_class in REPROCESS_STEPS.items():
+        if name in step_names:
+            check_cancelled(step_class.__name__)
+            with tracing.span(step_class.__name__, transfer=sip_name):
+                step_class(context).execute()
+    check_cancelled("updating the METS and manifests")
+
+    changed, removed, touched = update_aip(aip_dir, before)
+    if not changed and not removed:
+        logger.info("No payload files changed; AIP left untouched.")
+        return changed, removed
+    logger.info(f"Updated {touched} METS file entries.")
+    logger.info(f"Updated bag manifests: {len(changed)} file(s) rehashed, {len(removed)} removed.")
+
+    if config.UPDATE_AIP_INDEX:
+        index = AIPIndex(index_path(context['aip_path']))
+        try:
+            index.add_aip_from_mets(aip_dir)
+        finally:
+            index.close()
+
+    return changed, removed
@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .engine import WorkflowEngine, WorkflowCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class JobManager:
+    """
+    Runs transfers on a resident pool of worker threads.
+
+    The process (and with it lxml, the configuration, the compiled
+    normalization rules, ...) stays warm between jobs, so small transfers do
+    not pay interpreter start-up and import costs every time. External tools
+    are still started per job: FIDO loads its format signatures each time,
+    and ClamAV only keeps its signatures loaded when run through clamdscan.
+
+    Finished jobs are kept for config.SERVER_JOB_TTL_SECONDS, and at most
+    config.SERVER_MAX_FINISHED_JOBS of them, so a long-lived server does not
+    grow without limit.
+    """
+
+    def __init__(self, aip_path, dip_path, config, workers):
+        self.aip_path = aip_path
+        self.dip_path = dip_path
+        self.config = config
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="am-worker")
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self):
+        # Called with self._lock held
+        now = time.time()
+        finished = sorted(
+            (job["finished_at"], job_id) for job_id, job in self.jobs.items() if job["finished_at"] is not None
+        )
+        excess = len(finished) - self.config.SERVER_MAX_FINISHED_JOBS
+        for index, (finished_at, job_id) in enumerate(finished):
+            if index < excess or now - finished_at > self.config.SERVER_JOB_TTL_SECONDS:
+                del self.jobs[job_id]
+
+    def submit(self, transfer_path):
+        if not os.path.isdir(transfer_path):
+            raise ValueError(f"Transfer path is not a directory: {transfer_path}")
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "transfer_path": os.path.abspath(transfer_path),
+            "state": "queued",
+            "error": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        with self._lock:
+            self._prune()
+            self.jobs[job_id] = job
+            job["_cancel"] = threading.Event()
+            job["_future"] = self.executor.submit(self._run, job)
+        logger.info(f"Job {job_id} queued for {transfer_path}")
+        return self._public(job)
+
+    def _run(self, job):
+        with self._lock:
+            if job["_cancel"].is_set():
+                return
+            job["state"] = "running"
+            job["started_at"] = time.time()
+
+        logger.info(f"Job {job['id']} started")
+        try:
+            engine = WorkflowEngine(
+                transfer_path=job["transfer_path"],
+                aip_path=self.aip_path,
+                dip_path=self.dip_path,
+                config=self.config,
+                cancel_event=job["_cancel"]
+            )
+            engine.run()
+            state, error = "done", None
+        except WorkflowCancelled:
+            state, error = "cancelled", None
+        except Exception as e:
+            logger.exception(f"Job {job['id']} failed")
+            state, error = "failed", str(e)
+
+        with self._lock:
+            job["state"] = state
+            job["error"] = error
+            job["finished_at"] = time.time()
+        logger.info(f"Job {job['id']} {state}")
+
+    def status(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def list(self):
+        with self._lock:
+            self._prune()
+            return [self._public(job) for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs never start; running jobs stop before
+        their next step. Returns the job, or None if it does not exist.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job["state"] in ("queued", "running"):
+                job["_cancel"].set()
+                if job["state"] == "queued":
+                    job["_future"].cancel()
+                    job["state"] = "cancelled"
+                    job["finished_at"] = time.time()
+            return self._public(job)
+
+    def shutdown(self):
+        """Cancel queued jobs and wait for running ones to finish."""
+        with self._lock:
+            for job in self.jobs.values():
+                if job["state"] == "queued":
+                    job["_cancel"].set()
+                    job["_future"].cancel()
+                    job["state"] = "cancelled"
+                    job["finished_at"] = time.time()
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def _public(job):
+        return {key: value for key, value in job.items() if not key.startswith("_")}
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON job API:
+
+        POST   /jobs          {"transfer_path": "..."}  -> 202 job
+        GET    /jobs                                    -> 200 [job, ...]
+        GET    /jobs/<id>                               -> 200 job
+        DELETE /jobs/<id>                               -> 200 job (cancelled)
+    """
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            job = self.server.jobs.submit(body["transfer_path"])
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {"error": str(e)})
+        self._send(202, job)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/jobs":
+            return self._send(200, self.server.jobs.list())
+        job = self.server.jobs.status(self._job_id())
+        if job is None:
+            return self._send(404, {"error": "no such job"})
+        self._send(200, job)
+
+    def do_DELETE(self):
+        job = self.server.jobs.cancel(self._job_id())
+        if job is None:
+            return self._send(404, {"error": "no such job"})
+        self._send(200, job)
+
+    def _job_id(self):
+        prefix = "/jobs/"
+        return self.path[len(prefix):].strip("/") if self.path.startswith(prefix) else None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class JobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs):
+        super().__init__(address, JobRequestHandler)
+        self.jobs = jobs
+
+
+def serve(host, port, aip_path, dip_path, config, workers):
+    jobs = JobManager(aip_path, dip_path, config, workers)
+    server = JobServer((host, port), jobs)
+    logger.info(f"Serving job API on http://{host}:{server.server_port} with {workers} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    finally:
+        server.server_close()
+        jobs.shutdown()
+
+
+class JobClient:
+    """Minimal client for the job API."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def submit(self, transfer_path):
+        return self._request("POST", "/jobs", {"transfer_path": transfer_path})
+
+    def status(self, job_id):
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def list(self):
+        return self._request("GET", "/jobs")
+
+    def cancel(self, job_id):
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def wait(self, job_id, interval=1.0):
+        """Poll until the job has finished and return its final status."""
+        while True:
+            job = self.status(job_id)
+            if job["state"] not in ("queued", "running"):
+                return job
+            time.sleep(interval)
+
+    def _request(self, method, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            body = e.read().decode('utf-8', 'replace')
+            try:
+                message = json.loads(body)["error"]
+            except (ValueError, KeyError, TypeError):
+                # Not one of our error responses; keep it to one line
+                message = " ".join(body.split())
+            raise RuntimeError(f"{method} {path} failed ({e.code}): {message}") from e
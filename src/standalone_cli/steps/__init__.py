@@ -1,5 +1,8 @@
 import abc
 
+class WorkflowCancelled(Exception):
+    """Raised when the run's cancel event has been set: between steps, or before a step writes a file."""
+
 class Step(abc.ABC):
     def __init__(self, context):
         self.context = context
@@ -8,3 +11,9 @@ class Step(abc.ABC):
     def execute(self):
         """Execute the step logic."""
         pass
+
+    def check_cancelled(self, before):
+        """Raise WorkflowCancelled if context['cancel_event'] is set, e.g. because a queue lease was lost."""
+        cancel_event = self.context.get('cancel_event')
+        if cancel_event is not None and cancel_event.is_set():
+            raise WorkflowCancelled(before)
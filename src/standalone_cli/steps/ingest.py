@@ -1,46 +1,168 @@
 import os
+import csv
 import uuid
+import tempfile
 import subprocess
 import logging
 from . import Step
 from ..config import Paths
+from ..utils import tracing
+from ..utils.bag import hash_file
+from ..utils.fetch import fetch_checksum
+from ..utils.scan_cache import ScanCache, signature_version
+from ..utils.sharding import shard_map
 
 logger = logging.getLogger(__name__)
 
+class ClamAVNotFound(Exception):
+    """Paths.CLAMSCAN_CMD could not be started."""
+
 class ScanVirusStep(Step):
     def execute(self):
         logger.info("Scanning for viruses...")
+        files = self._list_files()
         try:
-            # Recursive scan, suppress summary, only print infected files
-            cmd = [Paths.CLAMSCAN_CMD, "-r", self.context['sip_path']]
-            logger.info(f"Running: {' '.join(cmd)}")
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            logger.info("Virus scan passed.")
-            
-            # Save virus scan log
-            log_path = os.path.join(self.context['sip_path'], 'virus_scan.log')
-            with open(log_path, 'w') as f:
-                f.write(result.stdout)
-                
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Virus scan failed or found viruses: {e.stderr}")
-            
-            # Save virus scan log even on failure
-            log_path = os.path.join(self.context['sip_path'], 'virus_scan.log')
-            with open(log_path, 'w') as f:
-                f.write(e.stdout) # clamscan writes to stdout even on virus found
-                if e.stderr:
-                    f.write("\nErrors:\n")
-                    f.write(e.stderr)
-
-            # Clamscan returns 1 if viruses are found
-            if e.returncode == 1:
-                logger.warning("Viruses found! (Continuing for now, but should quarantine)")
-            else:
-                raise
-        except FileNotFoundError:
+            db_version = None
+            cache = None
+            if self.context['config'].SCAN_CACHE:
+                db_version = self._signature_version()
+                if db_version:
+                    cache = ScanCache(Paths.SCAN_CACHE, self.context['config'].SCAN_CACHE_MAX_ENTRIES)
+                else:
+                    logger.warning("Could not determine the ClamAV signature version; scanning without the cache.")
+
+            try:
+                self._scan(files, cache, db_version)
+            finally:
+                if cache is not None:
+                    cache.close()
+        except ClamAVNotFound:
             logger.warning("ClamAV not found. Skipping virus scan.")
 
+    def _list_files(self):
+        # (absolute path, path shown in virus_scan.log, fetch entry or None), in sorted walk order
+        files = []
+        for root, dirs, names in os.walk(self.context['sip_path']):
+            dirs.sort()
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                files.append((file_path, os.path.relpath(file_path, self.context['sip_path']).replace('\\', '/'), None))
+        # Files left in place for fetch.txt are scanned where they are
+        for entry in self.context.get('fetch_files', []):
+            files.append((entry['source'], entry['rel_path'], entry))
+        return files
+
+    def _signature_version(self):
+        result = self._run_clamav([Paths.CLAMSCAN_CMD, "--version"], capture_output=True, text=True)
+        return signature_version(result.stdout)
+
+    def _run_clamav(self, cmd, **kwargs):
+        # Only a missing scanner skips the scan; any other missing file fails the step
+        try:
+            return tracing.run(cmd, **kwargs)
+        except FileNotFoundError as e:
+            raise ClamAVNotFound(cmd[0]) from e
+
+    def _scan(self, files, cache, db_version):
+        config = self.context['config']
+        checksums = {}
+        cached = {}
+        if cache is not None:
+            for shard in shard_map(self._hash_files, files, config, key=lambda item: item[0], name="HashFiles"):
+                checksums.update(shard)
+            cached = cache.lookup(list(checksums.values()), db_version)
+
+        to_scan = [file_path for file_path, _, _ in files if checksums.get(file_path) not in cached]
+        logger.info(f"{len(files)} files, {len(files) - len(to_scan)} with cached results, {len(to_scan)} to scan.")
+
+        statuses = {}
+        stderr = ""
+        returncode = 0
+        workers = None if self._uses_clamd() else config.SCAN_SHARD_WORKERS
+        for shard_statuses, shard_stderr, shard_returncode in shard_map(self._run_clamscan, to_scan, config, name="ScanShard", workers=workers):
+            statuses.update(shard_statuses)
+            stderr += shard_stderr
+            # 1 (virus found) from one shard must not hide 2 (error) from another
+            returncode = max(returncode, shard_returncode)
+
+        scanned = {
+            checksums[file_path]: (None if status == "OK" else status[:-len(" FOUND")])
+            for file_path, status in statuses.items()
+            if file_path in checksums and (status == "OK" or status.endswith(" FOUND"))
+        }
+        if cache is not None and scanned:
+            cache.record(scanned, db_version)
+
+        infected = self._write_log(files, checksums, cached, statuses, db_version, stderr)
+
+        if returncode not in (0, 1):
+            logger.error(f"Virus scan failed: {stderr}")
+            raise subprocess.CalledProcessError(returncode, Paths.CLAMSCAN_CMD, stderr=stderr)
+        if infected:
+            logger.warning(f"Viruses found in {infected} files! (Continuing for now, but should quarantine)")
+        else:
+            logger.info("Virus scan passed.")
+
+    def _hash_files(self, files):
+        return {
+            file_path: fetch_checksum(entry) if entry else hash_file(file_path, "sha256")
+            for file_path, _, entry in files
+        }
+
+    def _uses_clamd(self):
+        return os.path.basename(Paths.CLAMSCAN_CMD).startswith("clamdscan")
+
+    def _run_clamscan(self, paths):
+        fd, list_path = tempfile.mkstemp(prefix='clamscan-files-', suffix='.txt', dir=os.path.dirname(self.context['sip_path']))
+        with os.fdopen(fd, 'w') as f:
+            f.write("".join(f"{file_path}\n" for file_path in paths))
+        cmd = [Paths.CLAMSCAN_CMD, f"--file-list={list_path}"]
+        if self._uses_clamd():
+            # Let clamd read the files through our descriptors
+            cmd.insert(1, "--fdpass")
+        logger.info(f"Running: {' '.join(cmd)}")
+        try:
+            result = self._run_clamav(cmd, path=self.context['sip_path'], capture_output=True, text=True)
+        finally:
+            os.remove(list_path)
+        return self._parse_clamscan_output(result.stdout, set(paths)), result.stderr, result.returncode
+
+    def _parse_clamscan_output(self, output, paths):
+        # One "<path>: OK", "<path>: <signature> FOUND" or "<path>: <message> ERROR" line per file,
+        # followed by the scan summary
+        statuses = {}
+        for line in output.splitlines():
+            file_path, _, status = line.rpartition(": ")
+            if file_path in paths:
+                statuses[file_path] = status
+        return statuses
+
+    def _write_log(self, files, checksums, cached, statuses, db_version, stderr):
+        # One line per file in walk order, whether the result came from clamscan or the cache
+        infected = 0
+        log_path = os.path.join(self.context['sip_path'], 'virus_scan.log')
+        with open(log_path, 'w') as f:
+            for file_path, rel_path, _ in files:
+                checksum = checksums.get(file_path)
+                if checksum in cached:
+                    signature = cached[checksum]
+                    status = f"{signature} FOUND (cached)" if signature else "OK (cached)"
+                else:
+                    status = statuses.get(file_path, "not scanned")
+                if "FOUND" in status:
+                    infected += 1
+                f.write(f"{rel_path}: {status}\n")
+
+            f.write("\n----------- SCAN SUMMARY -----------\n")
+            f.write(f"Signature database: {db_version or 'unknown'}\n")
+            f.write(f"Scanned files: {len(files)}\n")
+            f.write(f"Cached results: {sum(1 for file_path, _, _ in files if checksums.get(file_path) in cached)}\n")
+            f.write(f"Infected files: {infected}\n")
+            if stderr:
+                f.write("\nErrors:\n")
+                f.write(stderr)
+        return infected
+
 class AssignUUIDStep(Step):
     def execute(self):
         logger.info("Assigning UUIDs to directories...")
@@ -67,7 +189,7 @@ class StructureReportStep(Step):
                  cmd = ['cmd', '/c', 'tree', '/F', '/A', self.context['sip_path']]
             
             with open(report_path, 'w') as f:
-                subprocess.run(cmd, stdout=f, check=True)
+                tracing.run(cmd, path=self.context['sip_path'], stdout=f, check=True)
             logger.info(f"Structure report generated at {report_path}")
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             logger.warning(f"Failed to generate structure report: {e}")
@@ -76,18 +198,53 @@ class IdentifyFormatStep(Step):
     def execute(self):
         logger.info("Identifying file formats...")
         try:
-            # FIDO usage: fido -r <dir>
-            cmd = [Paths.FIDO_CMD, "-r", self.context['sip_path']]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            # FIDO reads the files to identify from a list (fido -input <file>), one list per shard
+            paths = []
+            for root, dirs, files in os.walk(self.context['sip_path']):
+                dirs.sort()
+                paths += [os.path.join(root, file) for file in sorted(files)]
+            paths += [entry['source'] for entry in self.context.get('fetch_files', [])]
+            output = "".join(shard_map(self._run_fido, paths, self.context['config'], name="IdentifyShard"))
             
             # Save FIDO output to a file
             fido_log = os.path.join(self.context['sip_path'], 'fido.xml') # FIDO default is CSV-like, but let's just save stdout
             with open(fido_log, 'w') as f:
-                f.write(result.stdout)
-            logger.info("File formats identified.")
+                f.write(output)
+
+            # Keep the identification results for NormalizeStep, keyed by path relative to the transfer
+            self.context['formats'] = self._parse_fido_output(output)
+            logger.info(f"File formats identified ({len(self.context['formats'])} files).")
         except (subprocess.CalledProcessError, FileNotFoundError) as e:
             logger.warning(f"Failed to identify formats (FIDO missing?): {e}")
 
+    def _run_fido(self, paths):
+        fd, list_path = tempfile.mkstemp(prefix='fido-files-', suffix='.txt', dir=os.path.dirname(self.context['sip_path']))
+        with os.fdopen(fd, 'w') as f:
+            f.write("".join(f"{path}\n" for path in paths))
+        try:
+            cmd = [Paths.FIDO_CMD, "-input", list_path]
+            result = tracing.run(cmd, path=self.context['sip_path'], capture_output=True, text=True, check=True)
+        finally:
+            os.remove(list_path)
+        return result.stdout
+
+    def _parse_fido_output(self, output):
+        # FIDO's default output is one CSV line per match:
+        # OK,<ms>,<puid>,"<format name>","<signature name>",<size>,"<filename>","<mimetype>","<match type>"
+        formats = {}
+        fetched = {entry['source']: entry['rel_path'] for entry in self.context.get('fetch_files', [])}
+        for row in csv.reader(output.splitlines()):
+            if len(row) < 8 or row[0] != 'OK':
+                continue
+            rel_path = fetched.get(row[6]) or os.path.relpath(row[6], self.context['sip_path']).replace('\\', '/')
+            # FIDO may report several matches for a file; keep the first
+            formats.setdefault(rel_path, {
+                'puid': row[2],
+                'format_name': row[3],
+                'mimetype': row[7],
+            })
+        return formats
+
 class ExtractPackageStep(Step):
     def execute(self):
         logger.info("Extracting packages...")
@@ -96,15 +253,15 @@ class ExtractPackageStep(Step):
             for file in files:
                 if file.lower().endswith(('.zip', '.tar', '.gz', '.7z', '.rar')):
                     archive_path = os.path.join(root, file)
-                    logger.info(f"Extracting {archive_path}...")
+                    logger.info(f"Extracting {archive_path}...", extra={'progress': 'extracted'})
                     try:
                         # 7z x <archive> -o<outdir>
                         out_dir = os.path.join(root, os.path.splitext(file)[0])
                         cmd = [Paths.SEVEN_ZIP_CMD, "x", archive_path, f"-o{out_dir}", "-y"]
-                        subprocess.run(cmd, check=True, capture_output=True)
+                        tracing.run(cmd, path=archive_path, check=True, capture_output=True)
                         
                         if self.context['config'].DELETE_PACKAGE_AFTER_EXTRACTION:
                             os.remove(archive_path)
-                            logger.info(f"Deleted original archive: {file}")
+                            logger.info(f"Deleted original archive: {file}", extra={'progress': 'archives deleted'})
                     except (subprocess.CalledProcessError, FileNotFoundError) as e:
                         logger.warning(f"Failed to extract {file}: {e}")
@@ -1,13 +1,21 @@
 import logging
 import os
-import subprocess
 import shutil
 import hashlib
 import csv
+import uuid
 import datetime
+from lxml import etree
 from . import Step
 from ..config import Paths
-from ..utils.mets import METSGenerator
+from ..utils.mets import METSGenerator, update_aip
+from ..utils.bag import snapshot
+from ..utils.fs import sorted_walk
+from ..utils import tracing
+from ..utils.fetch import fetch_checksum, fetch_url, write_fetch_txt
+from ..utils.sharding import shard_map
+from ..utils.accrual import write_accrual, accrual_sequence
+from ..utils.normalization_rules import DEFAULT_RULES, PRESERVE_TIFF, PRESERVE_MKV, ACCESS_THUMBNAIL
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +27,12 @@ class CreateSIPStep(Step):
         
         sip_root = self.context['sip_path']
         sip_uuid = self.context.get('sip_uuid', 'no-uuid')
+        # Name of the transfer directory; identifies the source across accruals
+        source_name = os.path.basename(sip_root)
+        # Transfer files left in place; they are listed in fetch.txt instead of copied
+        fetch_files = self.context.get('fetch_files', [])
+        # Accrual mode: plan from utils.accrual.plan_accrual; only new and changed files are in the bag
+        accrual = self.context.get('accrual')
         
         # BagIt Structure:
         # <base>/
@@ -78,23 +92,24 @@ class CreateSIPStep(Step):
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
             
-            # Add entries for objects
-            for root, dirs, files in os.walk(objects_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    rel_path = os.path.relpath(file_path, content_dir).replace('\\', '/')
-                    # content_dir is data/content, objects are in data/content/objects
-                    # so rel_path starts with objects/
-                    
-                    writer.writerow({
-                        'filename': rel_path,
-                        'dc.title': file,
-                        'dc.creator': 'Unknown',
-                        'dc.description': f'Imported file {file}',
-                        'dc.date': datetime.date.today().isoformat(),
-                        'dc.format': os.path.splitext(file)[1][1:].upper(),
-                        'dc.identifier': hashlib.md5(file_path.encode()).hexdigest()
-                    })
+            # Add entries for objects, including those left in place for fetch.txt
+            object_paths = [os.path.join(root, file) for root, dirs, files in sorted_walk(objects_dir) for file in files]
+            object_paths += [self._fetch_target(objects_dir, entry) for entry in fetch_files]
+            for file_path in object_paths:
+                file = os.path.basename(file_path)
+                rel_path = os.path.relpath(file_path, content_dir).replace('\\', '/')
+                # content_dir is data/content, objects are in data/content/objects
+                # so rel_path starts with objects/
+                
+                writer.writerow({
+                    'filename': rel_path,
+                    'dc.title': file,
+                    'dc.creator': 'Unknown',
+                    'dc.description': f'Imported file {file}',
+                    'dc.date': datetime.date.today().isoformat(),
+                    'dc.format': os.path.splitext(file)[1][1:].upper(),
+                    'dc.identifier': hashlib.md5(file_path.encode()).hexdigest()
+                })
 
         # 2. dublin_core.xml
         dc_path = os.path.join(metadata_dir, 'dublin_core.xml')
@@ -172,18 +187,41 @@ class CreateSIPStep(Step):
         with open(os.path.join(sub_doc_dir, 'rights.csv'), 'w') as f:
              f.write('file,basis,status,country,jurisdiction,start_date,end_date,note\n')
 
+        # Checksums of the objects, computed once (in shards for large transfers) for the METS and the manifests
+        checksums = self._hash_objects(objects_dir, fetch_files)
+
+        if accrual:
+            self._write_accrual(accrual, objects_dir, checksums, sip_root, sip_uuid)
+
         # --- Generate METS.xml ---
         try:
             mets_gen = METSGenerator(sip_uuid, data_dir) # Use data_dir as base for relative paths in METS
             
             # Add Original Objects
             original_files = []
-            for root, dirs, files in os.walk(objects_dir):
+            for root, dirs, files in sorted_walk(objects_dir):
                 for file in files:
                     file_path = os.path.join(root, file)
                     file_uuid = hashlib.md5(file_path.encode()).hexdigest()
-                    original_files.append((file_path, file_uuid))
+                    original_files.append((file_path, file_uuid, os.path.getsize(file_path), checksums[file_path]))
+            unmanaged = []
+            for entry in fetch_files:
+                file_path = self._fetch_target(objects_dir, entry)
+                file_uuid = hashlib.md5(file_path.encode()).hexdigest()
+                original_files.append((file_path, file_uuid, entry['size'], checksums[file_path]))
+                if entry.get('outside_prefixes'):
+                    unmanaged.append((file_uuid, entry))
             mets_gen.add_file_group("original", "grp-originals", original_files)
+            for file_uuid, entry in unmanaged:
+                self._add_fetch_location_event(mets_gen, file_uuid, entry)
+
+            if accrual and accrual['parent']:
+                # A delta AIP: the unchanged files are held by the parent (and its ancestors)
+                dc = etree.Element(f"{{{METSGenerator.NS_DCTERMS}}}dublincore", nsmap={'dcterms': METSGenerator.NS_DCTERMS})
+                etree.SubElement(dc, f"{{{METSGenerator.NS_DCTERMS}}}isVersionOf").text = f"urn:uuid:{accrual['parent']['uuid']}"
+                etree.SubElement(dc, f"{{{METSGenerator.NS_DCTERMS}}}source").text = source_name
+                mets_gen.add_dmd_sec("dmdSec_accrual", "DC", dc)
+                mets_gen.div_root.set("DMDID", "dmdSec_accrual")
             
         
             
@@ -216,8 +254,8 @@ class CreateSIPStep(Step):
             f.write("BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n")
 
         # bag-info.txt - Standard Archivematica Fields
-        oxum = self._calculate_oxum(data_dir)
-        bag_size = self._calculate_bag_size(data_dir)
+        oxum = self._calculate_oxum(data_dir, fetch_files)
+        bag_size = self._calculate_bag_size(data_dir, fetch_files)
         with open(os.path.join(sip_root, "bag-info.txt"), 'w') as f:
             f.write(f"Source-Organization: Archivematica Standalone\n")
             f.write(f"Organization-Address: 123 Archive Way\n")
@@ -228,24 +266,85 @@ class CreateSIPStep(Step):
             f.write(f"Payload-Oxum: {oxum}\n")
             f.write(f"Bag-Size: {bag_size}\n")
             f.write(f"Bag-Group-Identifier: {sip_uuid}\n") # Often same as UUID or Transfer name
+            f.write(f"Internal-Sender-Identifier: {source_name}\n")
+            if accrual:
+                # Read by find_parent_aip and the AIP index to order a source's AIPs
+                f.write(f"Accrual-Sequence: {accrual_sequence(accrual)}\n")
+            if accrual and accrual['parent']:
+                f.write(f"Accrual-Parent-Identifier: {accrual['parent']['uuid']}\n")
 
         # manifest-sha256.txt
-        self._create_manifest(data_dir, os.path.join(sip_root, "manifest-sha256.txt"), "sha256")
+        self._create_manifest(data_dir, os.path.join(sip_root, "manifest-sha256.txt"), "sha256", fetch_files, checksums)
+
+        # fetch.txt (holey bag)
+        if fetch_files:
+            write_fetch_txt(sip_root, fetch_files, "data/content/objects/")
+            logger.info(f"Listed {len(fetch_files)} file(s) in fetch.txt")
 
         # tagmanifest-sha256.txt
         self._create_tagmanifest(sip_root, os.path.join(sip_root, "tagmanifest-sha256.txt"), "sha256")
         
         # manifests/manifest.json
-        self._create_manifest_json(data_dir, os.path.join(manifests_dir, "manifests.json"))
+        self._create_manifest_json(data_dir, os.path.join(manifests_dir, "manifests.json"), fetch_files, checksums)
         
         # manifests/checksums.sha256 (Copy of manifest-sha256.txt)
         shutil.copy2(os.path.join(sip_root, "manifest-sha256.txt"), os.path.join(manifests_dir, "checksums.sha256"))
         
+        # Files written by later steps (derivatives, normalization report) are added by UpdateBagStep
+        self.context['bag_snapshot'] = snapshot(sip_root)
         logger.info("BagIt SIP structure created.")
 
-    def _calculate_bag_size(self, data_dir):
-        total_bytes = 0
-        for root, dirs, files in os.walk(data_dir):
+    def _add_fetch_location_event(self, mets_gen, file_uuid, entry):
+        # A PREMIS event on the file, so the METS shows that its fetch.txt location is outside FETCH_PATH_PREFIXES
+        ns = METSGenerator.NS_PREMIS
+        event = etree.Element(f"{{{ns}}}event")
+        identifier = etree.SubElement(event, f"{{{ns}}}eventIdentifier")
+        etree.SubElement(identifier, f"{{{ns}}}eventIdentifierType").text = "UUID"
+        etree.SubElement(identifier, f"{{{ns}}}eventIdentifierValue").text = str(uuid.uuid4())
+        etree.SubElement(event, f"{{{ns}}}eventType").text = "fetch reference"
+        etree.SubElement(event, f"{{{ns}}}eventDateTime").text = datetime.datetime.now().isoformat()
+        detail = etree.SubElement(event, f"{{{ns}}}eventDetailInformation")
+        etree.SubElement(detail, f"{{{ns}}}eventDetail").text = (
+            f"Left in place at {fetch_url(entry)} because of FETCH_SIZE_THRESHOLD; "
+            "the location is outside FETCH_PATH_PREFIXES and may be cleared with the transfer area"
+        )
+        outcome = etree.SubElement(event, f"{{{ns}}}eventOutcomeInformation")
+        etree.SubElement(outcome, f"{{{ns}}}eventOutcome").text = "warning"
+
+        amd_id = f"amdSec_fetch_{file_uuid}"
+        mets_gen.add_amd_sec(amd_id, digiprov_md_element=event)
+        mets_gen.file_sec.find(f".//{{{METSGenerator.NS_METS}}}file[@ID='file-{file_uuid}']").set("ADMID", amd_id)
+
+    def _write_accrual(self, accrual, objects_dir, checksums, sip_root, sip_uuid):
+        # Fill in checksums of the new and changed files, reusing the object checksums where the file is unchanged by extraction
+        for rel_path in accrual['added'] + accrual['changed']:
+            record = accrual['files'][rel_path]
+            if record['sha256'] is None:
+                record['sha256'] = (
+                    checksums.get(os.path.join(objects_dir, *rel_path.split('/')))
+                    or self._hash_file(record['transfer_path'], "sha256")
+                )
+        path = write_accrual(sip_root, accrual, sip_uuid)
+        logger.info(f"Accrual record written to {path}")
+
+    def _hash_objects(self, objects_dir, fetch_files):
+        # {file path: sha256} for every object; files left in place are keyed by where they belong in the bag
+        paths = [os.path.join(root, file) for root, dirs, files in sorted_walk(objects_dir) for file in files]
+        checksums = {}
+        for shard in shard_map(lambda shard: {path: self._hash_file(path, "sha256") for path in shard}, paths, self.context['config'], name="HashShard"):
+            checksums.update(shard)
+        hash_fetched = lambda shard: {self._fetch_target(objects_dir, entry): fetch_checksum(entry) for entry in shard}
+        for shard in shard_map(hash_fetched, fetch_files, self.context['config'], key=lambda entry: entry['source'], name="HashShard"):
+            checksums.update(shard)
+        return checksums
+
+    def _fetch_target(self, objects_dir, entry):
+        # Where a file listed in fetch.txt belongs in the bag
+        return os.path.join(objects_dir, *entry['rel_path'].split('/'))
+
+    def _calculate_bag_size(self, data_dir, fetch_files=()):
+        total_bytes = sum(entry['size'] for entry in fetch_files)
+        for root, dirs, files in sorted_walk(data_dir):
             for file in files:
                 total_bytes += os.path.getsize(os.path.join(root, file))
         
@@ -256,18 +355,20 @@ class CreateSIPStep(Step):
             total_bytes /= 1024
         return f"{total_bytes:.2f} TB"
 
-    def _calculate_oxum(self, data_dir):
-        total_bytes = 0
-        file_count = 0
-        for root, dirs, files in os.walk(data_dir):
+    def _calculate_oxum(self, data_dir, fetch_files=()):
+        total_bytes = sum(entry['size'] for entry in fetch_files)
+        file_count = len(fetch_files)
+        for root, dirs, files in sorted_walk(data_dir):
             for file in files:
                 total_bytes += os.path.getsize(os.path.join(root, file))
                 file_count += 1
         return f"{total_bytes}.{file_count}"
 
-    def _create_manifest(self, data_dir, manifest_path, algo):
+    def _create_manifest(self, data_dir, manifest_path, algo, fetch_files=(), checksums=None):
+        # checksums holds precomputed sha256 values
+        checksums = checksums if algo == "sha256" else {}
         with open(manifest_path, 'w') as f:
-            for root, dirs, files in os.walk(data_dir):
+            for root, dirs, files in sorted_walk(data_dir):
                 for file in files:
                     file_path = os.path.join(root, file)
                     # Rel path from bag root (which is parent of data_dir)
@@ -279,8 +380,10 @@ class CreateSIPStep(Step):
                     sip_root = os.path.dirname(data_dir)
                     rel_path = os.path.relpath(file_path, sip_root).replace('\\', '/')
                     
-                    hash_val = self._hash_file(file_path, algo)
+                    hash_val = (checksums or {}).get(file_path) or self._hash_file(file_path, algo)
                     f.write(f"{hash_val}  {rel_path}\n")
+            for entry in fetch_files:
+                f.write(f"{fetch_checksum(entry)}  data/content/objects/{entry['rel_path']}\n")
 
     def _create_tagmanifest(self, sip_root, tagmanifest_path, algo):
         with open(tagmanifest_path, 'w') as f:
@@ -299,10 +402,10 @@ class CreateSIPStep(Step):
                 h.update(chunk)
         return h.hexdigest()
 
-    def _create_manifest_json(self, data_dir, manifest_path):
+    def _create_manifest_json(self, data_dir, manifest_path, fetch_files=(), checksums=None):
         import json
         manifest_data = []
-        for root, dirs, files in os.walk(data_dir):
+        for root, dirs, files in sorted_walk(data_dir):
             for file in files:
                  file_path = os.path.join(root, file)
                  sip_root = os.path.dirname(data_dir)
@@ -311,61 +414,196 @@ class CreateSIPStep(Step):
                  manifest_data.append({
                      "file": rel_path,
                      "size": os.path.getsize(file_path),
-                     "sha256": self._hash_file(file_path, "sha256")
+                     "sha256": (checksums or {}).get(file_path) or self._hash_file(file_path, "sha256")
                  })
+        for entry in fetch_files:
+            manifest_data.append({
+                "file": f"data/content/objects/{entry['rel_path']}",
+                "size": entry['size'],
+                "sha256": fetch_checksum(entry)
+            })
         
         with open(manifest_path, 'w') as f:
             json.dump(manifest_data, f, indent=4)
 
 class NormalizeStep(Step):
+    # Preservation action -> (derivative suffix, label used in logs)
+    PRESERVATION_TARGETS = {
+        PRESERVE_TIFF: ("_preservation.tif", "TIFF"),
+        PRESERVE_MKV: ("_preservation.mkv", "MKV"),
+    }
+
     def execute(self):
         logger.info("Normalizing content for preservation and access...")
         
         sip_root = self.context['sip_path']
         objects_dir = os.path.join(sip_root, 'data', 'content', 'objects')
         thumbnails_dir = os.path.join(sip_root, 'data', 'thumbnails')
+        logs_dir = os.path.join(sip_root, 'data', 'content', 'logs')
         
         if not os.path.exists(objects_dir):
             objects_dir = sip_root
+            logs_dir = sip_root
+
+        # Identification results from IdentifyFormatStep, keyed by path relative to objects/
+        formats = self.context.get('formats', {})
+        # (source path, directory for the preservation copy, path relative to objects/)
+        tasks = []
             
-        for root, dirs, files in os.walk(objects_dir):
+        for root, dirs, files in sorted_walk(objects_dir):
             for file in files:
                 file_path = os.path.join(root, file)
-                filename, ext = os.path.splitext(file)
-                ext = ext.lower()
-                
-                # Images
-                if ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff']:
-                    # Preservation: TIFF (if not already)
-                    if ext not in ['.tif', '.tiff']:
-                        preservation_path = os.path.join(root, f"{filename}_preservation.tif")
-                        try:
-                            cmd = [Paths.CONVERT_CMD, file_path, "-compress", "lzw", preservation_path]
-                            subprocess.run(cmd, check=True, capture_output=True)
-                            logger.info(f"Normalized {file} to TIFF")
-                        except Exception as e:
-                            logger.warning(f"Failed to normalize image {file}: {e}")
-
-                    # Thumbnails
-                    thumb_path = os.path.join(thumbnails_dir, f"{filename}.png")
-                    try:
-                        # convert input -resize 200x200 thumb.png
-                        cmd = [Paths.CONVERT_CMD, file_path, "-resize", "200x200", thumb_path]
-                        subprocess.run(cmd, check=True, capture_output=True)
-                        logger.info(f"Generated thumbnail for {file}")
-                    except Exception as e:
-                        logger.warning(f"Failed to generate thumbnail for {file}: {e}")
-
-                # Video
-                elif ext in ['.avi', '.mov', '.mp4', '.flv']:
-                    # Preservation: MKV (FFV1)
-                    preservation_path = os.path.join(root, f"{filename}_preservation.mkv")
-                    try:
-                        cmd = [Paths.FFMPEG_CMD, "-i", file_path, "-c:v", "ffv1", "-level", "3", "-c:a", "pcm_s24le", preservation_path, "-y"]
-                        subprocess.run(cmd, check=True, capture_output=True)
-                        logger.info(f"Normalized {file} to MKV")
-                    except Exception as e:
-                         logger.warning(f"Failed to normalize video {file}: {e}")
+                rel_path = os.path.relpath(file_path, objects_dir).replace('\\', '/')
+                tasks.append((file_path, root, rel_path))
+
+        # Files left in place for fetch.txt are read from their source; derivatives go into the bag
+        for entry in self.context.get('fetch_files', []):
+            output_dir = os.path.join(objects_dir, *entry['rel_path'].split('/')[:-1])
+            os.makedirs(output_dir, exist_ok=True)
+            tasks.append((entry['source'], output_dir, entry['rel_path']))
+
+        def normalize_shard(shard):
+            return [
+                self._normalize_file(file_path, output_dir, rel_path, formats.get(rel_path, {}), thumbnails_dir)
+                for file_path, output_dir, rel_path in shard
+            ]
+
+        results = [result for shard in shard_map(normalize_shard, tasks, self.context['config'], key=lambda task: task[0], name="NormalizeShard") for result in shard]
+
+        self.context['normalization_results'] = results
+        self.check_cancelled("writing the normalization report")
+        self._write_report(results, logs_dir)
+
+        converted = sum(1 for r in results if r['preservation'] == 'converted')
+        skipped = sum(1 for r in results if r['preservation'].startswith('skipped'))
+        logger.info(f"Normalization complete: {converted} converted, {skipped} skipped, {len(results)} files examined.")
+
+    def _normalize_file(self, file_path, output_dir, rel_path, file_format, thumbnails_dir):
+        file = os.path.basename(rel_path)
+        filename = os.path.splitext(file)[0]
+        puid = file_format.get('puid')
+        mimetype = file_format.get('mimetype')
+        rule, matched_on = DEFAULT_RULES.match(file, puid, mimetype)
+
+        result = {
+            'file': rel_path,
+            'puid': puid or '',
+            'mimetype': mimetype or '',
+            'rule': rule['name'] if rule else '',
+            'matched_on': matched_on or '',
+            'preservation': 'no rule',
+            'access': '',
+        }
+
+        if filename.endswith('_preservation'):
+            # A derivative from an earlier normalization, not an original
+            result['preservation'] = 'skipped: derivative'
+            return result
+        if rule is None:
+            return result
+
+        # Preservation
+        action = rule['preservation']
+        if action is None:
+            result['preservation'] = 'skipped: already a preservation format'
+        else:
+            suffix, label = self.PRESERVATION_TARGETS[action]
+            preservation_path = os.path.join(output_dir, f"{filename}{suffix}")
+            if os.path.exists(preservation_path) and not self.context.get('normalize_force', False):
+                result['preservation'] = 'skipped: preservation copy exists'
+            else:
+                # In reprocessing this writes into the stored AIP, so stop as soon as the lease is lost
+                self.check_cancelled(f"normalizing {rel_path}")
+                if action == PRESERVE_TIFF:
+                    cmd = [Paths.CONVERT_CMD, file_path, "-compress", "lzw", preservation_path]
+                else:
+                    cmd = [Paths.FFMPEG_CMD, "-i", file_path, "-c:v", "ffv1", "-level", "3", "-c:a", "pcm_s24le", preservation_path, "-y"]
+                try:
+                    tracing.run(cmd, path=file_path, check=True, capture_output=True)
+                    logger.info(f"Normalized {file} to {label}", extra={'progress': 'normalized'})
+                    result['preservation'] = 'converted'
+                except Exception as e:
+                    logger.warning(f"Failed to normalize {file}: {e}")
+                    result['preservation'] = 'failed'
+
+        # Access
+        if rule['access'] == ACCESS_THUMBNAIL:
+            # Mirrors the objects/ tree, so files with the same name in different directories keep their own thumbnail
+            thumb_dir = os.path.join(thumbnails_dir, *rel_path.split('/')[:-1])
+            thumb_path = os.path.join(thumb_dir, f"{filename}.png")
+            self.check_cancelled(f"the thumbnail of {rel_path}")
+            try:
+                os.makedirs(thumb_dir, exist_ok=True)
+                # convert input -resize 200x200 thumb.png
+                cmd = [Paths.CONVERT_CMD, file_path, "-resize", "200x200", thumb_path]
+                tracing.run(cmd, path=file_path, check=True, capture_output=True)
+                logger.info(f"Generated thumbnail for {file}", extra={'progress': 'thumbnails'})
+                result['access'] = 'thumbnail'
+            except Exception as e:
+                logger.warning(f"Failed to generate thumbnail for {file}: {e}")
+                result['access'] = 'failed'
+
+        return result
+
+    def _write_report(self, results, logs_dir):
+        report_path = os.path.join(logs_dir, 'normalization.csv')
+        fieldnames = ['file', 'puid', 'mimetype', 'rule', 'matched_on', 'preservation', 'access']
+        # When a stored AIP is reprocessed, the report of the earlier run is merged by path, not replaced
+        rows = {}
+        if os.path.exists(report_path):
+            with open(report_path, newline='') as csvfile:
+                rows = {row['file']: row for row in csv.DictReader(csvfile)}
+        for result in results:
+            previous = rows.get(result['file'])
+            if previous and previous['preservation'] == 'converted' and result['preservation'] == 'skipped: preservation copy exists':
+                # Keep the record of the run that made the copy
+                result = dict(result, preservation='converted')
+            rows[result['file']] = result
+        with open(report_path, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows.values())
+        logger.info(f"Normalization report written to {report_path}")
+
+class DeferNormalizationStep(NormalizeStep):
+    """
+    Stand-in for NormalizeStep in the deferred profile.
+
+    Writes the normalization report with every file marked 'deferred', so the
+    identification results travel with the AIP to the background job that
+    normalizes it later (see QueueNormalizationStep).
+    """
+
+    def execute(self):
+        logger.info("Deferring normalization until the AIP is stored...")
+        sip_root = self.context['sip_path']
+        objects_dir = os.path.join(sip_root, 'data', 'content', 'objects')
+        logs_dir = os.path.join(sip_root, 'data', 'content', 'logs')
+        if not os.path.exists(objects_dir):
+            objects_dir = sip_root
+            logs_dir = sip_root
+
+        formats = self.context.get('formats', {})
+        rel_paths = []
+        for root, dirs, files in sorted_walk(objects_dir):
+            for file in files:
+                rel_paths.append(os.path.relpath(os.path.join(root, file), objects_dir).replace('\\', '/'))
+        rel_paths += [entry['rel_path'] for entry in self.context.get('fetch_files', [])]
+
+        results = []
+        for rel_path in rel_paths:
+            file_format = formats.get(rel_path, {})
+            rule, matched_on = DEFAULT_RULES.match(os.path.basename(rel_path), file_format.get('puid'), file_format.get('mimetype'))
+            results.append({
+                'file': rel_path,
+                'puid': file_format.get('puid') or '',
+                'mimetype': file_format.get('mimetype') or '',
+                'rule': rule['name'] if rule else '',
+                'matched_on': matched_on or '',
+                'preservation': 'deferred' if rule else 'no rule',
+                'access': '',
+            })
+        self._write_report(results, logs_dir)
 
 class ProcessContentStep(Step):
     def execute(self):
@@ -373,3 +611,19 @@ class ProcessContentStep(Step):
         # Placeholder for bulk_extractor or similar
         # For now, just log that we are examining
         logger.info("Content examination complete (simulated).")
+
+class UpdateBagStep(Step):
+    """
+    Adds what the steps after CreateSIPStep wrote (preservation copies,
+    thumbnails, the normalization report) to the METS, the manifests and
+    Payload-Oxum before the AIP is stored. Only files that are new or changed
+    since the bag was created are hashed.
+    """
+
+    def execute(self):
+        before = self.context.get('bag_snapshot')
+        if before is None:
+            return
+        changed, removed, touched = update_aip(self.context['sip_path'], before)
+        if changed or removed:
+            logger.info(f"Updated bag: {len(changed)} file(s) added or rehashed, {len(removed)} removed, {touched} METS entries.")
@@ -2,9 +2,12 @@
 import shutil
 import logging
 import os
-import subprocess
 from . import Step
 from ..config import Paths
+from ..utils.aip_index import AIPIndex, index_path
+from ..utils.fs import directory_size
+from ..utils.job_queue import TransferQueue, normalization_queue_path
+from ..utils import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -26,9 +29,44 @@ class StoreAIPStep(Step):
             if os.path.exists(dest_path):
                 shutil.rmtree(dest_path)
             shutil.copytree(sip_path, dest_path)
+            self.context['stored_aip_path'] = dest_path
             logger.info("AIP stored.")
         except Exception as e:
             logger.error(f"Failed to store AIP: {e}")
+            return
+
+        if self.context['config'].UPDATE_AIP_INDEX:
+            self._update_index(dest_path)
+
+    def _update_index(self, dest_path):
+        db_path = index_path(self.context['aip_path'])
+        try:
+            index = AIPIndex(db_path)
+            try:
+                file_count = index.add_aip_from_mets(dest_path)
+            finally:
+                index.close()
+            logger.info(f"Indexed {file_count} files in {db_path}")
+        except Exception as e:
+            # The AIP itself is stored; a stale index can be repaired with 'index backfill'
+            logger.warning(f"Failed to update AIP index: {e}")
+
+class QueueNormalizationStep(Step):
+    """Hands a stored AIP of originals to the background queue processed by the 'deferred' command."""
+
+    def execute(self):
+        aip_dir = self.context.get('stored_aip_path')
+        if aip_dir is None:
+            logger.error("AIP was not stored; normalization not queued.")
+            return
+
+        config = self.context['config']
+        db_path = normalization_queue_path(self.context['aip_path'])
+        queue = TransferQueue(db_path, lease_seconds=config.QUEUE_LEASE_SECONDS, max_attempts=config.QUEUE_MAX_ATTEMPTS, root=self.context['aip_path'])
+        if queue.enqueue(os.path.abspath(aip_dir), directory_size(aip_dir)):
+            logger.info(f"Queued {os.path.basename(aip_dir)} for deferred normalization in {db_path}")
+        else:
+            logger.warning(f"{os.path.basename(aip_dir)} is already in the deferred normalization queue")
 
 class StoreDIPStep(Step):
     def execute(self):
@@ -36,7 +74,7 @@ class StoreDIPStep(Step):
         
         sip_path = self.context['sip_path']
         sip_uuid = self.context.get('sip_uuid', 'no-uuid')
-        sip_name = os.path.basename(sip_path)
+        sip_name = self.context.get('sip_name', os.path.basename(sip_path))
         
         # DIP Name: <SIP_Name>-<UUID>
         dip_name = f"{sip_name}-{sip_uuid}"
@@ -110,7 +148,7 @@ class StoreDIPStep(Step):
             try:
                 # 7z a -mx=N archive.7z path/to/dip
                 cmd = [Paths.SEVEN_ZIP_CMD, "a", f"-mx={compression_level}", archive_name, dest_path]
-                subprocess.run(cmd, check=True, capture_output=True)
+                tracing.run(cmd, path=dest_path, check=True, capture_output=True)
                 logger.info("DIP compressed and stored.")
                 
                 
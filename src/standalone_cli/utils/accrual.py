@@ -0,0 +1,188 @@
+import os
+import json
+import logging
+from .aip_index import AIPIndex, index_path, read_package_info
+from .bag import hash_file, read_manifest, read_bag_info, MANIFEST, BAG_INFO
+from .fetch import FETCH_FILE, read_fetch_txt
+
+logger = logging.getLogger(__name__)
+
+# Written into every AIP built in accrual mode: the source's full file list and what changed
+ACCRUAL_FILE = "data/content/metadata/accrual.json"
+OBJECTS_PREFIX = "data/content/objects/"
+
+
+def _read_accrual(aip_dir):
+    path = os.path.join(aip_dir, *ACCRUAL_FILE.split("/"))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_parent_aip(aip_storage, source_name, use_index=True):
+    """
+    Return the most recent AIP built from the transfer directory source_name, or None.
+
+    AIPs are matched on the Internal-Sender-Identifier in bag-info.txt, or for
+    older AIPs without one, on a <source_name>-<uuid> directory name. The
+    latest Bagging-Date wins, then the higher Accrual-Sequence.
+
+    With use_index, the AIP index answers this with one query. Without it,
+    or if the index has not been created yet, the bag-info.txt of every AIP
+    in aip_storage is read.
+    """
+    db_path = index_path(aip_storage)
+    if use_index and os.path.exists(db_path):
+        index = AIPIndex(db_path)
+        try:
+            locations = index.aips_from_source(source_name)
+        finally:
+            index.close()
+        # Skip AIPs that were indexed but have since been moved or deleted
+        return next((location for location in locations if os.path.isfile(os.path.join(location, BAG_INFO))), None)
+
+    if not os.path.isdir(aip_storage):
+        return None
+    candidates = []
+    for item in os.listdir(aip_storage):
+        aip_dir = os.path.join(aip_storage, item)
+        package = read_package_info(aip_dir)
+        if package["source"] != source_name:
+            continue
+        rank = (package["bagging_date"] or "", package["accrual_sequence"], package["bag_mtime"])
+        candidates.append((rank, aip_dir))
+    return max(candidates)[1] if candidates else None
+
+
+def load_state(aip_dir):
+    """
+    Return {path relative to objects/: {'size', 'mtime_ns', 'sha256', 'aip'}} for the source as of aip_dir.
+
+    Accrual AIPs carry the full list in accrual.json, including files held by
+    earlier AIPs. For other AIPs it is rebuilt from manifest-sha256.txt, with
+    sizes and modification times taken from the stored files. Preservation
+    copies are left out. Files listed in fetch.txt have no modification
+    time, so they are always rehashed when compared.
+    """
+    accrual = _read_accrual(aip_dir)
+    if accrual is not None:
+        return accrual["files"]
+
+    aip_uuid = read_bag_info(aip_dir).get("External-Identifier")
+    fetched = {}
+    if os.path.exists(os.path.join(aip_dir, FETCH_FILE)):
+        fetched = {path: length for url, length, path in read_fetch_txt(aip_dir)}
+
+    state = {}
+    for path, checksum in read_manifest(os.path.join(aip_dir, MANIFEST)).items():
+        if not path.startswith(OBJECTS_PREFIX):
+            continue
+        rel_path = path[len(OBJECTS_PREFIX):]
+        if os.path.splitext(os.path.basename(rel_path))[0].endswith("_preservation"):
+            continue
+        file_path = os.path.join(aip_dir, *path.split("/"))
+        if os.path.exists(file_path):
+            st = os.stat(file_path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        elif path in fetched and fetched[path] != "-":
+            size, mtime_ns = int(fetched[path]), None
+        else:
+            continue
+        state[rel_path] = {"size": size, "mtime_ns": mtime_ns, "sha256": checksum, "aip": aip_uuid}
+    return state
+
+
+def plan_accrual(transfer_path, source_name, aip_storage, use_index=True):
+    """
+    Compare a transfer with the latest AIP of the same source (see find_parent_aip).
+
+    A file is unchanged if its size and modification time match the
+    parent's record. If only the modification time differs, the file is
+    hashed and compared with the parent's checksum. Returns a dict with the
+    parent AIP (or None), the added, changed, unchanged and removed paths,
+    and the new file list. Unchanged files keep the checksum and AIP
+    recorded by the parent; the others are filled in by CreateSIPStep.
+    """
+    parent_dir = find_parent_aip(aip_storage, source_name, use_index)
+    parent = None
+    state = {}
+    if parent_dir is not None:
+        info = read_bag_info(parent_dir)
+        parent = {
+            "uuid": info.get("External-Identifier"),
+            "name": os.path.basename(parent_dir),
+            "sequence": int(info.get("Accrual-Sequence") or 0),
+        }
+        state = load_state(parent_dir)
+        logger.info(f"Accrual parent: {parent['name']} ({len(state)} files)")
+    else:
+        logger.info(f"No earlier AIP of {source_name}; ingesting everything")
+
+    files = {}
+    added, changed, unchanged = [], [], []
+    for root, dirs, names in os.walk(transfer_path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            rel_path = os.path.relpath(file_path, transfer_path).replace('\\', '/')
+            st = os.stat(file_path)
+            record = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": None, "aip": None, "transfer_path": file_path}
+            previous = state.get(rel_path)
+
+            if previous is not None and previous["size"] == st.st_size:
+                if previous["mtime_ns"] != st.st_mtime_ns:
+                    # Touched or rewritten; only the content decides
+                    record["sha256"] = hash_file(file_path, "sha256")
+                if previous["mtime_ns"] == st.st_mtime_ns or record["sha256"] == previous["sha256"]:
+                    record.update(sha256=previous["sha256"], aip=previous["aip"])
+                    unchanged.append(rel_path)
+                    files[rel_path] = record
+                    continue
+
+            (changed if previous is not None else added).append(rel_path)
+            files[rel_path] = record
+
+    removed = sorted(set(state) - set(files))
+    logger.info(f"Accrual: {len(added)} added, {len(changed)} changed, {len(unchanged)} unchanged, {len(removed)} removed")
+    return {
+        "source": source_name,
+        "parent": parent,
+        "added": added,
+        "changed": changed,
+        "unchanged": unchanged,
+        "removed": removed,
+        "files": files,
+    }
+
+
+def accrual_sequence(plan):
+    """Position of the AIP built from plan in its source's chain of accruals; 0 for the first."""
+    return plan["parent"]["sequence"] + 1 if plan["parent"] else 0
+
+
+def write_accrual(bag_dir, plan, aip_uuid):
+    """Write accrual.json; plan['files'] must hold a sha256 for every added and changed file."""
+    parent = plan["parent"]
+    document = {
+        "source": plan["source"],
+        "sequence": accrual_sequence(plan),
+        "parent": {"uuid": parent["uuid"], "name": parent["name"]} if parent else None,
+        "added": plan["added"],
+        "changed": plan["changed"],
+        "removed": plan["removed"],
+        "unchanged": len(plan["unchanged"]),
+        "files": {
+            rel_path: {
+                "size": record["size"],
+                "mtime_ns": record["mtime_ns"],
+                "sha256": record["sha256"],
+                "aip": record["aip"] or aip_uuid,
+            }
+            for rel_path, record in plan["files"].items()
+        },
+    }
+    path = os.path.join(bag_dir, *ACCRUAL_FILE.split("/"))
+    with open(path, "w") as f:
+        json.dump(document, f, indent=1)
+    return path
@@ -0,0 +1,243 @@
+import os
+import re
+import glob
+import sqlite3
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from ..config import Paths
+from .bag import read_bag_info, BAG_INFO
+
+logger = logging.getLogger(__name__)
+
+NS_METS = "http://www.loc.gov/METS/"
+METS_FILE_TAG = f"{{{NS_METS}}}file"
+METS_FLOCAT_TAG = f"{{{NS_METS}}}FLocat"
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+# Stored AIPs are named <source>-<uuid>
+UUID_SUFFIX = re.compile(r"-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+def index_path(aip_storage):
+    """Location of the AIP index: AM_AIP_INDEX, or aip-index.sqlite in AIP storage."""
+    return Paths.AIP_INDEX or os.path.join(aip_storage, "aip-index.sqlite")
+
+
+def parse_mets(mets_path):
+    """
+    Stream the mets:file entries of a METS document.
+
+    Returns a list of dicts with the bag-relative path, size, sha256 and format
+    of every file. Uses iterparse and clears processed elements, so memory stays
+    flat for METS files with hundreds of thousands of entries.
+    """
+    files = []
+    for event, file_el in etree.iterparse(mets_path, events=("end",), tag=METS_FILE_TAG):
+        flocat = file_el.find(METS_FLOCAT_TAG)
+        href = None
+        if flocat is not None:
+            # METSGenerator writes an unqualified href; standard METS uses xlink:href
+            href = flocat.get("href") or flocat.get(XLINK_HREF)
+        if href:
+            checksum_type = (file_el.get("CHECKSUMTYPE") or "").upper()
+            files.append({
+                "path": f"data/{href}",
+                "size": int(file_el.get("SIZE") or 0),
+                "sha256": file_el.get("CHECKSUM") if checksum_type == "SHA-256" else None,
+                "format": file_el.get("MIMETYPE"),
+            })
+
+        file_el.clear()
+        while file_el.getprevious() is not None:
+            del file_el.getparent()[0]
+    return files
+
+
+def read_package_info(aip_dir):
+    """
+    Return the source, Bagging-Date, accrual sequence and bag-info.txt mtime of an AIP directory.
+
+    The source is the Internal-Sender-Identifier in bag-info.txt, or for
+    older AIPs without one, the directory name without its -<uuid> suffix.
+    """
+    package = {"source": None, "bagging_date": None, "accrual_sequence": 0, "bag_mtime": None}
+    bag_info_path = os.path.join(aip_dir, BAG_INFO)
+    if not os.path.isfile(bag_info_path):
+        return package
+    info = read_bag_info(aip_dir)
+    source = info.get("Internal-Sender-Identifier")
+    if not source:
+        name = os.path.basename(aip_dir.rstrip(os.sep))
+        match = UUID_SUFFIX.search(name)
+        source = name[:match.start()] if match else None
+    package.update(
+        source=source,
+        bagging_date=info.get("Bagging-Date"),
+        accrual_sequence=int(info.get("Accrual-Sequence") or 0),
+        bag_mtime=os.path.getmtime(bag_info_path),
+    )
+    return package
+
+
+def find_mets(aip_dir):
+    """Return the METS.<uuid>.xml of an AIP directory, or None."""
+    matches = glob.glob(os.path.join(aip_dir, "data", "METS.*.xml"))
+    return matches[0] if matches else None
+
+
+def _read_aip(aip_dir):
+    # Runs in a worker process during backfill
+    mets_path = find_mets(aip_dir)
+    if mets_path is None:
+        return aip_dir, None, []
+    aip_uuid = os.path.basename(mets_path)[len("METS."):-len(".xml")]
+    return aip_dir, aip_uuid, parse_mets(mets_path)
+
+
+class AIPIndex:
+    """
+    Local SQLite index of every file held in AIP storage.
+
+    Maps AIP UUID, bag-relative path, size, sha256 and format to each other so
+    that "which AIP holds this file/checksum/format?" is an indexed lookup
+    instead of a grep over every METS file. AIPs are also recorded by source
+    transfer directory, so accruals find their parent without opening every
+    AIP in storage.
+    """
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS aips (
+            uuid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            location TEXT NOT NULL,
+            indexed_at REAL NOT NULL,
+            source TEXT,
+            bagging_date TEXT,
+            accrual_sequence INTEGER NOT NULL DEFAULT 0,
+            bag_mtime REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS files (
+            aip_uuid TEXT NOT NULL,
+            path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER,
+            sha256 TEXT,
+            format TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS files_aip ON files (aip_uuid)",
+        "CREATE INDEX IF NOT EXISTS files_path ON files (path)",
+        "CREATE INDEX IF NOT EXISTS files_name ON files (name)",
+        "CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)",
+        "CREATE INDEX IF NOT EXISTS files_format ON files (format)",
+    ]
+
+    QUERY_COLUMNS = ("aip_uuid", "aip_name", "path", "size", "sha256", "format")
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(aips)")]
+            if "source" not in columns:
+                # Index created before AIPs were recorded by source; fill the new columns from bag-info.txt
+                self.conn.execute("ALTER TABLE aips ADD COLUMN source TEXT")
+                self.conn.execute("ALTER TABLE aips ADD COLUMN bagging_date TEXT")
+                self.conn.execute("ALTER TABLE aips ADD COLUMN accrual_sequence INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute("ALTER TABLE aips ADD COLUMN bag_mtime REAL")
+                for aip_uuid, location in self.conn.execute("SELECT uuid, location FROM aips").fetchall():
+                    self.conn.execute(
+                        "UPDATE aips SET source = :source, bagging_date = :bagging_date, accrual_sequence = :accrual_sequence, bag_mtime = :bag_mtime WHERE uuid = :uuid",
+                        dict(read_package_info(location), uuid=aip_uuid)
+                    )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS aips_source ON aips (source)")
+
+    def close(self):
+        self.conn.close()
+
+    def add_aip(self, aip_uuid, aip_dir, files):
+        """(Re)index one AIP. Any previous entries for aip_uuid are replaced."""
+        package = read_package_info(aip_dir)
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE aip_uuid = ?", (aip_uuid,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO aips (uuid, name, location, indexed_at, source, bagging_date, accrual_sequence, bag_mtime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    aip_uuid, os.path.basename(aip_dir.rstrip(os.sep)), os.path.abspath(aip_dir), time.time(),
+                    package["source"], package["bagging_date"], package["accrual_sequence"], package["bag_mtime"]
+                )
+            )
+            self.conn.executemany(
+                "INSERT INTO files (aip_uuid, path, name, size, sha256, format) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (aip_uuid, f["path"], os.path.basename(f["path"]), f["size"], f["sha256"], f["format"])
+                    for f in files
+                )
+            )
+
+    def add_aip_from_mets(self, aip_dir):
+        """Index an AIP directory from its METS file. Returns the number of files indexed."""
+        aip_dir, aip_uuid, files = _read_aip(aip_dir)
+        if aip_uuid is None:
+            logger.warning(f"No METS file found in {aip_dir}; not indexed")
+            return 0
+        self.add_aip(aip_uuid, aip_dir, files)
+        return len(files)
+
+    def backfill(self, aip_storage, workers=None):
+        """
+        Index every AIP directory below aip_storage.
+
+        METS files are parsed in parallel worker processes; the results are
+        written by this process only, as SQLite allows a single writer.
+        """
+        aip_dirs = [
+            os.path.join(aip_storage, item)
+            for item in sorted(os.listdir(aip_storage))
+            if os.path.isdir(os.path.join(aip_storage, item))
+        ]
+        aip_count = 0
+        file_count = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for aip_dir, aip_uuid, files in executor.map(_read_aip, aip_dirs, chunksize=16):
+                if aip_uuid is None:
+                    logger.warning(f"No METS file found in {aip_dir}; skipped")
+                    continue
+                self.add_aip(aip_uuid, aip_dir, files)
+                aip_count += 1
+                file_count += len(files)
+        return aip_count, file_count
+
+    def query(self, sha256=None, path=None, name=None, file_format=None, aip_uuid=None, limit=100):
+        """Return matching files as dicts. All given criteria must match."""
+        clauses = []
+        params = []
+        for column, value in (("sha256", sha256), ("path", path), ("name", name), ("format", file_format), ("aip_uuid", aip_uuid)):
+            if value is not None:
+                clauses.append(f"files.{column} = ?")
+                params.append(value)
+        sql = (
+            "SELECT files.aip_uuid, aips.name, files.path, files.size, files.sha256, files.format "
+            "FROM files JOIN aips ON aips.uuid = files.aip_uuid"
+        )
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " LIMIT ?"
+        params.append(limit)
+        return [dict(zip(self.QUERY_COLUMNS, row)) for row in self.conn.execute(sql, params)]
+
+    def aips_from_source(self, source):
+        """Return the locations of the AIPs built from source, latest first: by Bagging-Date, then accrual sequence."""
+        rows = self.conn.execute(
+            "SELECT location FROM aips WHERE source = ? ORDER BY bagging_date DESC, accrual_sequence DESC, bag_mtime DESC",
+            (source,)
+        )
+        return [row[0] for row in rows]
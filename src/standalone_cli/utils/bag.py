@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import hashlib
+from .fs import sorted_walk
+
+MANIFEST = "manifest-sha256.txt"
+TAGMANIFEST = "tagmanifest-sha256.txt"
+BAG_INFO = "bag-info.txt"
+
+# Internal copies of the manifest; they are not listed in the payload manifest
+MANIFESTS_DIR = "data/manifests/"
+
+
+def hash_file(filepath, algo="sha256"):
+    h = hashlib.new(algo)
+    with open(filepath, 'rb') as f:
+        while chunk := f.read(8192):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def human_size(total_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if total_bytes < 1024:
+            return f"{total_bytes:.2f} {unit}"
+        total_bytes /= 1024
+    return f"{total_bytes:.2f} TB"
+
+
+def snapshot(bag_dir):
+    """Return {bag-relative path: (size, mtime_ns)} for every payload file. Only stats, never reads."""
+    data_dir = os.path.join(bag_dir, "data")
+    state = {}
+    for root, dirs, files in sorted_walk(data_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            rel_path = os.path.relpath(file_path, bag_dir).replace('\\', '/')
+            if rel_path.startswith(MANIFESTS_DIR):
+                continue
+            st = os.stat(file_path)
+            state[rel_path] = (st.st_size, st.st_mtime_ns)
+    return state
+
+
+def read_manifest(manifest_path):
+    """Return an insertion-ordered {path: checksum} dict."""
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line:
+                    checksum, path = line.split(None, 1)
+                    entries[path.strip()] = checksum
+    return entries
+
+
+def write_manifest(manifest_path, entries):
+    with open(manifest_path, 'w') as f:
+        for path, checksum in entries.items():
+            f.write(f"{checksum}  {path}\n")
+
+
+def read_bag_info(bag_dir):
+    """Return bag-info.txt as an insertion-ordered dict."""
+    info = {}
+    with open(os.path.join(bag_dir, BAG_INFO)) as f:
+        for line in f:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                info[key.strip()] = value.strip()
+    return info
+
+
+def write_bag_info(bag_dir, info):
+    with open(os.path.join(bag_dir, BAG_INFO), 'w') as f:
+        for key, value in info.items():
+            f.write(f"{key}: {value}\n")
+
+
+def write_tagmanifest(bag_dir):
+    with open(os.path.join(bag_dir, TAGMANIFEST), 'w') as f:
+        for item in os.listdir(bag_dir):
+            if item == TAGMANIFEST or item == "data":
+                continue
+            file_path = os.path.join(bag_dir, item)
+            if os.path.isfile(file_path):
+                f.write(f"{hash_file(file_path)}  {item}\n")
+
+
+def diff_snapshots(before, after):
+    """Return (changed, removed) bag-relative paths; changed includes new files."""
+    changed = sorted(path for path, state in after.items() if before.get(path) != state)
+    removed = sorted(path for path in before if path not in after)
+    return changed, removed
+
+
+def update_bag(bag_dir, before, after, checksums=None):
+    """
+    Bring the manifests and bag-info.txt up to date after payload changes.
+
+    before/after are snapshot() results taken around the changes. Only files
+    that are new or whose size/mtime changed are rehashed; Payload-Oxum and
+    Bag-Size are adjusted by the size differences instead of re-walking the
+    payload. checksums may hold already computed sha256 values for some of
+    the changed files. Returns (changed paths, removed paths).
+    """
+    changed, removed = diff_snapshots(before, after)
+    known = checksums or {}
+    checksums = {path: known.get(path) or hash_file(os.path.join(bag_dir, path)) for path in changed}
+
+    # manifest-sha256.txt (and its copy in data/manifests)
+    manifest_path = os.path.join(bag_dir, MANIFEST)
+    manifest = read_manifest(manifest_path)
+    previously_listed = set(manifest)
+    for path in removed:
+        manifest.pop(path, None)
+    manifest.update(checksums)
+    write_manifest(manifest_path, manifest)
+
+    manifests_dir = os.path.join(bag_dir, MANIFESTS_DIR)
+    if os.path.isdir(manifests_dir):
+        shutil.copy2(manifest_path, os.path.join(manifests_dir, "checksums.sha256"))
+        _update_manifest_json(os.path.join(manifests_dir, "manifests.json"), checksums, after, removed)
+
+    # bag-info.txt: Payload-Oxum covers the files listed in the manifest
+    info = read_bag_info(bag_dir)
+    total_bytes, file_count = (int(n) for n in info.get("Payload-Oxum", "0.0").split("."))
+    for path in removed:
+        if path in previously_listed:
+            total_bytes -= before[path][0]
+            file_count -= 1
+    for path in changed:
+        if path in previously_listed:
+            total_bytes += after[path][0] - before[path][0]
+        else:
+            total_bytes += after[path][0]
+            file_count += 1
+    info["Payload-Oxum"] = f"{total_bytes}.{file_count}"
+    info["Bag-Size"] = human_size(total_bytes)
+    write_bag_info(bag_dir, info)
+
+    write_tagmanifest(bag_dir)
+    return changed, removed
+
+
+def _update_manifest_json(manifest_json_path, checksums, after, removed):
+    entries = []
+    if os.path.exists(manifest_json_path):
+        with open(manifest_json_path) as f:
+            entries = json.load(f)
+    by_path = {entry["file"]: entry for entry in entries}
+    for path in removed:
+        by_path.pop(path, None)
+    for path, checksum in checksums.items():
+        by_path[path] = {"file": path, "size": after[path][0], "sha256": checksum}
+    with open(manifest_json_path, 'w') as f:
+        json.dump(list(by_path.values()), f, indent=4)
@@ -0,0 +1,143 @@
+import os
+import shutil
+import pathlib
+import logging
+import tempfile
+import urllib.parse
+import urllib.request
+from .fs import sorted_walk
+from .bag import hash_file, read_manifest, write_tagmanifest, MANIFEST
+
+logger = logging.getLogger(__name__)
+
+FETCH_FILE = "fetch.txt"
+
+
+def plan_fetch_files(transfer_path, size_threshold=0, path_prefixes=()):
+    """
+    Select the transfer files that stay where they are instead of being copied into the bag.
+
+    A file is left in place if it is at least size_threshold bytes
+    (0 disables the check) or if its real path lies under one of
+    path_prefixes. Returns a list of dicts with the real source path, the
+    path relative to the transfer and the size. Files selected by size alone
+    are marked 'outside_prefixes': fetch.txt then points into the transfer
+    area, which is not kept like the prefixes are.
+    """
+    prefixes = [os.path.join(os.path.realpath(prefix), "") for prefix in path_prefixes]
+    if not size_threshold and not prefixes:
+        return []
+
+    fetch_files = []
+    for root, dirs, files in sorted_walk(transfer_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            source = os.path.realpath(file_path)
+            size = os.path.getsize(source)
+            under_prefix = any(source.startswith(prefix) for prefix in prefixes)
+            if under_prefix or (size_threshold and size >= size_threshold):
+                entry = {
+                    'source': source,
+                    'transfer_path': file_path,
+                    'rel_path': os.path.relpath(file_path, transfer_path).replace('\\', '/'),
+                    'size': size,
+                }
+                if not under_prefix:
+                    entry['outside_prefixes'] = True
+                fetch_files.append(entry)
+    return fetch_files
+
+
+def fetch_url(entry):
+    """file:// URL of a file left in place, as listed in fetch.txt."""
+    return pathlib.Path(entry['source']).as_uri()
+
+
+def fetch_checksum(entry):
+    """sha256 of a file left in place, computed once from its source."""
+    if 'sha256' not in entry:
+        entry['sha256'] = hash_file(entry['source'], "sha256")
+    return entry['sha256']
+
+
+def write_fetch_txt(bag_dir, fetch_files, payload_prefix):
+    """Write fetch.txt lines: <url> <length> <path in bag>."""
+    with open(os.path.join(bag_dir, FETCH_FILE), 'w') as f:
+        for entry in fetch_files:
+            url = fetch_url(entry)
+            f.write(f"{url} {entry['size']} {payload_prefix}{entry['rel_path']}\n")
+
+
+def read_fetch_txt(bag_dir):
+    entries = []
+    with open(os.path.join(bag_dir, FETCH_FILE)) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                url, length, path = line.split(" ", 2)
+                entries.append((url, length, path))
+    return entries
+
+
+def _url_to_path(url):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != "file":
+        raise ValueError(f"Unsupported URL scheme in {FETCH_FILE}: {url}")
+    return urllib.request.url2pathname(parsed.path)
+
+
+def fetch_files_from_bag(bag_dir, payload_prefix):
+    """Rebuild the plan_fetch_files() entries of a stored holey bag from its fetch.txt."""
+    if not os.path.exists(os.path.join(bag_dir, FETCH_FILE)):
+        return []
+    return [
+        {
+            'source': _url_to_path(url),
+            'rel_path': path[len(payload_prefix):],
+            'size': int(length),
+        }
+        for url, length, path in read_fetch_txt(bag_dir)
+        if path.startswith(payload_prefix)
+    ]
+
+
+def complete_bag(bag_dir):
+    """
+    Materialize a holey bag: copy every fetch.txt entry into the bag, verify
+    it against manifest-sha256.txt, then drop fetch.txt.
+
+    Each file is copied to a temporary name next to its destination and only
+    renamed into place once verified, so a failed or interrupted run never
+    leaves a partial or corrupt file under a manifest path.
+    """
+    fetch_path = os.path.join(bag_dir, FETCH_FILE)
+    if not os.path.exists(fetch_path):
+        logger.info(f"{bag_dir} has no {FETCH_FILE}; bag is already complete.")
+        return 0
+
+    manifest = read_manifest(os.path.join(bag_dir, MANIFEST))
+    entries = read_fetch_txt(bag_dir)
+    for url, length, path in entries:
+        source = _url_to_path(url)
+        dest = os.path.join(bag_dir, *path.split("/"))
+
+        logger.info(f"Fetching {path}...")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, part_path = tempfile.mkstemp(prefix=f".{os.path.basename(dest)}.", suffix=".part", dir=os.path.dirname(dest))
+        os.close(fd)
+        try:
+            shutil.copy2(source, part_path)
+            if length != "-" and os.path.getsize(part_path) != int(length):
+                raise ValueError(f"Size mismatch for {path}: expected {length}, got {os.path.getsize(part_path)}")
+            expected = manifest.get(path)
+            if expected and hash_file(part_path, "sha256") != expected:
+                raise ValueError(f"Checksum mismatch for {path}")
+            os.replace(part_path, dest)
+        except BaseException:
+            os.remove(part_path)
+            raise
+
+    os.remove(fetch_path)
+    write_tagmanifest(bag_dir)
+    logger.info(f"Bag complete: {len(entries)} file(s) fetched.")
+    return len(entries)
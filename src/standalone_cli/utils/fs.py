@@ -0,0 +1,56 @@
+import os
+
+
+def sorted_walk(path):
+    """os.walk in name order, so lists built from it do not depend on the order the filesystem returns entries in."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        yield root, dirs, sorted(files)
+
+
+def directory_size(path):
+    """Return the total size in bytes of all files below path."""
+    total_bytes = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                # File vanished or is unreadable; it will fail later in the workflow anyway
+                continue
+    return total_bytes
+
+
+def tree_fingerprint(path):
+    """
+    Return (total size, fingerprint) of the tree below path.
+
+    The fingerprint combines the file count, the total size and the newest
+    file or directory mtime, so it changes when files are added, removed,
+    rewritten or touched.
+    """
+    file_count = 0
+    total_bytes = 0
+    newest = os.stat(path).st_mtime_ns
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            newest = max(newest, st.st_mtime_ns)
+            if name in files:
+                file_count += 1
+                total_bytes += st.st_size
+    return total_bytes, f"{file_count}:{total_bytes}:{newest}"
+
+
+def ignore_paths(paths):
+    """shutil.copytree ignore callable that skips the given file paths."""
+    skipped = {os.path.abspath(path) for path in paths}
+
+    def ignore(directory, names):
+        directory = os.path.abspath(directory)
+        return {name for name in names if os.path.join(directory, name) in skipped}
+
+    return ignore
@@ -0,0 +1,235 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import logging
+from ..config import Paths
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def normalization_queue_path(aip_storage):
+    """Location of the deferred normalization queue: AM_NORMALIZATION_QUEUE_DB, or a file in AIP storage."""
+    return Paths.NORMALIZATION_QUEUE_DB or os.path.join(aip_storage, ".am-normalization-queue.sqlite")
+
+
+class TransferQueue:
+    """
+    Job table shared by several CLI worker processes.
+
+    The table is a SQLite database that lives on the shared transfer area, so
+    workers on one host or many can claim transfers from it. A claimed transfer
+    is leased to its worker; the worker renews the lease with heartbeats, and a
+    lease that is not renewed (crashed worker) expires so another worker can
+    reclaim the transfer. Pending transfers are handed out largest first.
+
+    Paths under root are stored relative to it, so hosts that mount the
+    shared area at different paths see the same jobs: each passes its own
+    mount point as root, and gets paths under it back from claim().
+
+    Note: SQLite relies on POSIX file locks. On NFS these require a working lock
+    manager (lockd); the default rollback journal is used because WAL mode does
+    not work over network filesystems.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            enqueued_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            fingerprint TEXT
+        )
+    """
+
+    def __init__(self, db_path, lease_seconds=300, max_attempts=3, root=None):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.root = os.path.abspath(root) if root else None
+        with self._connect() as conn:
+            conn.execute(self.SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "fingerprint" not in columns:
+                # Queue created before fingerprints were recorded
+                conn.execute("ALTER TABLE jobs ADD COLUMN fingerprint TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state_size ON jobs (state, size)")
+            if self.root:
+                # Queue created before paths were stored relative to the root
+                for (path,) in conn.execute("SELECT path FROM jobs").fetchall():
+                    if os.path.isabs(path) and self._key(path) != path:
+                        conn.execute("UPDATE OR IGNORE jobs SET path = ? WHERE path = ?", (self._key(path), path))
+
+    def _connect(self):
+        return _Connection(self.db_path)
+
+    def _key(self, path):
+        # What is stored for path: relative to root with '/' separators, or absolute if outside it
+        path = os.path.abspath(path)
+        if self.root:
+            rel_path = os.path.relpath(path, self.root)
+            if rel_path != os.pardir and not rel_path.startswith(os.pardir + os.sep):
+                return rel_path.replace(os.sep, '/')
+        return path
+
+    def _path(self, key):
+        if self.root and not os.path.isabs(key):
+            return os.path.join(self.root, *key.split('/'))
+        return key
+
+    def enqueue(self, path, size, fingerprint=None, force=False):
+        """
+        Add a transfer to the queue. Returns True if it was added or queued again.
+
+        A transfer that is already done or failed is queued again when its
+        fingerprint (see fs.tree_fingerprint) has changed, i.e. the transfer
+        grew or was re-deposited, or when force is set. Pending and running
+        transfers are left untouched.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (path, size, state, enqueued_at, updated_at, fingerprint) VALUES (?, ?, 'pending', ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET state = 'pending', size = excluded.size, fingerprint = excluded.fingerprint, "
+                "worker = NULL, lease_expires = NULL, attempts = 0, error = NULL, "
+                "enqueued_at = excluded.enqueued_at, updated_at = excluded.updated_at "
+                "WHERE jobs.state IN ('done', 'failed') "
+                "AND (? OR (jobs.fingerprint IS NOT NULL AND jobs.fingerprint IS NOT excluded.fingerprint))",
+                (self._key(path), size, now, now, fingerprint, bool(force))
+            )
+            if cursor.rowcount == 1:
+                return True
+            # Rows from before fingerprints were recorded: adopt the current one as the baseline
+            conn.execute("UPDATE jobs SET fingerprint = ? WHERE path = ? AND fingerprint IS NULL", (fingerprint, self._key(path)))
+            return False
+
+    def claim(self, worker_id):
+        """
+        Lease the next transfer to worker_id.
+
+        Pending transfers and transfers whose lease has expired are eligible,
+        largest first. Returns the transfer path, or None if nothing can be claimed.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Give up on transfers that keep killing their workers
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', error = 'lease expired too many times', updated_at = ? "
+                "WHERE state = 'running' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            row = conn.execute(
+                "SELECT path, state, worker FROM jobs "
+                "WHERE state = 'pending' OR (state = 'running' AND lease_expires < ?) "
+                "ORDER BY size DESC, enqueued_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            path, state, previous_worker = row
+            conn.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE path = ?",
+                (worker_id, now + self.lease_seconds, now, path)
+            )
+            conn.execute("COMMIT")
+
+        if state == 'running':
+            logger.warning(f"Reclaimed transfer {path} from worker {previous_worker} (lease expired)")
+        return self._path(path)
+
+    def heartbeat(self, path, worker_id):
+        """Renew the lease on path. Returns False if worker_id no longer holds it."""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE path = ? AND worker = ? AND state = 'running'",
+                (now + self.lease_seconds, now, self._key(path), worker_id)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, path, worker_id):
+        self._finish(path, worker_id, 'done', None)
+
+    def fail(self, path, worker_id, error):
+        self._finish(path, worker_id, 'failed', error)
+
+    def _finish(self, path, worker_id, state, error):
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, lease_expires = NULL, updated_at = ? WHERE path = ? AND worker = ?",
+                (state, error, now, self._key(path), worker_id)
+            )
+            if cursor.rowcount == 0:
+                logger.warning(f"Transfer {path} was reclaimed by another worker before {worker_id} finished it")
+
+    def counts(self):
+        """Return the number of jobs in each state."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+
+class _Connection:
+    """Short-lived connection so every call (and every thread) gets its own handle."""
+
+    def __init__(self, db_path):
+        # isolation_level=None: autocommit, claim() manages its own BEGIN IMMEDIATE transaction
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+        self.conn.close()
+        return False
+
+
+class Heartbeat(threading.Thread):
+    """
+    Background thread that keeps a claimed transfer's lease alive.
+
+    If the lease is found to belong to another worker, the `lost` event is
+    set; pass it as the run's cancel event so the work stops before it
+    stores anything.
+    """
+
+    def __init__(self, queue, path, worker_id, interval):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.path = path
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.path, self.worker_id):
+                    self.lost.set()
+                    logger.warning(f"Lost lease on transfer {self.path}")
+                    return
+            except sqlite3.Error as e:
+                # Transient lock contention on the shared filesystem; try again next beat
+                logger.warning(f"Heartbeat for {self.path} failed: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import queue
+import atexit
+import datetime
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+
+# (transfer name, per-transfer log path) of the transfer the current thread is working on
+_current_transfer = contextvars.ContextVar("current_transfer", default=None)
+
+_listener = None
+
+
+class TransferContextFilter(logging.Filter):
+    """Tags records with the transfer of the thread that logged them, before they are queued."""
+
+    def filter(self, record):
+        current = _current_transfer.get()
+        record.transfer, record.transfer_log = current if current else (None, None)
+        return True
+
+
+class ProgressConsoleHandler(logging.StreamHandler):
+    """
+    Console handler that rolls per-file messages up into periodic summaries.
+
+    Records logged with extra={'progress': <category>} below WARNING are
+    counted per transfer instead of printed; every `interval` seconds (and
+    when a transfer finishes) one summary line per transfer is written.
+    ProgressQueueListener also calls summarize() while no records arrive,
+    and with force=True when it stops.
+    """
+
+    def __init__(self, stream=None, interval=10.0):
+        super().__init__(stream)
+        self.interval = interval
+        self.counts = {}
+        self.last_summary = time.monotonic()
+
+    def emit(self, record):
+        category = getattr(record, "progress", None)
+        if category is not None and record.levelno < logging.WARNING:
+            transfer_counts = self.counts.setdefault(record.transfer, {})
+            transfer_counts[category] = transfer_counts.get(category, 0) + 1
+        elif getattr(record, "transfer_end", False):
+            self._summarize([record.transfer])
+            super().emit(record)
+        else:
+            super().emit(record)
+
+        self.summarize()
+
+    def next_summary_in(self):
+        """Seconds until the next summary is due, or None while nothing is counted."""
+        if not self.counts:
+            return None
+        return max(0.0, self.last_summary + self.interval - time.monotonic())
+
+    def summarize(self, force=False):
+        """Write the pending summaries if they are due, or now if force."""
+        if self.counts and (force or time.monotonic() - self.last_summary >= self.interval):
+            self._summarize(list(self.counts))
+
+    def _summarize(self, transfers):
+        for transfer in transfers:
+            transfer_counts = self.counts.pop(transfer, None)
+            if not transfer_counts:
+                continue
+            parts = ", ".join(f"{count} {category}" for category, count in transfer_counts.items())
+            summary = logging.makeLogRecord({
+                "name": "progress",
+                "levelno": logging.INFO,
+                "levelname": "INFO",
+                "msg": f"Progress [{transfer or '-'}]: {parts}",
+            })
+            super().emit(summary)
+        self.last_summary = time.monotonic()
+
+
+class TransferJSONHandler(logging.Handler):
+    """Writes each transfer's records, including per-file ones, to its own JSON-lines file."""
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def emit(self, record):
+        path = getattr(record, "transfer_log", None)
+        if path is None:
+            return
+        try:
+            f = self.files.get(path)
+            if f is None:
+                f = self.files[path] = open(path, "a", encoding="utf-8")
+            entry = {
+                "time": datetime.datetime.fromtimestamp(record.created).isoformat(),
+                "level": record.levelname,
+                "logger": record.name,
+                "transfer": record.transfer,
+                "thread": record.threadName,
+                "message": record.getMessage(),
+            }
+            if getattr(record, "progress", None):
+                entry["progress"] = record.progress
+            # QueueHandler has already folded any traceback into the message
+            f.write(json.dumps(entry) + "\n")
+            if getattr(record, "transfer_end", False):
+                self.files.pop(path).close()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        super().close()
+
+
+class ProgressQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that keeps the console's progress summaries on time.
+
+    While the queue is idle it wakes up when a summary is due, so a long
+    conversion does not hold back the counts of the files before it; the
+    remaining counts are written when the listener stops.
+    """
+
+    def __init__(self, log_queue, console, *handlers):
+        super().__init__(log_queue, console, *handlers)
+        self.console = console
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.console.next_summary_in() if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                # Runs on the listener thread, like every other console write
+                self.console.summarize()
+
+    def stop(self):
+        super().stop()
+        self.console.summarize(force=True)
+
+
+def setup_logging(fmt, summary_interval=10.0, stream=None):
+    """
+    Route all logging through a queue to a background listener thread.
+
+    Worker threads only enqueue records; console formatting, summaries and
+    all I/O (console and per-transfer JSON-lines files) happen on the
+    listener thread.
+    """
+    global _listener
+    console = ProgressConsoleHandler(stream, interval=summary_interval)
+    console.setFormatter(logging.Formatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TransferContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = ProgressQueueListener(log_queue, console, TransferJSONHandler())
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Drain the queue and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+@contextmanager
+def transfer_logging(transfer_name, run_id, log_dir):
+    """
+    Attribute everything logged by this thread to one transfer.
+
+    Records go to <log_dir>/<transfer_name>-<run_id>.jsonl; the file is closed
+    and the transfer's progress summary printed when the block exits.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.abspath(os.path.join(log_dir, f"{transfer_name}-{run_id}.jsonl"))
+    token = _current_transfer.set((transfer_name, log_path))
+    logger = logging.getLogger(__name__)
+    try:
+        yield log_path
+    finally:
+        logger.info(f"Transfer log written to {log_path}", extra={"transfer_end": True})
+        _current_transfer.reset(token)
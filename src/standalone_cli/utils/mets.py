@@ -1,7 +1,12 @@
 import os
+import glob
+import uuid
 import datetime
+import posixpath
 import hashlib
+import mimetypes
 from lxml import etree
+from .bag import snapshot, diff_snapshots, update_bag, hash_file
 
 class METSGenerator:
     # Namespaces from Archivematica
@@ -43,14 +48,19 @@ class METSGenerator:
         name.text = "Archivematica Standalone CLI"
 
     def add_dmd_sec(self, dmd_id, md_type, content_element):
-        dmd = etree.SubElement(self.root, f"{{{self.NS_METS}}}dmdSec", ID=dmd_id)
+        dmd = etree.Element(f"{{{self.NS_METS}}}dmdSec", ID=dmd_id)
+        # dmdSec precedes amdSec and fileSec in the METS schema
+        first_amd = self.root.find(f"{{{self.NS_METS}}}amdSec")
+        (first_amd if first_amd is not None else self.file_sec).addprevious(dmd)
         md_wrap = etree.SubElement(dmd, f"{{{self.NS_METS}}}mdWrap", MDTYPE=md_type)
         xml_data = etree.SubElement(md_wrap, f"{{{self.NS_METS}}}xmlData")
         xml_data.append(content_element)
         self.dmd_secs.append(dmd_id)
 
     def add_amd_sec(self, amd_id, tech_md_element=None, digiprov_md_element=None):
-        amd = etree.SubElement(self.root, f"{{{self.NS_METS}}}amdSec", ID=amd_id)
+        amd = etree.Element(f"{{{self.NS_METS}}}amdSec", ID=amd_id)
+        # amdSec precedes fileSec in the METS schema
+        self.file_sec.addprevious(amd)
         if tech_md_element is not None:
             tech_md = etree.SubElement(amd, f"{{{self.NS_METS}}}techMD", ID=f"techMD_{amd_id}")
             md_wrap = etree.SubElement(tech_md, f"{{{self.NS_METS}}}mdWrap", MDTYPE="PREMIS:OBJECT")
@@ -68,33 +78,23 @@ class METSGenerator:
     def add_file_group(self, use, group_id, files):
         """
         files: list of (file_path, file_uuid) tuples. 
+        A (file_path, file_uuid, size, sha256) tuple describes a file that is not
+        present at file_path (e.g. listed in the bag's fetch.txt).
         """
         file_grp = etree.SubElement(self.file_sec, f"{{{self.NS_METS}}}fileGrp", USE=use)
         
-        for file_path, file_uuid in files:
-            if not os.path.exists(file_path):
+        for entry in files:
+            file_path, file_uuid = entry[0], entry[1]
+            if len(entry) == 4:
+                file_size, checksum = entry[2], entry[3]
+            elif not os.path.exists(file_path):
                 continue
+            else:
+                file_size = os.path.getsize(file_path)
+                checksum = self._calculate_checksum(file_path)
                 
             rel_path = os.path.relpath(file_path, self.sip_path).replace("\\", "/")
-            file_size = os.path.getsize(file_path)
-            checksum = self._calculate_checksum(file_path)
-            
-            file_el = etree.SubElement(file_grp, f"{{{self.NS_METS}}}file", 
-                                       ID=f"file-{file_uuid}", 
-                                       GROUPID=f"group-{file_uuid}",
-                                       MIMETYPE="application/octet-stream", 
-                                       SIZE=str(file_size),
-                                       CHECKSUM=checksum,
-                                       CHECKSUMTYPE="SHA-256")
-                                       
-            flocat = etree.SubElement(file_el, f"{{{self.NS_METS}}}FLocat", 
-                                      LOCTYPE="URL", 
-                                      href=rel_path,
-                                      **{f"{{{self.NS_XLINK}}}type": "simple",
-                                         f"{{{self.NS_XLINK}}}title": os.path.basename(file_path)})
-            
-            # Update StructMap
-            fptr = etree.SubElement(self.div_root, f"{{{self.NS_METS}}}fptr", FILEID=f"file-{file_uuid}")
+            _append_file(file_grp, self.div_root, file_uuid, f"group-{file_uuid}", rel_path, file_size, checksum)
 
     def _calculate_checksum(self, filepath):
         h = hashlib.sha256()
@@ -111,3 +111,137 @@ class METSGenerator:
         
         tree = etree.ElementTree(self.root)
         tree.write(output_path, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+
+
+def _append_file(file_grp, div, file_uuid, group_id, href, size, checksum):
+    """Add a mets:file for href to file_grp and point to it from the structMap div."""
+    ns_mets = METSGenerator.NS_METS
+    ns_xlink = METSGenerator.NS_XLINK
+    mimetype = mimetypes.guess_type(href)[0] or "application/octet-stream"
+    file_el = etree.SubElement(file_grp, f"{{{ns_mets}}}file",
+                               ID=f"file-{file_uuid}",
+                               GROUPID=group_id,
+                               MIMETYPE=mimetype,
+                               SIZE=str(size),
+                               CHECKSUM=checksum,
+                               CHECKSUMTYPE="SHA-256")
+    etree.SubElement(file_el, f"{{{ns_mets}}}FLocat",
+                     LOCTYPE="URL",
+                     href=href,
+                     **{f"{{{ns_xlink}}}type": "simple",
+                        f"{{{ns_xlink}}}title": posixpath.basename(href)})
+    etree.SubElement(div, f"{{{ns_mets}}}fptr", FILEID=f"file-{file_uuid}")
+    return file_el
+
+
+# Bag payload directories (relative to data/) whose files are listed in the METS
+OBJECTS_HREF = "content/objects/"
+THUMBNAILS_HREF = "thumbnails/"
+
+
+def _derivative_of(href):
+    """
+    Return (fileGrp USE, key of the original) for a file that is not yet in the METS, or None if it does not belong there.
+
+    The key is (directory relative to objects/, name without extension), so a
+    preservation copy or thumbnail can be grouped with its original.
+    """
+    if href.startswith(OBJECTS_HREF):
+        rel_dir, name = posixpath.split(href[len(OBJECTS_HREF):])
+        stem = posixpath.splitext(name)[0]
+        if stem.endswith("_preservation"):
+            return "preservation", (rel_dir, stem[:-len("_preservation")])
+        return "original", (rel_dir, stem)
+    if href.startswith(THUMBNAILS_HREF):
+        rel_dir, name = posixpath.split(href[len(THUMBNAILS_HREF):])
+        return "thumbnail", (rel_dir, posixpath.splitext(name)[0])
+    return None
+
+
+def update_mets_files(mets_path, sizes, checksums, removed):
+    """
+    Update the mets:file entries of an existing METS document in place.
+
+    sizes and checksums are keyed by href (path relative to the METS file's
+    directory); entries listed in removed are dropped together with their
+    structMap pointers. Files under content/objects/ and thumbnails/ that the
+    METS does not list yet are added, preservation copies and thumbnails in
+    fileGrps of their own (USE="preservation" / "thumbnail") and grouped with
+    their original. Returns the number of entries touched.
+    """
+    ns = {"mets": METSGenerator.NS_METS}
+    tree = etree.parse(mets_path, etree.XMLParser(remove_blank_text=True))
+    touched = 0
+    listed = set()
+    originals = {}
+    for file_el in tree.iterfind(".//mets:fileSec/mets:fileGrp/mets:file", ns):
+        flocat = file_el.find("mets:FLocat", ns)
+        href = flocat.get("href") if flocat is not None else None
+        listed.add(href)
+        if href in removed:
+            for fptr in tree.iterfind(f".//mets:fptr[@FILEID='{file_el.get('ID')}']", ns):
+                fptr.getparent().remove(fptr)
+            file_el.getparent().remove(file_el)
+            touched += 1
+            continue
+        if href in checksums:
+            file_el.set("SIZE", str(sizes[href]))
+            file_el.set("CHECKSUM", checksums[href])
+            file_el.set("CHECKSUMTYPE", "SHA-256")
+            touched += 1
+        derivative = _derivative_of(href or "")
+        if derivative and derivative[0] == "original":
+            originals[derivative[1]] = file_el.get("GROUPID")
+
+    file_sec = tree.find(".//mets:fileSec", ns)
+    div = tree.find(".//mets:structMap/mets:div", ns)
+    groups = {grp.get("USE"): grp for grp in file_sec.iterfind("mets:fileGrp", ns)}
+    for href in sorted(set(checksums) - listed):
+        derivative = _derivative_of(href)
+        if derivative is None:
+            continue
+        use, key = derivative
+        if use not in groups:
+            groups[use] = etree.SubElement(file_sec, f"{{{METSGenerator.NS_METS}}}fileGrp", USE=use)
+        file_uuid = uuid.uuid4().hex
+        group_id = originals.get(key) or f"group-{file_uuid}"
+        if use == "original":
+            originals[key] = group_id
+        _append_file(groups[use], div, file_uuid, group_id, href, sizes[href], checksums[href])
+        touched += 1
+
+    if touched:
+        tree.write(mets_path, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+    return touched
+
+
+def update_aip(aip_dir, before):
+    """
+    Bring an AIP's METS and bag up to date with the payload changes made since the snapshot before.
+
+    Each changed file is hashed once, for both the METS and the manifests.
+    Returns (changed paths, removed paths, METS entries touched); nothing is
+    written if no payload file changed.
+    """
+    data_dir = os.path.join(aip_dir, "data")
+    changed, removed = diff_snapshots(before, snapshot(aip_dir))
+    if not changed and not removed:
+        return changed, removed, 0
+
+    checksums = {path: hash_file(os.path.join(aip_dir, path)) for path in changed}
+
+    touched = 0
+    mets_paths = glob.glob(os.path.join(data_dir, "METS.*.xml"))
+    if mets_paths:
+        # METS hrefs are relative to data/
+        prefix = "data/"
+        touched = update_mets_files(
+            mets_paths[0],
+            sizes={path[len(prefix):]: os.path.getsize(os.path.join(aip_dir, path)) for path in changed},
+            checksums={path[len(prefix):]: checksum for path, checksum in checksums.items()},
+            removed={path[len(prefix):] for path in removed},
+        )
+
+    # Taken again so the rewritten METS is rehashed too
+    changed, removed = update_bag(aip_dir, before, snapshot(aip_dir), checksums)
+    return changed, removed, touched
@@ -0,0 +1,130 @@
+import os
+
+# Preservation actions understood by NormalizeStep
+PRESERVE_TIFF = "tiff"
+PRESERVE_MKV = "mkv"
+
+# Access actions understood by NormalizeStep
+ACCESS_THUMBNAIL = "thumbnail"
+
+# Each rule maps identified formats (PRONOM PUID, MIME type) and, as a fallback
+# when a file was not identified, file extensions to the actions to run.
+# preservation=None means the format is already acceptable for preservation.
+RULES = [
+    {
+        "name": "TIFF",
+        "puids": ["fmt/353", "fmt/154", "fmt/155", "fmt/156", "x-fmt/387", "x-fmt/399"],
+        "mimetypes": ["image/tiff"],
+        "extensions": [".tif", ".tiff"],
+        "preservation": None,
+        "access": ACCESS_THUMBNAIL,
+    },
+    {
+        "name": "JPEG",
+        "puids": ["fmt/41", "fmt/42", "fmt/43", "fmt/44", "x-fmt/398", "x-fmt/390", "x-fmt/391"],
+        "mimetypes": ["image/jpeg"],
+        "extensions": [".jpg", ".jpeg"],
+        "preservation": PRESERVE_TIFF,
+        "access": ACCESS_THUMBNAIL,
+    },
+    {
+        "name": "PNG",
+        "puids": ["fmt/11", "fmt/12", "fmt/13"],
+        "mimetypes": ["image/png"],
+        "extensions": [".png"],
+        "preservation": PRESERVE_TIFF,
+        "access": ACCESS_THUMBNAIL,
+    },
+    {
+        "name": "GIF",
+        "puids": ["fmt/3", "fmt/4"],
+        "mimetypes": ["image/gif"],
+        "extensions": [".gif"],
+        "preservation": PRESERVE_TIFF,
+        "access": ACCESS_THUMBNAIL,
+    },
+    {
+        "name": "BMP",
+        "puids": ["fmt/114", "fmt/115", "fmt/116", "fmt/117", "fmt/118", "fmt/119", "x-fmt/270"],
+        "mimetypes": ["image/bmp", "image/x-ms-bmp"],
+        "extensions": [".bmp"],
+        "preservation": PRESERVE_TIFF,
+        "access": ACCESS_THUMBNAIL,
+    },
+    {
+        "name": "Matroska",
+        "puids": ["fmt/569"],
+        "mimetypes": ["video/x-matroska"],
+        "extensions": [".mkv"],
+        "preservation": None,
+        "access": None,
+    },
+    {
+        "name": "AVI",
+        "puids": ["fmt/5"],
+        "mimetypes": ["video/x-msvideo", "video/avi"],
+        "extensions": [".avi"],
+        "preservation": PRESERVE_MKV,
+        "access": None,
+    },
+    {
+        "name": "QuickTime",
+        "puids": ["x-fmt/384"],
+        "mimetypes": ["video/quicktime"],
+        "extensions": [".mov"],
+        "preservation": PRESERVE_MKV,
+        "access": None,
+    },
+    {
+        "name": "MPEG-4",
+        "puids": ["fmt/199"],
+        "mimetypes": ["video/mp4"],
+        "extensions": [".mp4"],
+        "preservation": PRESERVE_MKV,
+        "access": None,
+    },
+    {
+        "name": "Flash Video",
+        "puids": ["x-fmt/382"],
+        "mimetypes": ["video/x-flv"],
+        "extensions": [".flv"],
+        "preservation": PRESERVE_MKV,
+        "access": None,
+    },
+]
+
+
+class RuleTable:
+    """
+    Rules compiled into dict lookups.
+
+    A file is matched on its PUID first, then its MIME type, then its
+    extension, so identification results take precedence over file names.
+    """
+
+    def __init__(self, rules):
+        self.by_puid = {}
+        self.by_mimetype = {}
+        self.by_extension = {}
+        for rule in rules:
+            # First rule wins when a key is listed twice
+            for puid in rule["puids"]:
+                self.by_puid.setdefault(puid, rule)
+            for mimetype in rule["mimetypes"]:
+                self.by_mimetype.setdefault(mimetype.lower(), rule)
+            for extension in rule["extensions"]:
+                self.by_extension.setdefault(extension.lower(), rule)
+
+    def match(self, filename, puid=None, mimetype=None):
+        """Return (rule, matched_on) for a file, or (None, None) if no rule applies."""
+        if puid and puid in self.by_puid:
+            return self.by_puid[puid], "puid"
+        if mimetype and mimetype.lower() in self.by_mimetype:
+            return self.by_mimetype[mimetype.lower()], "mimetype"
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in self.by_extension:
+            return self.by_extension[ext], "extension"
+        return None, None
+
+
+DEFAULT_RULES = RuleTable(RULES)
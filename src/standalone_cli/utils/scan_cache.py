@@ -0,0 +1,140 @@
+import re
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def signature_version(output):
+    """
+    Parse the engine and signature database version from `clamscan --version`.
+
+    "ClamAV 1.0.5/27426/Tue Oct 15 08:37:11 2024" -> "1.0.5/27426". clamdscan
+    reports the database loaded by clamd in the same format. Returns None if
+    the output does not contain a database version.
+    """
+    match = re.search(r"ClamAV ([^/\s]+)/(\d+)", output)
+    return f"{match.group(1)}/{match.group(2)}" if match else None
+
+
+class ScanCache:
+    """
+    Local SQLite cache of virus-scan results keyed by (sha256, signature database version).
+
+    Content already scanned with the current database is not sent to the
+    scanner again; a database update changes the version, so every file is
+    rescanned once against the new signatures. Entries are evicted least
+    recently used first, entries for older database versions before any
+    others. Hit, miss and eviction counts are kept in the database for stats().
+    """
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS results (
+            sha256 TEXT NOT NULL,
+            db_version TEXT NOT NULL,
+            signature TEXT,
+            scanned_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (sha256, db_version)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)",
+        """
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        """,
+    ]
+
+    def __init__(self, db_path, max_entries=1000000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, checksums, db_version):
+        """
+        Return {sha256: signature} for the checksums already scanned with db_version.
+
+        signature is None for clean content. Found entries are marked as used;
+        hits and misses are added to the counters.
+        """
+        unique = list(set(checksums))
+        results = {}
+        now = time.time()
+        with self.conn:
+            # Stay below SQLite's bound-parameter limit
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                placeholders = ", ".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT sha256, signature FROM results WHERE db_version = ? AND sha256 IN ({placeholders})",
+                    [db_version] + batch
+                ).fetchall()
+                results.update(rows)
+                self.conn.executemany(
+                    "UPDATE results SET last_used = ? WHERE sha256 = ? AND db_version = ?",
+                    ((now, sha256, db_version) for sha256, _ in rows)
+                )
+            self._count("hits", len(results))
+            self._count("misses", len(unique) - len(results))
+        return results
+
+    def record(self, results, db_version):
+        """Store {sha256: signature or None} scanned with db_version, then evict down to max_entries."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (sha256, db_version, signature, scanned_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                ((sha256, db_version, signature, now, now) for sha256, signature in results.items())
+            )
+            self._evict(db_version)
+
+    def _evict(self, db_version):
+        excess = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+        if excess <= 0:
+            return
+        self.conn.execute(
+            "DELETE FROM results WHERE rowid IN ("
+            "SELECT rowid FROM results ORDER BY db_version = ?, last_used LIMIT ?)",
+            (db_version, excess)
+        )
+        self._count("evictions", excess)
+        logger.info(f"Evicted {excess} scan cache entries")
+
+    def _count(self, name, amount):
+        if amount:
+            self.conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM results")
+            self.conn.execute("DELETE FROM counters")
+
+    def stats(self):
+        """Return entry counts per database version and the lifetime hit/miss/eviction counts."""
+        counters = dict(self.conn.execute("SELECT name, value FROM counters"))
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": dict(self.conn.execute(
+                "SELECT db_version, COUNT(*) FROM results GROUP BY db_version ORDER BY db_version"
+            )),
+            "infected": self.conn.execute("SELECT COUNT(*) FROM results WHERE signature IS NOT NULL").fetchone()[0],
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
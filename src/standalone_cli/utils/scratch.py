@@ -0,0 +1,226 @@
+import os
+import errno
+import shutil
+import socket
+import threading
+import time
+import logging
+from .fs import directory_size
+
+logger = logging.getLogger(__name__)
+
+RESERVATIONS_DIR = ".reservations"
+LOCK_FILE = ".lock"
+STALE_LOCK_SECONDS = 60
+
+
+class Reservation:
+    """Space held on a scratch volume for one run. Releases itself when used as a context manager."""
+
+    def __init__(self, allocator, volume, run_id, size):
+        self.allocator = allocator
+        self.volume = volume
+        self.run_id = run_id
+        self.size = size
+
+    @property
+    def processing_path(self):
+        return os.path.join(self.volume, self.run_id)
+
+    def release(self):
+        self.allocator.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class ScratchAllocator:
+    """
+    Places processing directories on one of several scratch volumes.
+
+    Volumes are listed fastest first. A run is placed on the volume with the
+    fewest runs in progress that still has room for it, ties going to the
+    earlier (faster) volume. "Room" is free space minus the part of other
+    runs' reservations they have not written yet, so concurrent transfers, in
+    this process or in other worker processes, do not overcommit a disk.
+
+    Reservations are small files under <volume>/.reservations, guarded by an
+    exclusive lock file so that the check-and-reserve is atomic across processes.
+    """
+
+    _thread_lock = threading.Lock()
+
+    def __init__(self, volumes):
+        self.volumes = [os.path.abspath(volume) for volume in volumes]
+        self.hostname = socket.gethostname()
+
+    def reserve(self, run_id, size):
+        """Reserve size bytes for run_id. Raises OSError(ENOSPC) if no volume has room."""
+        with self._thread_lock:
+            candidates = []
+            for order, volume in enumerate(self.volumes):
+                os.makedirs(os.path.join(volume, RESERVATIONS_DIR), exist_ok=True)
+                written = {}
+                with self._volume_lock(volume):
+                    available, active = self._available(volume, written)
+                if available < size:
+                    # Free space already reflects what running transfers have written, so only the
+                    # unwritten part of their reservations is held back. Measured without the lock.
+                    written = self._written(volume)
+                    with self._volume_lock(volume):
+                        available, active = self._available(volume, written)
+                if available >= size:
+                    candidates.append((active, order, volume, written))
+
+            for active, order, volume, written in sorted(candidates, key=lambda candidate: candidate[:2]):
+                with self._volume_lock(volume):
+                    # Re-check under the lock: another process may have reserved in the meantime
+                    available, active = self._available(volume, written)
+                    if available < size:
+                        continue
+                    with open(self._reservation_path(volume, run_id), 'w') as f:
+                        f.write(f"{size} {self.hostname} {os.getpid()}\n")
+                logger.info(f"Reserved {size} bytes on scratch volume {volume} ({active} other run(s) active)")
+                return Reservation(self, volume, run_id, size)
+
+        raise OSError(errno.ENOSPC, f"No scratch volume has {size} bytes available", ", ".join(self.volumes))
+
+    def release(self, reservation):
+        try:
+            os.remove(self._reservation_path(reservation.volume, reservation.run_id))
+        except FileNotFoundError:
+            pass
+
+    def _reservation_path(self, volume, run_id):
+        return os.path.join(volume, RESERVATIONS_DIR, run_id)
+
+    def _available(self, volume, written):
+        """
+        Return (bytes available for a new reservation, active run count) for volume.
+
+        written maps run IDs to the bytes their processing directories held
+        when measured; reservations without an entry count in full. Only stats
+        and lists the reservations, so it is cheap enough to run under the lock.
+        """
+        reserved = 0
+        active = 0
+        for run_id, size in self._reservations(volume):
+            reserved += max(0, size - written.get(run_id, 0))
+            active += 1
+        return shutil.disk_usage(volume).free - reserved, active
+
+    def _written(self, volume):
+        """Return {run ID: bytes in its processing directory} for the runs holding a reservation on volume."""
+        written = {}
+        for run_id, _ in self._reservations(volume):
+            written[run_id] = directory_size(os.path.join(volume, run_id))
+        return written
+
+    def _reservations(self, volume):
+        """Return [(run ID, reserved bytes)] for volume, dropping reservations of dead local processes."""
+        reservations = []
+        reservations_dir = os.path.join(volume, RESERVATIONS_DIR)
+        for entry in os.listdir(reservations_dir):
+            if entry == LOCK_FILE:
+                continue
+            path = os.path.join(reservations_dir, entry)
+            try:
+                with open(path) as f:
+                    size, hostname, pid = f.read().split()
+            except (OSError, ValueError):
+                continue
+            if hostname == self.hostname and not _pid_alive(int(pid)):
+                logger.warning(f"Removing stale scratch reservation {path}")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            reservations.append((entry, int(size)))
+        return reservations
+
+    def _volume_lock(self, volume):
+        return _LockFile(os.path.join(volume, RESERVATIONS_DIR, LOCK_FILE))
+
+
+class _LockFile:
+    """
+    Portable inter-process lock: whoever manages to create the file holds it.
+
+    The file records the holder's host and pid. A lock held by a process on
+    this host is only broken once that process has died. For holders on other
+    hosts (and on Windows, where liveness cannot be checked safely) the lock
+    is broken after STALE_LOCK_SECONDS; it is only ever held for a listing
+    and a few stats, never for a directory walk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.owner = f"{socket.gethostname()} {os.getpid()}"
+
+    def __enter__(self):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                holder = self._stale_holder()
+                if holder is not None:
+                    self._break(holder)
+                    continue
+                time.sleep(0.05)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.owner)
+            return self
+
+    def _stale_holder(self):
+        # The lock file's content if its holder is gone, else None
+        try:
+            with open(self.path) as f:
+                holder = f.read()
+            age = time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+        try:
+            hostname, pid = holder.split()
+        except ValueError:
+            # Not written yet by a holder that has just created it
+            return holder if age > STALE_LOCK_SECONDS else None
+        if hostname == socket.gethostname() and os.name != 'nt':
+            return holder if not _pid_alive(int(pid)) else None
+        return holder if age > STALE_LOCK_SECONDS else None
+
+    def _break(self, holder):
+        # Only remove the lock if it still belongs to the holder found dead
+        try:
+            with open(self.path) as f:
+                if f.read() != holder:
+                    return
+            logger.warning(f"Breaking stale scratch lock {self.path} held by {holder or 'unknown'}")
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        # os.kill(pid, 0) terminates the process on Windows; assume alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
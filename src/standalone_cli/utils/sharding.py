@@ -0,0 +1,77 @@
+import os
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+
+def plan_shards(items, shard_files, shard_bytes, key=None):
+    """
+    Split an ordered list of files into contiguous shards.
+
+    key(item) gives the file path of an item (default: the item itself). A
+    shard is closed once it holds shard_files files or shard_bytes bytes, at
+    the next change of directory, so a directory's files stay together unless
+    the directory alone is twice the limit. Concatenating the shards gives
+    back the original list.
+    """
+    key = key or (lambda item: item)
+    shards = []
+    current = []
+    current_bytes = 0
+    current_dir = None
+    for item in items:
+        path = key(item)
+        directory = os.path.dirname(path)
+        full = len(current) >= shard_files or current_bytes >= shard_bytes
+        overfull = len(current) >= 2 * shard_files or current_bytes >= 2 * shard_bytes
+        if current and ((full and directory != current_dir) or overfull):
+            shards.append(current)
+            current = []
+            current_bytes = 0
+        current.append(item)
+        current_dir = directory
+        current_bytes += os.path.getsize(path) if os.path.exists(path) else 0
+    if current:
+        shards.append(current)
+    return shards
+
+
+def shard_map(func, items, config, key=None, name="Shard", workers=None):
+    """
+    Run func(shard) over the shards of items and return the results in shard order.
+
+    Transfers with fewer than config.SHARD_MIN_FILES files are processed as
+    a single shard in the calling thread. Larger ones are split with
+    plan_shards and run on config.SHARD_WORKERS threads. The per-file work is
+    done by external tools or hashlib, which release the GIL. Because results
+    are merged in shard order, the output is the same as a serial run.
+
+    Passing workers instead splits the items into at most that many shards,
+    one per thread, for tools whose start-up cost is paid once per shard.
+    """
+    if not items:
+        return []
+    max_workers = config.SHARD_WORKERS if workers is None else workers
+    if len(items) < config.SHARD_MIN_FILES or max_workers <= 1:
+        return [func(items)]
+
+    if workers is None:
+        shards = plan_shards(items, config.SHARD_FILES, config.SHARD_BYTES, key)
+    else:
+        shards = plan_shards(items, -(-len(items) // workers), float("inf"), key)
+    logger.info(f"{name}: {len(items)} files in {len(shards)} shards on {max_workers} workers")
+
+    def run_shard(index, shard):
+        with tracing.span(name, category="shard", shard=index, files=len(shard)):
+            return func(shard)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name) as executor:
+        # Each task gets its own copy of the caller's context, so its log records stay tagged with the transfer
+        futures = [
+            executor.submit(contextvars.copy_context().run, run_shard, index, shard)
+            for index, shard in enumerate(shards)
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,102 @@
+import os
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+_tracer = None
+
+
+class Tracer:
+    """
+    Writes spans as Chrome trace events ("X" complete events).
+
+    The output file is a JSON array that is appended to one event per line and
+    never closed, which the Chrome trace viewer (chrome://tracing) and Perfetto
+    accept as-is. Timestamps are wall-clock microseconds, so several worker
+    processes can append to the same file and their spans line up.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, b"[\n")
+            os.close(fd)
+        except FileExistsError:
+            # Another process (or an earlier run) started the file; keep appending to it
+            pass
+
+    def emit(self, name, category, start, end, args):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int(start * 1_000_000),
+            "dur": int((end - start) * 1_000_000),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        line = (json.dumps(event, default=str) + ",\n").encode("utf-8")
+        with self._lock:
+            # A single O_APPEND write per event keeps lines from concurrent processes intact
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+def configure(path):
+    """Enable tracing to path, or disable it if path is None."""
+    global _tracer
+    _tracer = Tracer(path) if path else None
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, category="step", **attrs):
+    """
+    Record the enclosed block as a span. Does nothing unless tracing is enabled.
+
+    Yields the attribute dict so callers can add attributes (e.g. an exit code)
+    before the span ends.
+    """
+    if _tracer is None:
+        yield attrs
+        return
+
+    path = attrs.get("path")
+    if path and "size" not in attrs and os.path.isfile(path):
+        attrs["size"] = os.path.getsize(path)
+
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs.setdefault("error", f"{e.__class__.__name__}: {e}")
+        raise
+    finally:
+        _tracer.emit(name, category, start, time.time(), attrs)
+
+
+def run(cmd, path=None, **kwargs):
+    """subprocess.run wrapped in a span carrying the tool, file path, size and exit code."""
+    tool = os.path.basename(cmd[0])
+    attrs = {"tool": tool, "command": " ".join(cmd)}
+    if path:
+        attrs["path"] = path
+    with span(tool, category="tool", **attrs) as attrs:
+        try:
+            result = subprocess.run(cmd, **kwargs)
+        except subprocess.CalledProcessError as e:
+            attrs["exit_code"] = e.returncode
+            raise
+        attrs["exit_code"] = result.returncode
+        return result
@@ -0,0 +1,126 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from src.standalone_cli.config import Paths, ProcessingConfiguration
+from src.standalone_cli.engine import WorkflowEngine
+from src.standalone_cli.utils import tracing
+from src.standalone_cli.utils.bag import hash_file, read_manifest, read_bag_info, MANIFEST, MANIFESTS_DIR, TAGMANIFEST
+
+
+class BagOnlyConfiguration(ProcessingConfiguration):
+    """Runs only the steps that need no external tools."""
+    SCAN_FOR_VIRUSES = False
+    GENERATE_STRUCTURE_REPORT = False
+    IDENTIFY_FORMAT_TRANSFER = False
+    EXTRACT_PACKAGES = False
+    EXAMINE_CONTENTS = False
+    STORE_DIP = False
+    NORMALIZE = False
+    UPDATE_AIP_INDEX = False
+    SCAN_CACHE = False
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(Paths, "SCRATCH_VOLUMES", [str(tmp_path / "scratch")])
+    monkeypatch.setattr(Paths, "LOG_DIR", str(tmp_path / "logs"))
+    for name in ("transfers", "aips", "dips"):
+        (tmp_path / name).mkdir()
+    return tmp_path
+
+
+CLAMAV_VERSION = "ClamAV 1.0.5/27426/Tue Oct 15 08:37:11 2024"
+
+
+def read_file_list(list_path):
+    with open(list_path) as f:
+        return f.read().splitlines()
+
+
+def fake_clamscan(cmd):
+    # Files with "eicar" in their name are infected
+    if cmd[1] == "--version":
+        return 0, CLAMAV_VERSION + "\n"
+    paths = read_file_list(cmd[-1][len("--file-list="):])
+    lines = [f"{path}: Eicar-Test-Signature FOUND" if "eicar" in path else f"{path}: OK" for path in paths]
+    found = any("eicar" in path for path in paths)
+    return int(found), "\n".join(lines) + "\n\n----------- SCAN SUMMARY -----------\n"
+
+
+def fake_fido(cmd):
+    # .jpg files are identified as JPEG, everything else is not identified
+    lines = []
+    for path in read_file_list(cmd[2]):
+        if path.endswith(".jpg"):
+            lines.append(f'OK,5,fmt/43,"JPEG","sig",10,"{path}","image/jpeg","signature"')
+        else:
+            lines.append(f'KO,1,,,,10,"{path}",,fail')
+    return 0, "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def fake_tools(monkeypatch):
+    """
+    Replace every tool invocation: convert and ffmpeg copy their input to their output,
+    clamscan and fido answer as in fake_clamscan and fake_fido.
+    """
+    calls = []
+
+    def run(cmd, path=None, **kwargs):
+        calls.append(cmd)
+        returncode, stdout = 0, ""
+        if cmd[0] == Paths.CONVERT_CMD:
+            shutil.copyfile(cmd[1], cmd[-1])
+        elif cmd[0] == Paths.FFMPEG_CMD:
+            shutil.copyfile(cmd[2], cmd[-2])
+        elif cmd[0] == Paths.CLAMSCAN_CMD:
+            returncode, stdout = fake_clamscan(cmd)
+        elif cmd[0] == Paths.FIDO_CMD:
+            returncode, stdout = fake_fido(cmd)
+        return subprocess.CompletedProcess(cmd, returncode, stdout=stdout, stderr="")
+
+    monkeypatch.setattr(tracing, "run", run)
+    return calls
+
+
+@pytest.fixture
+def make_aip(workspace):
+    """Build a transfer from {relative path: bytes} and run it through the workflow; returns the stored AIP dir."""
+    def make(files, name="t1", config=BagOnlyConfiguration):
+        transfer = workspace / "transfers" / name
+        for rel_path, content in files.items():
+            path = transfer / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        WorkflowEngine(str(transfer), str(workspace / "aips"), str(workspace / "dips"), config).run()
+        aips = [p for p in (workspace / "aips").iterdir() if p.is_dir() and p.name.startswith(f"{name}-")]
+        assert len(aips) == 1
+        return str(aips[0])
+    return make
+
+
+def assert_valid_bag(bag_dir):
+    """
+    Every payload file is in manifest-sha256.txt with the right checksum, Payload-Oxum matches,
+    and tagmanifest-sha256.txt matches the tag files.
+
+    data/manifests/ holds copies of the manifests themselves and is left out, as in utils.bag.
+    """
+    manifest = read_manifest(os.path.join(bag_dir, MANIFEST))
+    payload = {}
+    for root, dirs, files in os.walk(os.path.join(bag_dir, "data")):
+        for file in files:
+            path = os.path.join(root, file)
+            rel_path = os.path.relpath(path, bag_dir).replace(os.sep, "/")
+            if not rel_path.startswith(MANIFESTS_DIR):
+                payload[rel_path] = path
+    assert set(manifest) == set(payload)
+    for rel_path, path in payload.items():
+        assert manifest[rel_path] == hash_file(path), rel_path
+    total = sum(os.path.getsize(path) for path in payload.values())
+    assert read_bag_info(bag_dir)["Payload-Oxum"] == f"{total}.{len(payload)}"
+    for rel_path, checksum in read_manifest(os.path.join(bag_dir, TAGMANIFEST)).items():
+        assert checksum == hash_file(os.path.join(bag_dir, rel_path)), rel_path
@@ -0,0 +1,69 @@
+import os
+import shutil
+import sqlite3
+
+from conftest import BagOnlyConfiguration
+from src.standalone_cli.engine import WorkflowEngine
+from src.standalone_cli.utils.accrual import find_parent_aip
+from src.standalone_cli.utils.aip_index import AIPIndex, index_path
+from src.standalone_cli.utils.bag import read_bag_info, write_bag_info
+
+
+class IndexedConfiguration(BagOnlyConfiguration):
+    UPDATE_AIP_INDEX = True
+
+
+def ingest(workspace, files):
+    transfer = workspace / "transfers" / "src"
+    for rel_path, content in files.items():
+        (transfer / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (transfer / rel_path).write_bytes(content)
+    aips = workspace / "aips"
+    before = set(os.listdir(aips))
+    WorkflowEngine(str(transfer), str(aips), str(workspace / "dips"), IndexedConfiguration, accrual=True).run()
+    new = set(os.listdir(aips)) - before - {"aip-index.sqlite"}
+    assert len(new) == 1
+    return str(aips / new.pop())
+
+
+def test_parent_is_found_through_the_index(workspace):
+    aips = str(workspace / "aips")
+    first = ingest(workspace, {"a.txt": b"a"})
+    second = ingest(workspace, {"b.txt": b"b"})
+
+    info = read_bag_info(second)
+    assert info["Accrual-Sequence"] == "1"
+    assert info["Accrual-Parent-Identifier"] == read_bag_info(first)["External-Identifier"]
+    assert find_parent_aip(aips, "src") == second
+    assert find_parent_aip(aips, "src", use_index=False) == second
+
+    # AIPs that are not in the index are not opened
+    unindexed = os.path.join(aips, "src-00000000-0000-0000-0000-000000000000")
+    shutil.copytree(second, unindexed)
+    info["Accrual-Sequence"] = "9"
+    write_bag_info(unindexed, info)
+    assert find_parent_aip(aips, "src", use_index=False) == unindexed
+    assert find_parent_aip(aips, "src") == second
+    shutil.rmtree(unindexed)
+
+    third = ingest(workspace, {"c.txt": b"c"})
+    assert read_bag_info(third)["Accrual-Sequence"] == "2"
+    assert read_bag_info(third)["Accrual-Parent-Identifier"] == read_bag_info(second)["External-Identifier"]
+
+
+def test_older_index_is_migrated(workspace):
+    aips = str(workspace / "aips")
+    second = None
+    for files in ({"a.txt": b"a"}, {"b.txt": b"b"}):
+        second = ingest(workspace, files)
+
+    # An index created before AIPs were recorded by source
+    conn = sqlite3.connect(index_path(aips))
+    with conn:
+        conn.execute("CREATE TABLE old AS SELECT uuid, name, location, indexed_at FROM aips")
+        conn.execute("DROP TABLE aips")
+        conn.execute("ALTER TABLE old RENAME TO aips")
+    conn.close()
+
+    AIPIndex(index_path(aips)).close()
+    assert find_parent_aip(aips, "src") == second
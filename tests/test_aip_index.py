@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import logging
+import os
+
+import pytest
+
+from conftest import BagOnlyConfiguration
+from src.standalone_cli.config import Paths
+from src.standalone_cli.main import run_index
+from src.standalone_cli.utils.aip_index import AIPIndex, index_path
+from src.standalone_cli.utils.bag import read_bag_info
+
+
+class IndexConfiguration(BagOnlyConfiguration):
+    UPDATE_AIP_INDEX = True
+
+
+@pytest.fixture(autouse=True)
+def default_index_path(monkeypatch):
+    monkeypatch.setattr(Paths, "AIP_INDEX", None)
+
+
+def aip_uuid(aip_dir):
+    return read_bag_info(aip_dir)["External-Identifier"]
+
+
+def open_index(workspace):
+    return AIPIndex(index_path(str(workspace / "aips")))
+
+
+def test_backfill_indexes_every_stored_aip(workspace, make_aip):
+    first = make_aip({"a.txt": b"a", "img/photo.jpg": b"jpeg"}, name="t1")
+    second = make_aip({"b.txt": b"b"}, name="t2")
+    (workspace / "aips" / "not-an-aip").mkdir()
+
+    index = open_index(workspace)
+    aip_count, file_count = index.backfill(str(workspace / "aips"), workers=2)
+
+    assert aip_count == 2
+    assert file_count == len(index.query(aip_uuid=aip_uuid(first))) + len(index.query(aip_uuid=aip_uuid(second)))
+    [row] = index.query(path="data/content/objects/img/photo.jpg")
+    assert row["aip_uuid"] == aip_uuid(first)
+    assert row["aip_name"] == os.path.basename(first)
+    assert row["size"] == 4
+    # Running it again replaces the entries instead of adding them twice
+    assert index.backfill(str(workspace / "aips"), workers=2) == (aip_count, file_count)
+    assert len(index.query(path="data/content/objects/img/photo.jpg")) == 1
+    index.close()
+
+
+def test_stored_aips_are_added_to_the_index(workspace, make_aip):
+    first = make_aip({"a.txt": b"a"}, name="t1", config=IndexConfiguration)
+    index = open_index(workspace)
+    assert {row["aip_uuid"] for row in index.query(name="a.txt")} == {aip_uuid(first)}
+
+    second = make_aip({"a.txt": b"a", "c.txt": b"c"}, name="t2", config=IndexConfiguration)
+
+    assert {row["aip_uuid"] for row in index.query(name="a.txt")} == {aip_uuid(first), aip_uuid(second)}
+    assert [row["aip_uuid"] for row in index.query(name="c.txt")] == [aip_uuid(second)]
+    assert index.aips_from_source("t2") == [second]
+    index.close()
+
+
+def test_query_by_checksum_path_name_and_format(workspace, make_aip):
+    aip_dir = make_aip({"a.txt": b"same", "sub/a.txt": b"same", "photo.jpg": b"jpeg"}, config=IndexConfiguration)
+    index = open_index(workspace)
+    same = hashlib.sha256(b"same").hexdigest()
+
+    assert sorted(row["path"] for row in index.query(sha256=same)) == [
+        "data/content/objects/a.txt", "data/content/objects/sub/a.txt"
+    ]
+    [row] = index.query(path="data/content/objects/sub/a.txt")
+    assert (row["sha256"], row["size"], row["format"]) == (same, 4, "text/plain")
+    assert len(index.query(name="a.txt")) == 2
+    assert [row["path"] for row in index.query(file_format="image/jpeg")] == ["data/content/objects/photo.jpg"]
+    # Criteria are combined
+    assert index.query(sha256=same, path="data/content/objects/photo.jpg") == []
+    assert len(index.query(aip_uuid=aip_uuid(aip_dir), name="a.txt", limit=1)) == 1
+    assert index.query(sha256="0" * 64) == []
+    index.close()
+
+
+def index_args(aip_storage, command="query", **criteria):
+    options = dict(sha256=None, path=None, name=None, format=None, aip=None, limit=100, workers=1)
+    options.update(criteria)
+    return argparse.Namespace(aip_storage=str(aip_storage), index_command=command, **options)
+
+
+def test_index_command_queries_the_index(workspace, make_aip, capsys):
+    aip_dir = make_aip({"a.txt": b"a"}, config=IndexConfiguration)
+
+    run_index(index_args(workspace / "aips", name="a.txt"))
+
+    [line] = capsys.readouterr().out.splitlines()
+    assert line.split("\t")[:3] == [aip_uuid(aip_dir), os.path.basename(aip_dir), "data/content/objects/a.txt"]
+
+
+@pytest.mark.parametrize("command", ["query", "backfill"])
+def test_index_command_exits_when_aip_storage_is_missing(tmp_path, caplog, command):
+    with caplog.at_level(logging.ERROR), pytest.raises(SystemExit) as exc_info:
+        run_index(index_args(tmp_path / "missing", command=command))
+
+    assert exc_info.value.code == 1
+    assert "AIP storage does not exist" in caplog.text
+
+
+def test_index_query_exits_when_the_index_was_never_built(workspace, caplog):
+    with caplog.at_level(logging.ERROR), pytest.raises(SystemExit):
+        run_index(index_args(workspace / "aips", name="a.txt"))
+
+    assert "index backfill" in caplog.text
+    assert not os.path.exists(index_path(str(workspace / "aips")))
+
+
+def test_index_command_exits_when_the_index_cannot_be_opened(workspace, caplog, monkeypatch):
+    monkeypatch.setattr(Paths, "AIP_INDEX", str(workspace / "missing" / "aip-index.sqlite"))
+
+    with caplog.at_level(logging.ERROR), pytest.raises(SystemExit):
+        run_index(index_args(workspace / "aips", command="backfill"))
+
+    assert "Cannot open the AIP index" in caplog.text
@@ -0,0 +1,30 @@
+import os
+
+from conftest import BagOnlyConfiguration, assert_valid_bag
+from src.standalone_cli.utils.bag import read_manifest, MANIFEST
+
+
+class InlineNormalizationConfiguration(BagOnlyConfiguration):
+    NORMALIZE = True
+
+
+class DeferredNormalizationConfiguration(BagOnlyConfiguration):
+    NORMALIZE = True
+    DEFER_NORMALIZATION = True
+
+
+def test_files_written_after_bagging_are_in_the_manifest(make_aip, fake_tools):
+    aip_dir = make_aip({"img/a.jpg": b"jpeg bytes", "notes.txt": b"text"}, config=InlineNormalizationConfiguration)
+
+    manifest = read_manifest(os.path.join(aip_dir, MANIFEST))
+    assert "data/content/logs/normalization.csv" in manifest
+    assert "data/content/objects/img/a_preservation.tif" in manifest
+    assert "data/thumbnails/img/a.png" in manifest
+    assert_valid_bag(aip_dir)
+
+
+def test_deferred_normalization_report_is_in_the_manifest(make_aip):
+    aip_dir = make_aip({"img/a.jpg": b"jpeg bytes"}, config=DeferredNormalizationConfiguration)
+
+    assert "data/content/logs/normalization.csv" in read_manifest(os.path.join(aip_dir, MANIFEST))
+    assert_valid_bag(aip_dir)
@@ -0,0 +1,74 @@
+import glob
+import logging
+import os
+
+import pytest
+from lxml import etree
+
+from conftest import BagOnlyConfiguration, assert_valid_bag
+from src.standalone_cli.config import Paths
+from src.standalone_cli.utils.fetch import complete_bag, FETCH_FILE
+from src.standalone_cli.utils.mets import METSGenerator
+
+NS = {"mets": METSGenerator.NS_METS, "premis": METSGenerator.NS_PREMIS}
+
+
+class HoleyConfiguration(BagOnlyConfiguration):
+    FETCH_SIZE_THRESHOLD = 10
+
+
+def test_complete_bag_only_moves_verified_files_into_place(make_aip, workspace):
+    aip_dir = make_aip({"big.bin": b"0123456789abcdef", "small.txt": b"s"}, config=HoleyConfiguration)
+    objects = os.path.join(aip_dir, "data", "content", "objects")
+    assert sorted(os.listdir(objects)) == ["small.txt"]
+
+    # The source changed after ingest: same size, different content
+    source = workspace / "transfers" / "t1" / "big.bin"
+    source.write_bytes(b"fedcba9876543210")
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        complete_bag(aip_dir)
+    assert sorted(os.listdir(objects)) == ["small.txt"]
+    assert os.path.exists(os.path.join(aip_dir, FETCH_FILE))
+
+    source.write_bytes(b"0123456789abcdef")
+    assert complete_bag(aip_dir) == 1
+    assert sorted(os.listdir(objects)) == ["big.bin", "small.txt"]
+    assert not os.path.exists(os.path.join(aip_dir, FETCH_FILE))
+    assert_valid_bag(aip_dir)
+
+
+def fetch_events(aip_dir):
+    """{href: eventDetail} of the PREMIS events linked to mets:file entries through ADMID."""
+    mets = etree.parse(glob.glob(os.path.join(aip_dir, "data", "METS.*.xml"))[0])
+    events = {}
+    for file_el in mets.iterfind(".//mets:fileSec//mets:file", NS):
+        if file_el.get("ADMID"):
+            [amd] = mets.xpath(f"//mets:amdSec[@ID='{file_el.get('ADMID')}']", namespaces=NS)
+            assert amd.findtext(".//premis:eventOutcome", namespaces=NS) == "warning"
+            events[file_el.find("mets:FLocat", NS).get("href")] = amd.findtext(".//premis:eventDetail", namespaces=NS)
+    return events
+
+
+def test_large_files_outside_the_prefixes_are_flagged(make_aip, workspace, monkeypatch, caplog):
+    monkeypatch.setattr(Paths, "FETCH_PATH_PREFIXES", [])
+
+    with caplog.at_level(logging.WARNING):
+        aip_dir = make_aip({"big.bin": b"0123456789abcdef", "small.txt": b"s"}, config=HoleyConfiguration)
+
+    source = workspace / "transfers" / "t1" / "big.bin"
+    assert "big.bin (16 bytes) is left in place outside FETCH_PATH_PREFIXES" in caplog.text
+    [detail] = fetch_events(aip_dir).values()
+    assert list(fetch_events(aip_dir)) == ["content/objects/big.bin"]
+    assert source.resolve().as_uri() in detail
+
+
+def test_files_under_the_prefixes_are_not_flagged(make_aip, workspace, monkeypatch, caplog):
+    monkeypatch.setattr(Paths, "FETCH_PATH_PREFIXES", [str(workspace / "transfers")])
+
+    with caplog.at_level(logging.WARNING):
+        aip_dir = make_aip({"big.bin": b"0123456789abcdef", "small.txt": b"s"}, config=HoleyConfiguration)
+
+    with open(os.path.join(aip_dir, FETCH_FILE)) as f:
+        assert len(f.read().splitlines()) == 2
+    assert "outside FETCH_PATH_PREFIXES" not in caplog.text
+    assert fetch_events(aip_dir) == {}
@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+from collections import Counter
+
+import pytest
+
+from src.standalone_cli.config import Paths, ProcessingConfiguration
+from src.standalone_cli.engine import WorkflowEngine, WorkflowCancelled
+from src.standalone_cli.steps import Step
+from src.standalone_cli.utils.fs import tree_fingerprint
+from src.standalone_cli.utils.job_queue import TransferQueue, Heartbeat
+
+
+def make_transfer(tmp_path):
+    transfer = tmp_path / "transfers" / "t1"
+    transfer.mkdir(parents=True)
+    (transfer / "a.txt").write_text("a")
+    return transfer
+
+
+def test_finished_transfer_is_requeued_when_it_changes(tmp_path):
+    transfer = make_transfer(tmp_path)
+    queue = TransferQueue(str(tmp_path / "queue.sqlite"))
+
+    assert queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    assert queue.claim("w1") == str(transfer)
+    queue.complete(str(transfer), "w1")
+
+    # Unchanged: stays done
+    assert not queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    assert queue.claim("w1") is None
+
+    # Grown: queued again with the new fingerprint
+    (transfer / "b.txt").write_text("bb")
+    assert queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    assert queue.counts() == {"pending": 1}
+    assert queue.claim("w2") == str(transfer)
+    queue.complete(str(transfer), "w2")
+    assert not queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+
+
+def test_forced_requeue(tmp_path):
+    transfer = make_transfer(tmp_path)
+    queue = TransferQueue(str(tmp_path / "queue.sqlite"))
+    queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    queue.claim("w1")
+    queue.fail(str(transfer), "w1", "boom")
+
+    assert queue.enqueue(str(transfer), *tree_fingerprint(transfer), force=True)
+    assert queue.claim("w1") == str(transfer)
+
+
+def test_running_transfer_is_not_reset(tmp_path):
+    transfer = make_transfer(tmp_path)
+    queue = TransferQueue(str(tmp_path / "queue.sqlite"))
+    queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    queue.claim("w1")
+
+    (transfer / "b.txt").write_text("bb")
+    assert not queue.enqueue(str(transfer), *tree_fingerprint(transfer), force=True)
+    assert queue.counts() == {"running": 1}
+
+
+class NoStepsConfiguration(ProcessingConfiguration):
+    SCAN_FOR_VIRUSES = False
+    ASSIGN_UUIDS = False
+    GENERATE_STRUCTURE_REPORT = False
+    IDENTIFY_FORMAT_TRANSFER = False
+    EXTRACT_PACKAGES = False
+    CREATE_SIP = False
+    NORMALIZE = False
+    EXAMINE_CONTENTS = False
+    STORE_AIP = False
+    STORE_DIP = False
+
+
+def test_lost_lease_cancels_running_workflow(tmp_path, monkeypatch):
+    monkeypatch.setattr(Paths, "SCRATCH_VOLUMES", [str(tmp_path / "scratch")])
+    monkeypatch.setattr(Paths, "LOG_DIR", str(tmp_path / "logs"))
+    transfer = make_transfer(tmp_path)
+    db_path = str(tmp_path / "queue.sqlite")
+    queue = TransferQueue(db_path, lease_seconds=60)
+    queue.enqueue(str(transfer), *tree_fingerprint(transfer))
+    assert queue.claim("w1") == str(transfer)
+
+    heartbeat = Heartbeat(queue, str(transfer), "w1", interval=0.05)
+    heartbeat.start()
+    stored = []
+
+    class SlowStep(Step):
+        def execute(self):
+            # w1 stalls past its lease and w2 reclaims the transfer
+            conn = sqlite3.connect(db_path)
+            with conn:
+                conn.execute("UPDATE jobs SET lease_expires = ?", (time.time() - 1,))
+            conn.close()
+            assert queue.claim("w2") == str(transfer)
+            assert heartbeat.lost.wait(5)
+
+    class StoreStep(Step):
+        def execute(self):
+            stored.append(self.context['sip_path'])
+
+    engine = WorkflowEngine(str(transfer), str(tmp_path / "aips"), str(tmp_path / "dips"), NoStepsConfiguration, cancel_event=heartbeat.lost)
+    engine.steps = [SlowStep(engine.context), StoreStep(engine.context)]
+    try:
+        with pytest.raises(WorkflowCancelled):
+            engine.run()
+    finally:
+        heartbeat.stop()
+
+    assert stored == []
+    # The reclaiming worker still holds the transfer
+    assert not queue.heartbeat(str(transfer), "w1")
+    assert queue.heartbeat(str(transfer), "w2")
+
+
+def queue_worker(db_path, root, worker_id, transfers, log_path, lease_seconds, heartbeat_seconds, work_seconds):
+    """A worker process: enqueue what it sees, then claim and 'process' transfers, as run_worker does."""
+    queue = TransferQueue(db_path, lease_seconds=lease_seconds, root=root)
+    for path in transfers:
+        queue.enqueue(path, 1, "fingerprint")
+
+    def record(event, path):
+        with open(log_path, "a") as f:
+            f.write(f"{event} {os.path.relpath(path, root)}\n")
+
+    while True:
+        path = queue.claim(worker_id)
+        if path is None:
+            if queue.counts().get("running", 0) > 0:
+                time.sleep(0.05)
+                continue
+            return
+        record("claimed", path)
+        heartbeat = Heartbeat(queue, path, worker_id, interval=heartbeat_seconds)
+        heartbeat.start()
+        lost = heartbeat.lost.wait(work_seconds)
+        heartbeat.stop()
+        if lost:
+            record("abandoned", path)
+        else:
+            queue.complete(path, worker_id)
+            record("done", path)
+
+
+def read_log(log_path):
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as f:
+        return [line.split() for line in f.read().splitlines()]
+
+
+def start_worker(tmp_path, name, transfers, lease_seconds, heartbeat_seconds, work_seconds):
+    process = multiprocessing.get_context("spawn").Process(target=queue_worker, args=(
+        str(tmp_path / "queue.sqlite"), str(tmp_path / "transfers"), name, transfers,
+        str(tmp_path / f"{name}.log"), lease_seconds, heartbeat_seconds, work_seconds,
+    ))
+    process.start()
+    return process
+
+
+def test_each_transfer_is_claimed_once_by_concurrent_processes(tmp_path):
+    transfers = [str(tmp_path / "transfers" / f"t{index:02}") for index in range(12)]
+    workers = [start_worker(tmp_path, f"w{index}", transfers, 30, 0.02, 0.05) for index in range(4)]
+    for process in workers:
+        process.join(60)
+        assert process.exitcode == 0
+
+    claims = Counter()
+    for index in range(4):
+        for event, rel_path in read_log(tmp_path / f"w{index}.log"):
+            assert event in ("claimed", "done")
+            if event == "claimed":
+                claims[rel_path] += 1
+    assert claims == {f"t{index:02}": 1 for index in range(12)}
+    assert TransferQueue(str(tmp_path / "queue.sqlite")).counts() == {"done": 12}
+
+
+def test_expired_lease_is_reclaimed_and_stale_holder_stops(tmp_path):
+    transfers = [str(tmp_path / "transfers" / "t1")]
+    # Hangs: its lease runs out long before its first heartbeat
+    stale = start_worker(tmp_path, "stale", transfers, lease_seconds=0.5, heartbeat_seconds=2, work_seconds=30)
+    deadline = time.monotonic() + 30
+    while not read_log(tmp_path / "stale.log") and time.monotonic() < deadline:
+        time.sleep(0.05)
+    fresh = start_worker(tmp_path, "fresh", transfers, lease_seconds=30, heartbeat_seconds=0.1, work_seconds=0.2)
+
+    fresh.join(60)
+    stale.join(60)
+    assert fresh.exitcode == 0 and stale.exitcode == 0
+    assert read_log(tmp_path / "fresh.log") == [["claimed", "t1"], ["done", "t1"]]
+    # The stale holder noticed on its next heartbeat and stopped without completing
+    assert read_log(tmp_path / "stale.log") == [["claimed", "t1"], ["abandoned", "t1"]]
+    assert TransferQueue(str(tmp_path / "queue.sqlite")).counts() == {"done": 1}
+
+
+def test_paths_are_shared_across_mount_points(tmp_path):
+    db_path = str(tmp_path / "queue.sqlite")
+    # An older queue that recorded absolute paths
+    legacy = TransferQueue(db_path)
+    legacy.enqueue(str(tmp_path / "mnt-a" / "t0"), 1)
+
+    host_a = TransferQueue(db_path, root=str(tmp_path / "mnt-a"))
+    host_b = TransferQueue(db_path, root=str(tmp_path / "mnt-b"))
+    assert host_a.enqueue(str(tmp_path / "mnt-a" / "t1"), 2)
+    assert not host_b.enqueue(str(tmp_path / "mnt-b" / "t0"), 1)
+
+    assert host_b.claim("b") == str(tmp_path / "mnt-b" / "t1")
+    assert host_b.claim("b") == str(tmp_path / "mnt-b" / "t0")
+    assert host_a.heartbeat(str(tmp_path / "mnt-a" / "t1"), "b")
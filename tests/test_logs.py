@@ -0,0 +1,129 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from src.standalone_cli.config import ProcessingConfiguration
+from src.standalone_cli.utils import logs
+from src.standalone_cli.utils.sharding import shard_map
+
+logger = logging.getLogger(__name__)
+
+
+class SmallShardsConfiguration(ProcessingConfiguration):
+    SHARD_MIN_FILES = 1
+    SHARD_FILES = 2
+    SHARD_WORKERS = 3
+
+
+@pytest.fixture
+def console():
+    """Start the logging listener with a given summary interval; returns the console stream."""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    stream = io.StringIO()
+
+    def start(interval):
+        logs.setup_logging(fmt="%(levelname)s %(message)s", summary_interval=interval, stream=stream)
+        return stream
+
+    yield start
+    logs.stop_logging()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_records_from_shard_threads_go_to_their_transfers_log(console, tmp_path):
+    console(60)
+    log_paths = {}
+    # shard_map sizes its shards from the files
+    files = []
+    for item in range(6):
+        (tmp_path / str(item)).write_text("x")
+        files.append(str(tmp_path / str(item)))
+
+    def process(name):
+        def convert(shard):
+            for path in shard:
+                logger.info(f"Normalized {name}/{os.path.basename(path)}", extra={"progress": "normalized"})
+            return shard
+
+        with logs.transfer_logging(name, "run1", str(tmp_path / "logs")) as log_path:
+            log_paths[name] = log_path
+            logger.info(f"Started {name}")
+            shard_map(convert, files, SmallShardsConfiguration, name=f"Shard-{name}")
+
+    threads = [threading.Thread(target=process, args=(name,)) for name in ("t1", "t2")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logger.info("Not part of any transfer")
+    logs.stop_logging()
+
+    for name, log_path in log_paths.items():
+        entries = read_jsonl(log_path)
+        assert {entry["transfer"] for entry in entries} == {name}
+        normalized = [entry for entry in entries if entry.get("progress") == "normalized"]
+        assert sorted(entry["message"] for entry in normalized) == [f"Normalized {name}/{item}" for item in range(6)]
+        # Logged from the shard threads, not the thread that entered transfer_logging
+        assert all(entry["thread"].startswith(f"Shard-{name}") for entry in normalized)
+        assert entries[0]["message"] == f"Started {name}"
+        assert entries[-1]["message"].startswith("Transfer log written to")
+        assert all("Not part of any transfer" not in entry["message"] for entry in entries)
+
+
+def test_progress_is_summarized_on_a_timer_while_the_queue_is_idle(console):
+    stream = console(0.2)
+
+    for index in range(3):
+        logger.info(f"Normalized {index}.jpg", extra={"progress": "normalized"})
+    # Nothing else is logged; the listener must wake up by itself
+    wait_for(lambda: "Progress [-]: 3 normalized" in stream.getvalue())
+
+    assert "Normalized 0.jpg" not in stream.getvalue()
+
+
+def test_summaries_are_not_written_before_the_interval(console):
+    stream = console(60)
+
+    logger.info("Normalized a.jpg", extra={"progress": "normalized"})
+    logger.info("Generated thumbnail for a.jpg", extra={"progress": "thumbnails"})
+    logger.info("Plain message")
+    wait_for(lambda: "Plain message" in stream.getvalue())
+    time.sleep(0.2)
+    assert "Progress" not in stream.getvalue()
+
+    logs.stop_logging()
+    # The counts still pending are written when the listener stops
+    assert "Progress [-]: 1 normalized, 1 thumbnails" in stream.getvalue()
+
+
+def test_transfer_end_writes_its_summary(console, tmp_path):
+    stream = console(60)
+
+    with logs.transfer_logging("t1", "run1", str(tmp_path)):
+        logger.info("Normalized a.jpg", extra={"progress": "normalized"})
+    wait_for(lambda: "Progress [t1]: 1 normalized" in stream.getvalue())
+    # Warnings are never rolled up
+    logger.warning("Failed to normalize b.jpg", extra={"progress": "normalized"})
+    wait_for(lambda: "WARNING Failed to normalize b.jpg" in stream.getvalue())
@@ -0,0 +1,159 @@
+import csv
+import os
+
+import pytest
+
+from conftest import BagOnlyConfiguration
+from src.standalone_cli.steps.ingest import IdentifyFormatStep
+from src.standalone_cli.steps.process import NormalizeStep
+from src.standalone_cli.utils.normalization_rules import (
+    RuleTable, DEFAULT_RULES, RULES, PRESERVE_TIFF, PRESERVE_MKV, ACCESS_THUMBNAIL
+)
+
+
+def rule(name, puids=(), mimetypes=(), extensions=()):
+    return {
+        "name": name, "puids": list(puids), "mimetypes": list(mimetypes), "extensions": list(extensions),
+        "preservation": None, "access": None,
+    }
+
+
+def test_puid_takes_precedence_over_mimetype_and_extension():
+    # A .png that FIDO identified as JPEG, with a TIFF MIME type from somewhere else
+    matched, matched_on = DEFAULT_RULES.match("photo.png", puid="fmt/43", mimetype="image/tiff")
+    assert (matched["name"], matched_on) == ("JPEG", "puid")
+    assert matched["preservation"] == PRESERVE_TIFF
+
+
+def test_mimetype_is_used_when_the_puid_is_unknown():
+    matched, matched_on = DEFAULT_RULES.match("clip.bin", puid="fmt/99999", mimetype="Video/QuickTime")
+    assert (matched["name"], matched_on) == ("QuickTime", "mimetype")
+    assert matched["preservation"] == PRESERVE_MKV
+
+
+def test_extension_is_the_fallback_for_unidentified_files():
+    matched, matched_on = DEFAULT_RULES.match("SCAN.TIFF")
+    assert (matched["name"], matched_on) == ("TIFF", "extension")
+    # Already a preservation format: no conversion, only a thumbnail
+    assert matched["preservation"] is None
+    assert matched["access"] == ACCESS_THUMBNAIL
+
+    matched, matched_on = DEFAULT_RULES.match("movie.avi", puid="", mimetype="application/octet-stream")
+    assert (matched["name"], matched_on) == ("AVI", "extension")
+
+
+def test_no_rule():
+    assert DEFAULT_RULES.match("notes.txt", puid="x-fmt/111", mimetype="text/plain") == (None, None)
+    assert DEFAULT_RULES.match("README") == (None, None)
+
+
+def test_first_rule_wins_for_keys_listed_twice():
+    table = RuleTable([
+        rule("first", puids=["fmt/1"], mimetypes=["Image/X"], extensions=[".X"]),
+        rule("second", puids=["fmt/1", "fmt/2"], mimetypes=["image/x"], extensions=[".x"]),
+    ])
+    assert table.match("a.bin", puid="fmt/1")[0]["name"] == "first"
+    assert table.match("a.bin", puid="fmt/2")[0]["name"] == "second"
+    assert table.match("a.bin", mimetype="image/X")[0]["name"] == "first"
+    assert table.match("a.x")[0]["name"] == "first"
+
+
+def test_default_table_covers_every_rule():
+    for entry in RULES:
+        for puid in entry["puids"]:
+            assert DEFAULT_RULES.match("", puid=puid) == (entry, "puid")
+        for extension in entry["extensions"]:
+            assert DEFAULT_RULES.match(f"file{extension}")[0] is entry
+
+
+def test_normalization_uses_the_precompiled_table(tmp_path, fake_tools, monkeypatch):
+    compiled = []
+    original_init = RuleTable.__init__
+
+    def init(self, rules):
+        compiled.append(rules)
+        original_init(self, rules)
+
+    monkeypatch.setattr(RuleTable, "__init__", init)
+    for index in range(5):
+        (tmp_path / f"{index}.jpg").write_bytes(b"jpeg")
+        (tmp_path / f"{index}.tif").write_bytes(b"tiff")
+    context = {"sip_path": str(tmp_path), "config": BagOnlyConfiguration, "formats": {"0.jpg": {"puid": "fmt/43"}}}
+
+    NormalizeStep(context).execute()
+
+    # Compiled once at import, never per file or per run
+    assert compiled == []
+    results = {result["file"]: result for result in context["normalization_results"]}
+    assert (results["0.jpg"]["matched_on"], results["0.jpg"]["preservation"]) == ("puid", "converted")
+    assert (results["1.jpg"]["matched_on"], results["1.jpg"]["preservation"]) == ("extension", "converted")
+    assert results["1.tif"]["preservation"] == "skipped: already a preservation format"
+
+
+def fido_line(status, puid, path, mimetype, name="Format"):
+    return f'{status},5,{puid},"{name}","sig",10,"{path}","{mimetype}","signature"'
+
+
+@pytest.fixture
+def identify(tmp_path):
+    sip = tmp_path / "sip"
+    sip.mkdir()
+    context = {
+        "sip_path": str(sip),
+        "config": BagOnlyConfiguration,
+        "fetch_files": [{"source": "/mnt/big/video.avi", "rel_path": "media/video.avi", "size": 10}],
+    }
+    return IdentifyFormatStep(context), str(sip)
+
+
+def test_parse_fido_output_keys_results_by_relative_path(identify):
+    step, sip = identify
+    output = "\n".join([
+        fido_line("OK", "fmt/43", os.path.join(sip, "img", "a.jpg"), "image/jpeg", name="JPEG File Interchange Format"),
+        fido_line("OK", "fmt/5", "/mnt/big/video.avi", "video/x-msvideo"),
+    ])
+
+    assert step._parse_fido_output(output) == {
+        "img/a.jpg": {"puid": "fmt/43", "format_name": "JPEG File Interchange Format", "mimetype": "image/jpeg"},
+        # Fetched files are reported by their source, and keyed by their place in the transfer
+        "media/video.avi": {"puid": "fmt/5", "format_name": "Format", "mimetype": "video/x-msvideo"},
+    }
+
+
+def test_parse_fido_output_keeps_the_first_of_several_matches(identify):
+    step, sip = identify
+    path = os.path.join(sip, "a.tif")
+    output = "\n".join([
+        fido_line("OK", "fmt/353", path, "image/tiff"),
+        fido_line("OK", "fmt/155", path, "image/tiff"),
+    ])
+
+    assert step._parse_fido_output(output)["a.tif"]["puid"] == "fmt/353"
+
+
+def test_parse_fido_output_skips_failures_and_malformed_lines(identify):
+    step, sip = identify
+    output = "\n".join([
+        f'KO,1,,,,10,"{os.path.join(sip, "unknown.bin")}",,fail',
+        "",
+        "Traceback (most recent call last):",
+        'OK,5,fmt/43,"JPEG"',
+        fido_line("OK", "fmt/11", os.path.join(sip, "b.png"), "image/png"),
+    ])
+
+    assert list(step._parse_fido_output(output)) == ["b.png"]
+
+
+def test_unidentified_files_fall_back_to_their_extension(make_aip, fake_tools):
+    class IdentifyConfiguration(BagOnlyConfiguration):
+        IDENTIFY_FORMAT_TRANSFER = True
+        NORMALIZE = True
+
+    # fake_fido identifies .jpg files only
+    aip_dir = make_aip({"a.jpg": b"jpeg", "b.png": b"png", "c.txt": b"text"}, config=IdentifyConfiguration)
+
+    with open(os.path.join(aip_dir, "data", "content", "logs", "normalization.csv"), newline="") as f:
+        report = {row["file"]: row for row in csv.DictReader(f)}
+    assert (report["a.jpg"]["puid"], report["a.jpg"]["matched_on"]) == ("fmt/43", "puid")
+    assert (report["b.png"]["puid"], report["b.png"]["matched_on"]) == ("", "extension")
+    assert (report["c.txt"]["rule"], report["c.txt"]["preservation"]) == ("", "no rule")
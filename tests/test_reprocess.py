@@ -0,0 +1,151 @@
+import csv
+import glob
+import os
+import threading
+
+import pytest
+from lxml import etree
+
+from conftest import BagOnlyConfiguration, assert_valid_bag
+from src.standalone_cli.config import Paths
+from src.standalone_cli.engine import WorkflowCancelled
+from src.standalone_cli.reprocess import reprocess_aip
+from src.standalone_cli.utils import tracing
+from src.standalone_cli.utils.bag import read_manifest, MANIFEST
+
+NS = {"mets": "http://www.loc.gov/METS/"}
+
+
+def mets_files(aip_dir):
+    mets = etree.parse(glob.glob(os.path.join(aip_dir, "data", "METS.*.xml"))[0])
+    files = {}
+    for file_el in mets.iterfind(".//mets:file", NS):
+        href = file_el.find("mets:FLocat", NS).get("href")
+        files[href] = (file_el.getparent().get("USE"), file_el.get("GROUPID"), file_el.get("ID"))
+    fptrs = {fptr.get("FILEID") for fptr in mets.iterfind(".//mets:structMap//mets:fptr", NS)}
+    return files, fptrs
+
+
+def test_reprocess_adds_derivatives_to_mets(make_aip, workspace, fake_tools):
+    aip_dir = make_aip({"img/a.jpg": b"jpeg bytes"})
+
+    reprocess_aip(aip_dir, str(workspace / "dips"), BagOnlyConfiguration, ["normalize"])
+
+    files, fptrs = mets_files(aip_dir)
+    original = files["content/objects/img/a.jpg"]
+    preservation = files["content/objects/img/a_preservation.tif"]
+    assert original[0] == "original"
+    assert preservation[0] == "preservation"
+    # Grouped with its original and reachable from the structMap
+    assert preservation[1] == original[1]
+    assert preservation[2] in fptrs
+    thumbnails = [href for href, (use, _, _) in files.items() if use == "thumbnail"]
+    assert len(thumbnails) == 1
+    assert_valid_bag(aip_dir)
+
+    # A second run with nothing new leaves the METS entries as they are
+    reprocess_aip(aip_dir, str(workspace / "dips"), BagOnlyConfiguration, ["normalize"])
+    assert mets_files(aip_dir)[0] == files
+
+
+def test_thumbnails_of_same_named_files_are_kept_apart(make_aip, workspace, fake_tools):
+    aip_dir = make_aip({"one/a.jpg": b"first", "two/a.jpg": b"second"})
+
+    reprocess_aip(aip_dir, str(workspace / "dips"), BagOnlyConfiguration, ["normalize"])
+
+    thumbnails = os.path.join(aip_dir, "data", "thumbnails")
+    with open(os.path.join(thumbnails, "one", "a.png"), "rb") as f:
+        assert f.read() == b"first"
+    with open(os.path.join(thumbnails, "two", "a.png"), "rb") as f:
+        assert f.read() == b"second"
+
+    files, fptrs = mets_files(aip_dir)
+    for directory in ("one", "two"):
+        original = files[f"content/objects/{directory}/a.jpg"]
+        thumbnail = files[f"thumbnails/{directory}/a.png"]
+        assert thumbnail[0] == "thumbnail"
+        assert thumbnail[1] == original[1]
+    assert_valid_bag(aip_dir)
+
+
+class SerialConfiguration(BagOnlyConfiguration):
+    SHARD_WORKERS = 1
+
+
+def test_lost_lease_stops_normalization_before_the_next_write(make_aip, workspace, fake_tools, monkeypatch):
+    aip_dir = make_aip({"a.jpg": b"first", "b.jpg": b"second", "c.jpg": b"third"})
+    with open(os.path.join(aip_dir, MANIFEST)) as f:
+        manifest = f.read()
+    report_path = os.path.join(aip_dir, "data", "content", "logs", "normalization.csv")
+    assert not os.path.exists(report_path)
+
+    # The lease is lost while the first preservation copy is being written
+    lost = threading.Event()
+    fake_run = tracing.run
+
+    def run(cmd, path=None, **kwargs):
+        result = fake_run(cmd, path=path, **kwargs)
+        lost.set()
+        return result
+
+    monkeypatch.setattr(tracing, "run", run)
+    with pytest.raises(WorkflowCancelled):
+        reprocess_aip(aip_dir, str(workspace / "dips"), SerialConfiguration, ["normalize"], cancel_event=lost)
+
+    converted = [cmd for cmd in fake_tools if cmd[0] == Paths.CONVERT_CMD]
+    assert len(converted) == 1
+    assert os.path.exists(os.path.join(aip_dir, "data", "content", "objects", "a_preservation.tif"))
+    assert not glob.glob(os.path.join(aip_dir, "data", "thumbnails", "*.png"))
+    assert not os.path.exists(report_path)
+    with open(os.path.join(aip_dir, MANIFEST)) as f:
+        assert f.read() == manifest
+
+    # The next holder of the lease adds the copy the cancelled run left behind
+    monkeypatch.setattr(tracing, "run", fake_run)
+    reprocess_aip(aip_dir, str(workspace / "dips"), SerialConfiguration, ["normalize"], cancel_event=threading.Event())
+
+    entries = read_manifest(os.path.join(aip_dir, MANIFEST))
+    for name in ("a", "b", "c"):
+        assert f"data/content/objects/{name}_preservation.tif" in entries
+        assert f"data/thumbnails/{name}.png" in entries
+    assert_valid_bag(aip_dir)
+
+
+class NormalizeConfiguration(BagOnlyConfiguration):
+    NORMALIZE = True
+
+
+class DeferredConfiguration(NormalizeConfiguration):
+    DEFER_NORMALIZATION = True
+
+
+def read_report(aip_dir):
+    with open(os.path.join(aip_dir, "data", "content", "logs", "normalization.csv"), newline="") as f:
+        return {row["file"]: row for row in csv.DictReader(f)}
+
+
+def test_reprocess_merges_the_normalization_report(make_aip, workspace, fake_tools):
+    aip_dir = make_aip({"a.jpg": b"jpeg", "notes.xyz": b"text"}, config=NormalizeConfiguration)
+    assert read_report(aip_dir)["a.jpg"]["preservation"] == "converted"
+
+    reprocess_aip(aip_dir, str(workspace / "dips"), BagOnlyConfiguration, ["normalize"])
+
+    report = read_report(aip_dir)
+    # One row per file: the outcome of the ingest run is kept, the derivative is added
+    assert list(report) == ["a.jpg", "notes.xyz", "a_preservation.tif"]
+    assert report["a.jpg"]["preservation"] == "converted"
+    assert report["notes.xyz"]["preservation"] == "no rule"
+    assert report["a_preservation.tif"]["preservation"] == "skipped: derivative"
+    assert_valid_bag(aip_dir)
+
+
+def test_reprocess_replaces_deferred_outcomes(make_aip, workspace, fake_tools):
+    aip_dir = make_aip({"a.jpg": b"jpeg", "b.jpg": b"jpeg too"}, config=DeferredConfiguration)
+    assert {row["preservation"] for row in read_report(aip_dir).values()} == {"deferred"}
+
+    reprocess_aip(aip_dir, str(workspace / "dips"), BagOnlyConfiguration, ["normalize"])
+
+    report = read_report(aip_dir)
+    assert report["a.jpg"]["preservation"] == report["b.jpg"]["preservation"] == "converted"
+    assert report["a.jpg"]["access"] == "thumbnail"
+    assert_valid_bag(aip_dir)
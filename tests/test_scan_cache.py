@@ -0,0 +1,178 @@
+import argparse
+import itertools
+import json
+import os
+
+import pytest
+
+import conftest
+from conftest import BagOnlyConfiguration
+from src.standalone_cli.config import Paths
+from src.standalone_cli.engine import WorkflowEngine
+from src.standalone_cli.main import run_scan_cache_command
+from src.standalone_cli.steps import ingest
+from src.standalone_cli.utils import scan_cache, tracing
+from src.standalone_cli.utils.scan_cache import ScanCache, signature_version
+
+
+class ScanConfiguration(BagOnlyConfiguration):
+    SCAN_FOR_VIRUSES = True
+    SCAN_CACHE = True
+
+
+@pytest.fixture
+def cache_db(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "scan-cache.sqlite")
+    monkeypatch.setattr(Paths, "SCAN_CACHE", db_path)
+    return db_path
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Distinct, increasing timestamps, so last_used order does not depend on the clock resolution
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(scan_cache.time, "time", lambda: float(next(ticks)))
+
+
+@pytest.fixture
+def scanned(fake_tools, monkeypatch):
+    """Files passed to clamscan through --file-list; the list files are deleted after each scan."""
+    paths = []
+    fake_run = tracing.run
+
+    def run(cmd, path=None, **kwargs):
+        if cmd[0] == Paths.CLAMSCAN_CMD and cmd[-1].startswith("--file-list="):
+            paths.extend(conftest.read_file_list(cmd[-1][len("--file-list="):]))
+        return fake_run(cmd, path=path, **kwargs)
+
+    monkeypatch.setattr(tracing, "run", run)
+    return paths
+
+
+def read_scan_log(aip_dir):
+    with open(os.path.join(aip_dir, "data", "content", "logs", "virus_scan.log")) as f:
+        return f.read()
+
+
+def test_signature_version():
+    assert signature_version(conftest.CLAMAV_VERSION) == "1.0.5/27426"
+    assert signature_version("clamscan: command not found") is None
+
+
+def test_lookup_returns_recorded_results_for_the_same_database(cache_db):
+    cache = ScanCache(cache_db)
+    cache.record({"a" * 64: None, "b" * 64: "Eicar-Test-Signature"}, "1.0.5/1")
+
+    assert cache.lookup(["a" * 64, "b" * 64, "c" * 64], "1.0.5/1") == {"a" * 64: None, "b" * 64: "Eicar-Test-Signature"}
+    assert cache.lookup(["a" * 64], "1.0.5/2") == {}
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["infected"] == 1
+    assert stats["hit_rate"] == 0.5
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(cache_db, clock):
+    cache = ScanCache(cache_db, max_entries=2)
+    cache.record({"a": None}, "v1")
+    cache.record({"b": None}, "v1")
+    # a is now more recently used than b
+    assert cache.lookup(["a"], "v1") == {"a": None}
+
+    cache.record({"c": None}, "v1")
+
+    assert cache.lookup(["a", "b", "c"], "v1") == {"a": None, "c": None}
+    assert cache.stats()["evictions"] == 1
+    cache.close()
+
+
+def test_entries_for_older_databases_are_evicted_first(cache_db, clock):
+    cache = ScanCache(cache_db, max_entries=2)
+    cache.record({"a": None}, "v1")
+    cache.record({"b": None}, "v2")
+    # Used more recently than b, but scanned with the old signatures
+    assert cache.lookup(["a"], "v1") == {"a": None}
+
+    cache.record({"c": None}, "v2")
+
+    assert cache.stats()["entries"] == {"v2": 2}
+    cache.close()
+
+
+def test_unchanged_content_is_not_rescanned(workspace, scanned, cache_db):
+    files = {"a.txt": b"a", "sub/b.txt": b"b", "eicar.com": b"x"}
+    make = lambda name: WorkflowEngine(
+        str(workspace / "transfers" / name), str(workspace / "aips"), str(workspace / "dips"), ScanConfiguration
+    )
+    for name in ("t1", "t2"):
+        for rel_path, content in files.items():
+            path = workspace / "transfers" / name / rel_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+
+    make("t1").run()
+    assert len(scanned) == 3
+
+    del scanned[:]
+    (workspace / "transfers" / "t2" / "new.txt").write_bytes(b"new")
+    make("t2").run()
+
+    assert [os.path.basename(path) for path in scanned] == ["new.txt"]
+    [aip_dir] = [str(path) for path in (workspace / "aips").iterdir() if path.name.startswith("t2-")]
+    log = read_scan_log(aip_dir)
+    assert "a.txt: OK (cached)" in log
+    assert "eicar.com: Eicar-Test-Signature FOUND (cached)" in log
+    assert "new.txt: OK\n" in log
+    assert "Cached results: 3" in log
+
+
+def test_new_signature_database_invalidates_cached_results(make_aip, scanned, cache_db, monkeypatch):
+    make_aip({"a.txt": b"a", "b.txt": b"b"}, name="t1", config=ScanConfiguration)
+
+    monkeypatch.setattr(conftest, "CLAMAV_VERSION", "ClamAV 1.0.5/27427/Wed Oct 16 08:37:11 2024")
+    del scanned[:]
+    aip_dir = make_aip({"a.txt": b"a", "b.txt": b"b"}, name="t2", config=ScanConfiguration)
+
+    assert len(scanned) == 2
+    assert "(cached)" not in read_scan_log(aip_dir)
+    assert "Signature database: 1.0.5/27427" in read_scan_log(aip_dir)
+    assert ScanCache(cache_db).stats()["entries"] == {"1.0.5/27426": 2, "1.0.5/27427": 2}
+
+
+def test_scan_cache_stats_command(make_aip, fake_tools, cache_db, capsys):
+    make_aip({"a.txt": b"a"}, name="t1", config=ScanConfiguration)
+    make_aip({"a.txt": b"a"}, name="t2", config=ScanConfiguration)
+
+    run_scan_cache_command(argparse.Namespace(db=cache_db, scan_cache_command="stats"))
+    stats = json.loads(capsys.readouterr().out)
+
+    assert stats["entries"] == {"1.0.5/27426": 1}
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 0)
+
+    run_scan_cache_command(argparse.Namespace(db=cache_db, scan_cache_command="clear"))
+    run_scan_cache_command(argparse.Namespace(db=cache_db, scan_cache_command="stats"))
+    assert json.loads(capsys.readouterr().out)["entries"] == {}
+
+
+def test_missing_clamscan_skips_the_scan(make_aip, fake_tools, cache_db, monkeypatch):
+    fake_run = tracing.run
+
+    def run(cmd, path=None, **kwargs):
+        if cmd[0] == Paths.CLAMSCAN_CMD:
+            raise FileNotFoundError(2, "No such file or directory", cmd[0])
+        return fake_run(cmd, path=path, **kwargs)
+
+    monkeypatch.setattr(tracing, "run", run)
+    aip_dir = make_aip({"a.txt": b"a"}, config=ScanConfiguration)
+
+    assert not os.path.exists(os.path.join(aip_dir, "data", "content", "logs", "virus_scan.log"))
+
+
+def test_other_missing_files_fail_the_scan(make_aip, fake_tools, cache_db, monkeypatch):
+    def hash_file(path, algorithm="sha256"):
+        raise FileNotFoundError(2, "No such file or directory", path)
+
+    monkeypatch.setattr(ingest, "hash_file", hash_file)
+    with pytest.raises(FileNotFoundError):
+        make_aip({"a.txt": b"a"}, config=ScanConfiguration)
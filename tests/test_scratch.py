@@ -0,0 +1,86 @@
+import errno
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+
+from src.standalone_cli.utils import scratch
+from src.standalone_cli.utils.fs import directory_size
+from src.standalone_cli.utils.scratch import ScratchAllocator, RESERVATIONS_DIR, LOCK_FILE, STALE_LOCK_SECONDS
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+CAPACITY = 1000
+
+
+@pytest.fixture
+def volume(tmp_path, monkeypatch):
+    # A 1000-byte disk: free space shrinks as processing directories are written
+    volume = tmp_path / "scratch"
+    volume.mkdir()
+
+    def disk_usage(path):
+        used = sum(directory_size(str(entry)) for entry in volume.iterdir() if not entry.name.startswith("."))
+        return DiskUsage(CAPACITY, used, CAPACITY - used)
+
+    monkeypatch.setattr(scratch.shutil, "disk_usage", disk_usage)
+    return volume
+
+
+def test_written_bytes_are_not_counted_twice(volume):
+    allocator = ScratchAllocator([str(volume)])
+    running = allocator.reserve("run-a", 600)
+
+    # run-a has written 500 of its 600 bytes; 500 are free, 100 of them still promised to run-a
+    os.makedirs(running.processing_path)
+    with open(os.path.join(running.processing_path, "copy"), "wb") as f:
+        f.write(b"x" * 500)
+
+    second = allocator.reserve("run-b", 400)
+    assert second.volume == str(volume)
+
+    with pytest.raises(OSError) as excinfo:
+        allocator.reserve("run-c", 1)
+    assert excinfo.value.errno == errno.ENOSPC
+
+    running.release()
+    shutil.rmtree(running.processing_path)
+    assert allocator.reserve("run-c", 500)
+
+
+def write_lock(volume, holder, age):
+    lock = volume / RESERVATIONS_DIR / LOCK_FILE
+    lock.parent.mkdir(exist_ok=True)
+    lock.write_text(holder)
+    then = time.time() - age
+    os.utime(lock, (then, then))
+    return lock
+
+
+def test_lock_of_a_live_process_is_not_broken(volume):
+    # Held by this (live) process for longer than STALE_LOCK_SECONDS, e.g. a slow filesystem
+    lock = write_lock(volume, f"{socket.gethostname()} {os.getpid()}", STALE_LOCK_SECONDS * 2)
+    allocator = ScratchAllocator([str(volume)])
+    reserved = []
+    worker = threading.Thread(target=lambda: reserved.append(allocator.reserve("run-a", 100)))
+    worker.start()
+    worker.join(0.5)
+    assert worker.is_alive() and reserved == []
+
+    lock.unlink()
+    worker.join(10)
+    assert len(reserved) == 1
+
+
+def test_lock_of_a_dead_process_is_broken(volume):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    write_lock(volume, f"{socket.gethostname()} {dead.pid}", 0)
+
+    assert ScratchAllocator([str(volume)]).reserve("run-a", 100)
+    assert not (volume / RESERVATIONS_DIR / LOCK_FILE).exists()
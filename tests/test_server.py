@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import BagOnlyConfiguration
+from src.standalone_cli.server import JobManager, JobServer, JobClient
+from src.standalone_cli.steps.process import ProcessContentStep
+
+
+class ExamineConfiguration(BagOnlyConfiguration):
+    EXAMINE_CONTENTS = True
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    """Makes ProcessContentStep block until released, so a job can be held in the 'running' state."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def execute(self):
+        started.set()
+        assert release.wait(10)
+
+    monkeypatch.setattr(ProcessContentStep, "execute", execute)
+    yield started, release
+    release.set()
+
+
+def make_transfer(workspace, name):
+    transfer = workspace / "transfers" / name
+    transfer.mkdir()
+    (transfer / "a.txt").write_text(name)
+    return str(transfer)
+
+
+def stored_aips(workspace):
+    return sorted(item for item in os.listdir(workspace / "aips") if os.path.isdir(workspace / "aips" / item))
+
+
+@pytest.fixture
+def server(workspace):
+    jobs = JobManager(str(workspace / "aips"), str(workspace / "dips"), ExamineConfiguration, workers=1)
+    server = JobServer(("127.0.0.1", 0), jobs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield JobClient(f"http://127.0.0.1:{server.server_port}")
+    server.shutdown()
+    server.server_close()
+    jobs.shutdown()
+
+
+def test_submit_status_and_cancel(server, workspace, gate):
+    started, release = gate
+
+    running = server.submit(make_transfer(workspace, "t1"))
+    assert started.wait(10)
+    assert server.status(running["id"])["state"] == "running"
+
+    # The single worker is busy, so the next job waits
+    queued = server.submit(make_transfer(workspace, "t2"))
+    assert queued["state"] == "queued"
+    cancelled = server.cancel(queued["id"])
+    assert cancelled["state"] == "cancelled"
+    assert cancelled["finished_at"] is not None
+
+    # A running job stops before its next step
+    assert server.cancel(running["id"])["state"] == "running"
+    release.set()
+    assert server.wait(running["id"], interval=0.05)["state"] == "cancelled"
+    assert stored_aips(workspace) == []
+
+    done = server.wait(server.submit(make_transfer(workspace, "t3"))["id"], interval=0.05)
+    assert done["state"] == "done"
+    assert [name.split("-")[0] for name in stored_aips(workspace)] == ["t3"]
+    assert {job["id"] for job in server.list()} == {running["id"], queued["id"], done["id"]}
+
+
+def test_unknown_job_and_bad_transfer(server, workspace):
+    with pytest.raises(RuntimeError, match="no such job"):
+        server.status("nope")
+    with pytest.raises(RuntimeError, match="400"):
+        server.submit(str(workspace / "missing"))
+
+
+def test_finished_jobs_are_pruned(workspace):
+    class OneFinishedJobConfiguration(BagOnlyConfiguration):
+        SERVER_MAX_FINISHED_JOBS = 1
+
+    jobs = JobManager(str(workspace / "aips"), str(workspace / "dips"), OneFinishedJobConfiguration, workers=1)
+    try:
+        first = jobs.submit(make_transfer(workspace, "t1"))
+        second = jobs.submit(make_transfer(workspace, "t2"))
+        jobs.executor.submit(lambda: None).result()
+        assert [job["id"] for job in jobs.list()] == [second["id"]]
+        assert jobs.status(first["id"]) is None
+    finally:
+        jobs.shutdown()
+
+
+def test_shutdown_cancels_queued_jobs(workspace, gate):
+    started, release = gate
+    jobs = JobManager(str(workspace / "aips"), str(workspace / "dips"), ExamineConfiguration, workers=1)
+    running = jobs.submit(make_transfer(workspace, "t1"))
+    assert started.wait(10)
+    queued = jobs.submit(make_transfer(workspace, "t2"))
+
+    stopper = threading.Thread(target=jobs.shutdown)
+    stopper.start()
+    # Let the worker go only once shutdown has dealt with the queued job
+    deadline = time.monotonic() + 10
+    while jobs.status(queued["id"])["state"] == "queued" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    stopper.join(10)
+
+    assert jobs.status(running["id"])["state"] == "done"
+    queued = jobs.status(queued["id"])
+    assert queued["state"] == "cancelled"
+    assert queued["finished_at"] is not None
@@ -0,0 +1,129 @@
+import os
+import re
+
+from lxml import etree
+
+from conftest import assert_valid_bag
+from src.standalone_cli.config import ProcessingConfiguration
+from src.standalone_cli.engine import WorkflowEngine
+from src.standalone_cli.utils.bag import read_bag_info, read_manifest, MANIFEST
+from src.standalone_cli.utils.sharding import shard_map
+
+NS = {"mets": "http://www.loc.gov/METS/"}
+UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class SmallShardsConfiguration(ProcessingConfiguration):
+    SHARD_MIN_FILES = 1
+    SHARD_FILES = 2
+    SHARD_BYTES = 1024
+    SHARD_WORKERS = 8
+
+
+def make_files(tmp_path):
+    paths = []
+    for directory in ("a", "b", "c"):
+        (tmp_path / directory).mkdir()
+        for index in range(10):
+            path = tmp_path / directory / f"{index}.txt"
+            path.write_text("x")
+            paths.append(str(path))
+    return paths
+
+
+def test_workers_caps_the_number_of_shards(tmp_path):
+    paths = make_files(tmp_path)
+
+    shards = shard_map(list, paths, SmallShardsConfiguration)
+    assert len(shards) == 9
+
+    # One invocation per worker, e.g. one signature database load per clamscan
+    shards = shard_map(list, paths, SmallShardsConfiguration, workers=3)
+    assert len(shards) == 3
+    assert sum(shards, []) == paths
+
+    assert shard_map(list, paths, SmallShardsConfiguration, workers=1) == [paths]
+
+
+class FullConfiguration(ProcessingConfiguration):
+    """Every step that fake_tools can stand in for, with normalization inline."""
+    GENERATE_STRUCTURE_REPORT = False
+    STORE_DIP = False
+    UPDATE_AIP_INDEX = False
+    SCAN_CACHE = False
+    SHARD_WORKERS = 1
+
+
+class ShardedConfiguration(FullConfiguration):
+    SHARD_MIN_FILES = 1
+    SHARD_FILES = 3
+    SHARD_WORKERS = 4
+    SCAN_SHARD_WORKERS = 3
+
+
+def describe_bag(aip_dir):
+    """Everything that must not depend on sharding: per-run UUIDs and dates are masked."""
+    sip_uuid = read_bag_info(aip_dir)["External-Identifier"]
+    mets_path = os.path.join(aip_dir, "data", f"METS.{sip_uuid}.xml")
+    logs = os.path.join(aip_dir, "data", "content", "logs")
+
+    # Payload that carries per-run identifiers is compared through the METS description below
+    varying = ("data/METS.", "data/content/metadata/", "data/content/submissionDocumentation/", "data/content/logs/fido.xml")
+    manifest = [
+        (path.replace(sip_uuid, "<uuid>"), "-" if path.startswith(varying) else checksum)
+        for path, checksum in read_manifest(os.path.join(aip_dir, MANIFEST)).items()
+    ]
+
+    groups = {}
+    file_sec = []
+    for file_el in etree.parse(mets_path).iterfind(".//mets:fileSec/mets:fileGrp/mets:file", NS):
+        group = groups.setdefault(file_el.get("GROUPID"), len(groups))
+        file_sec.append((
+            file_el.getparent().get("USE"), group,
+            file_el.find("mets:FLocat", NS).get("href"), file_el.get("SIZE"), file_el.get("CHECKSUM"),
+        ))
+
+    with open(os.path.join(logs, "normalization.csv")) as f:
+        normalization = f.read()
+    with open(os.path.join(logs, "virus_scan.log")) as f:
+        virus_scan = f.read()
+    # FIDO reports the paths of the working copy, which contain the run ID
+    with open(os.path.join(logs, "fido.xml")) as f:
+        fido = UUID.sub("<uuid>", f.read())
+    return {
+        "manifest": manifest,
+        "oxum": read_bag_info(aip_dir)["Payload-Oxum"],
+        "file_sec": file_sec,
+        "normalization": normalization,
+        "virus_scan": virus_scan,
+        "fido": fido,
+    }
+
+
+def test_sharded_run_builds_the_same_bag_as_a_serial_run(workspace, fake_tools):
+    transfer = workspace / "transfers" / "t1"
+    for directory in ("one", "two", "two/deeper", "three"):
+        for name in ("a.jpg", "b.jpg", "notes.txt"):
+            path = transfer / directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(f"{directory}/{name}".encode())
+    (transfer / "three" / "eicar.com").write_bytes(b"not really")
+
+    bags = {}
+    scans = {}
+    for label, config in (("serial", FullConfiguration), ("sharded", ShardedConfiguration)):
+        aips = workspace / f"aips-{label}"
+        aips.mkdir()
+        del fake_tools[:]
+        WorkflowEngine(str(transfer), str(aips), str(workspace / "dips"), config).run()
+        scans[label] = sum(1 for cmd in fake_tools if cmd[-1].startswith("--file-list="))
+        [aip_dir] = [str(path) for path in aips.iterdir() if path.is_dir()]
+        assert_valid_bag(aip_dir)
+        bags[label] = describe_bag(aip_dir)
+
+    # The sharded run did split the work
+    assert scans["serial"] == 1
+    assert 1 < scans["sharded"] <= ShardedConfiguration.SCAN_SHARD_WORKERS
+    assert "Eicar-Test-Signature FOUND" in bags["serial"]["virus_scan"]
+    for key in bags["serial"]:
+        assert bags["sharded"][key] == bags["serial"][key], key
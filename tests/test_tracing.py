@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import sys
+import threading
+
+import pytest
+
+from src.standalone_cli import main
+from src.standalone_cli.config import Paths, ProcessingConfiguration
+from src.standalone_cli.utils import logs, tracing
+
+# The real wrapper, so tool spans are recorded; fake_tools replaces it
+TRACED_RUN = tracing.run
+
+
+@pytest.fixture
+def traced_tools(fake_tools, monkeypatch):
+    """fake_tools one level down: tracing.run records its span and calls the fake in place of subprocess.run."""
+    fake_run = tracing.run
+    monkeypatch.setattr(tracing, "run", TRACED_RUN)
+    monkeypatch.setattr(tracing.subprocess, "run", fake_run)
+    return fake_tools
+
+
+@pytest.fixture
+def cli(monkeypatch):
+    """Run main() with the given arguments, restoring logging and tracing afterwards."""
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+
+    def run(*args):
+        monkeypatch.setattr(sys, "argv", ["standalone_cli", *args])
+        main.main()
+        logs.stop_logging()
+
+    yield run
+    logs.stop_logging()
+    tracing.configure(None)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def read_trace(path):
+    """Parse a trace file the way the trace viewers do: a JSON array whose closing bracket may be missing."""
+    with open(path) as f:
+        text = f.read()
+    assert text.startswith("[\n")
+    return json.loads(text.rstrip().rstrip(",") + "]")
+
+
+def contains(outer, inner):
+    # Timestamps and durations are truncated to whole microseconds separately
+    return outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"] + 2
+
+
+def test_trace_of_a_sharded_transfer(workspace, traced_tools, cli, monkeypatch):
+    monkeypatch.setattr(ProcessingConfiguration, "SHARD_MIN_FILES", 1)
+    monkeypatch.setattr(ProcessingConfiguration, "SHARD_FILES", 2)
+    monkeypatch.setattr(ProcessingConfiguration, "SHARD_WORKERS", 3)
+    monkeypatch.setattr(Paths, "SCAN_CACHE", str(workspace / "scan-cache.sqlite"))
+    for directory in ("one", "two", "three"):
+        for name in ("a.jpg", "b.jpg"):
+            path = workspace / "transfers" / "t1" / directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(f"{directory}/{name}".encode())
+    trace_path = str(workspace / "trace.json")
+
+    cli(
+        "--transfer-path", str(workspace / "transfers"),
+        "--aip-storage", str(workspace / "aips"),
+        "--dip-storage", str(workspace / "dips"),
+        "--trace", trace_path,
+    )
+
+    assert [path.name.startswith("t1-") for path in (workspace / "aips").iterdir() if path.is_dir()] == [True]
+    events = read_trace(trace_path)
+    for event in events:
+        assert event["ph"] == "X"
+        assert set(event) >= {"name", "cat", "ts", "dur", "pid", "tid", "args"}
+        assert isinstance(event["ts"], int) and event["dur"] >= 0
+        assert event["pid"] == os.getpid()
+        assert "error" not in event["args"], event
+
+    main_thread = threading.get_ident()
+    steps = {event["name"]: event for event in events if event["cat"] == "step"}
+    for name in ("CopyTransfer", "ScanVirusStep", "IdentifyFormatStep", "CreateSIPStep", "NormalizeStep", "UpdateBagStep", "StoreAIPStep"):
+        assert name in steps, name
+        assert steps[name]["tid"] == main_thread
+        assert steps[name]["args"]["transfer"] == "t1"
+    # One span per step per transfer, one after the other
+    assert len(steps) == len([event for event in events if event["cat"] == "step"])
+    ordered = sorted(steps.values(), key=lambda event: event["ts"])
+    for before, after in zip(ordered, ordered[1:]):
+        assert before["ts"] + before["dur"] <= after["ts"] + 2
+
+    shards = [event for event in events if event["cat"] == "shard"]
+    normalize_shards = [event for event in shards if event["name"] == "NormalizeShard"]
+    assert sorted(event["args"]["shard"] for event in normalize_shards) == [0, 1, 2]
+    assert sum(event["args"]["files"] for event in normalize_shards) == 6
+    for shard in shards:
+        # Run on the worker threads, inside the step that started them
+        assert shard["tid"] != main_thread
+        assert any(contains(step, shard) for step in steps.values()), shard
+
+    tools = [event for event in events if event["cat"] == "tool"]
+    assert {event["name"] for event in tools} >= {"clamscan", "fido", "convert"}
+    for tool in tools:
+        assert tool["args"]["exit_code"] == 0 or tool["name"] == "clamscan"
+        if tool["tid"] == main_thread:
+            assert any(contains(step, tool) for step in steps.values()), tool
+        else:
+            # Tools started by a shard thread are recorded with that thread's tid
+            assert any(shard["tid"] == tool["tid"] and contains(shard, tool) for shard in shards), tool
+    converts = [tool for tool in tools if tool["name"] == "convert"]
+    # A preservation copy and a thumbnail per JPEG, all from NormalizeShard threads
+    assert len(converts) == 12
+    assert {tool["tid"] for tool in converts} <= {shard["tid"] for shard in normalize_shards}
+    assert all(contains(steps["NormalizeStep"], tool) for tool in converts)